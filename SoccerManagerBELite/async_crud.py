@@ -0,0 +1,234 @@
+# asynchronous database utils
+#
+# Every function mirrors the one with the same name in `crud`, and is meant to
+# be awaited from `async def` routes with an AsyncSession (see
+# `database.get_async_db`). The queries themselves are the ones in `crud`: they
+# are run through `AsyncSession.run_sync`, so SQL is issued by the asyncio
+# driver and the event loop is free while waiting on the database. The cache
+# topics they publish are bumped once they return, in the thread pool when the
+# cache backend blocks (see run_sync).
+
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncResult, AsyncSession
+import models
+import schemas
+import crud
+from cache import invalidation_bus
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+
+async def run_sync(db: AsyncSession, fn: Callable, *args):
+    """
+    db.run_sync(fn, *args), the cache topics published by `fn` being bumped after it returned,
+    without blocking the event loop on the cache backend
+    """
+    try:
+        with invalidation_bus.defer() as topics:
+            return await db.run_sync(fn, *args)
+    finally:
+        # also when `fn` failed after a commit
+        await invalidation_bus.publish_async(*topics)
+
+
+
+async def get_user_by_username(db: AsyncSession, username: str) -> models.User:
+    return await run_sync(db, crud.get_user_by_username, username)
+
+
+async def get_user_and_team(db: AsyncSession, username: str) -> Tuple[models.User, models.Team]:
+    return await run_sync(db, crud.get_user_and_team, username)
+
+
+
+async def get_team_by_team_id(db: AsyncSession, team_id: int) -> models.Team:
+    return await run_sync(db, crud.get_team_by_team_id, team_id)
+
+
+async def get_players_by_team_id(db: AsyncSession, team_id: int) -> List[models.Player]:
+    return await run_sync(db, crud.get_players_by_team_id, team_id)
+
+
+async def get_player_by_player_id(db: AsyncSession, player_id: int) -> models.Player:
+    return await run_sync(db, crud.get_player_by_player_id, player_id)
+
+
+
+async def get_market_rows(
+        db: AsyncSession,
+        filters: schemas.MarketFilter = None,
+        sort: str = 'id',
+        order: str = 'asc',
+        after: Tuple = None,
+        limit: int = None
+        ) -> List[Row]:
+    return await run_sync(db, crud.get_market_rows, filters, sort, order, after, limit)
+
+
+async def get_team_player_rows(db: AsyncSession, team_id: int) -> List[Row]:
+    return await run_sync(db, crud.get_team_player_rows, team_id)
+
+
+async def stream_market_export(db: AsyncSession, filters: schemas.MarketFilter = None) -> AsyncResult:
+    """
+    :return: result streaming the exported columns of the market list, read through a server side cursor
+    """
+    statement = crud.market_export_statement(filters).execution_options(yield_per=crud.EXPORT_BATCH_SIZE)
+    return await db.stream(statement)
+
+
+async def create_user(db: AsyncSession, user: schemas.User, hashed_password: str = None) -> models.User:
+    return await run_sync(db, crud.create_user, user, hashed_password)
+
+
+async def register_user(db: AsyncSession, user: schemas.User, hashed_password: str) -> models.User:
+    return await run_sync(db, crud.register_user, user, hashed_password)
+
+
+async def register_team(db: AsyncSession, user_id: int, username: str, player_ids: List[int]) -> models.Team:
+    return await run_sync(db, crud.register_team, user_id, username, player_ids)
+
+
+async def delete_user(db: AsyncSession, user_id: int):
+    return await run_sync(db, crud.delete_user, user_id)
+
+
+
+
+async def update_player(db: AsyncSession, player: models.Player, player_name, player_surname, player_country):
+    return await run_sync(db, crud.update_player, player, player_name, player_surname, player_country)
+
+
+
+
+async def put_player_for_sale(db: AsyncSession, player: models.Player, price: int):
+    return await run_sync(db, crud.put_player_for_sale, player, price)
+
+
+async def get_players_by_ids(db: AsyncSession, player_ids: List[int]) -> Dict[int, models.Player]:
+    return await run_sync(db, crud.get_players_by_ids, player_ids)
+
+
+async def put_players_for_sale(db: AsyncSession, team_id: int, orders: List[Tuple[int, int]]) \
+        -> List[schemas.BatchItemResult]:
+    return await run_sync(db, crud.put_players_for_sale, team_id, orders)
+
+
+async def remove_players_for_sale(db: AsyncSession, team_id: int, player_ids: List[int]) \
+        -> List[schemas.BatchItemResult]:
+    return await run_sync(db, crud.remove_players_for_sale, team_id, player_ids)
+
+
+async def acquire_player(db: AsyncSession, player: models.Player, user_team: models.Team, bid_id: int = None):
+    return await run_sync(db, crud.acquire_player, player, user_team, bid_id)
+
+
+async def remove_player_for_sale(db: AsyncSession, player: models.Player):
+    return await run_sync(db, crud.remove_player_for_sale, player)
+
+
+async def load_order_book(db: AsyncSession):
+    return await run_sync(db, crud.load_order_book)
+
+
+async def get_team_bids(db: AsyncSession, team_id: int) -> List[models.Bid]:
+    return await run_sync(db, crud.get_team_bids, team_id)
+
+
+async def _order_book_versions() -> List[int]:
+    # read off the event loop, for the order book to check whether another worker changed the orders
+    return await invalidation_bus.versions_async(crud.ORDER_BOOK_TOPICS)
+
+
+async def place_bid(db: AsyncSession, team_id: int, order: schemas.BidOrder) \
+        -> Tuple[schemas.Bid, List[schemas.Trade]]:
+    return await run_sync(db, crud.place_bid, team_id, order, await _order_book_versions())
+
+
+async def cancel_bid(db: AsyncSession, team_id: int, bid_id: int) -> schemas.Bid:
+    return await run_sync(db, crud.cancel_bid, team_id, bid_id)
+
+
+async def match_orders(db: AsyncSession, bid_id: int = None, player_id: int = None) -> List[schemas.Trade]:
+    return await run_sync(db, crud.match_orders, bid_id, player_id, await _order_book_versions())
+
+
+async def get_open_auction(db: AsyncSession, player_id: int) -> Optional[models.Auction]:
+    return await run_sync(db, crud.get_open_auction, player_id)
+
+
+async def get_auctioned_player_ids(db: AsyncSession, player_ids: List[int]) -> Set[int]:
+    return await run_sync(db, crud.get_auctioned_player_ids, player_ids)
+
+
+async def get_open_auctions(db: AsyncSession, limit: int = 100) -> List[models.Auction]:
+    return await run_sync(db, crud.get_open_auctions, limit)
+
+
+async def get_auctions_ending_before(db: AsyncSession, until: datetime) -> List[Row]:
+    return await run_sync(db, crud.get_auctions_ending_before, until)
+
+
+async def start_auction(db: AsyncSession, player: models.Player, reserve_price: int, duration: int,
+                        now: datetime = None) -> schemas.Auction:
+    return await run_sync(db, crud.start_auction, player, reserve_price, duration, now)
+
+
+async def place_auction_bid(db: AsyncSession, auction_id: int, team: models.Team, amount: int,
+                            now: datetime = None) -> schemas.Auction:
+    return await run_sync(db, crud.place_auction_bid, auction_id, team, amount, now)
+
+
+async def settle_auctions(db: AsyncSession, auction_ids: List[int], now: datetime = None) -> Dict[int, str]:
+    return await run_sync(db, crud.settle_auctions, auction_ids, now)
+
+
+async def claim_idempotency_key(db: AsyncSession, user_id: int, key: str, fingerprint: str, now: datetime = None,
+                                ttl: int = None, lock_timeout: int = None) -> Optional[models.IdempotencyKey]:
+    return await run_sync(db, crud.claim_idempotency_key, user_id, key, fingerprint, now, ttl, lock_timeout)
+
+
+async def get_idempotency_key(db: AsyncSession, user_id: int, key: str) -> Optional[models.IdempotencyKey]:
+    return await run_sync(db, crud.get_idempotency_key, user_id, key)
+
+
+async def save_idempotent_response(db: AsyncSession, user_id: int, key: str, status_code: int, headers: str,
+                                   body: bytes):
+    return await run_sync(db, crud.save_idempotent_response, user_id, key, status_code, headers, body)
+
+
+async def release_idempotency_key(db: AsyncSession, user_id: int, key: str):
+    return await run_sync(db, crud.release_idempotency_key, user_id, key)
+
+
+async def purge_idempotency_keys(db: AsyncSession, now: datetime = None) -> int:
+    return await run_sync(db, crud.purge_idempotency_keys, now)
+
+
+async def get_shard_transfer(db: AsyncSession, transfer_id: str) -> Optional[models.ShardTransfer]:
+    return await run_sync(db, crud.get_shard_transfer, transfer_id)
+
+
+async def get_reserved_transfers(db: AsyncSession, before: datetime) -> List[models.ShardTransfer]:
+    return await run_sync(db, crud.get_reserved_transfers, before)
+
+
+async def reserve_transfer(db: AsyncSession, player: models.Player, buyer_team_id: int,
+                           now: datetime = None) -> models.ShardTransfer:
+    return await run_sync(db, crud.reserve_transfer, player, buyer_team_id, now)
+
+
+async def decide_transfer(db: AsyncSession, transfer: models.ShardTransfer, status: str) -> str:
+    return await run_sync(db, crud.decide_transfer, transfer, status)
+
+
+async def receive_transfer(db: AsyncSession, transfer: models.ShardTransfer, player: models.Player) -> str:
+    return await run_sync(db, crud.receive_transfer, transfer, player)
+
+
+async def complete_transfer(db: AsyncSession, transfer_id: str) -> bool:
+    return await run_sync(db, crud.complete_transfer, transfer_id)
+
+
+async def cancel_transfer(db: AsyncSession, transfer_id: str) -> bool:
+    return await run_sync(db, crud.cancel_transfer, transfer_id)
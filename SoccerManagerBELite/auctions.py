@@ -0,0 +1,154 @@
+# expiration scheduler of the timed auctions
+#
+# The open auctions ending soon are kept in a min-heap of (end time, auction id):
+# the scheduler sleeps until the first end time, pops every auction due and
+# settles them through `crud.settle_auctions`, `batch_size` auctions per
+# transaction. Expiring an auction costs a heap pop, never a scan of the
+# auctions or players tables.
+# The heap only holds the auctions ending within `horizon` seconds: it is
+# refilled from the open auctions index every half horizon, which also picks up
+# the auctions started by other workers and the batches whose settlement
+# failed. Settlement claims each auction with a guarded update, so workers
+# racing on the same auction settle it once.
+# While the database cannot be queried (not migrated yet, or unreachable), the
+# error is logged once and the scheduler retries less and less often, up to
+# every `horizon` seconds.
+
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional, Set, Tuple
+
+from sqlalchemy.exc import OperationalError
+
+import async_crud
+import metrics
+from core.config import settings
+from database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class AuctionScheduler:
+    """
+    :param session_factory: factory of the AsyncSession used to settle the auctions
+    :param batch_size: auctions settled per transaction
+    :param horizon: seconds ahead of now of the auctions kept in memory
+    """
+
+    def __init__(self, session_factory=None, batch_size: int = None, horizon: int = None):
+        self.session_factory = session_factory or AsyncSessionLocal
+        self.batch_size = batch_size or settings.AUCTION_BATCH_SIZE
+        self.horizon = horizon or settings.AUCTION_HORIZON
+        self._heap: List[Tuple[datetime, int]] = []
+        self._scheduled: Set[int] = set()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, auction_id: int, ends_at: datetime):
+        """
+        Adds an open auction to the heap, once; wakes the scheduler up if it ends first
+        :param auction_id: auction id
+        :param ends_at: end time, naive UTC
+        """
+        if auction_id in self._scheduled:
+            return
+        self._scheduled.add(auction_id)
+        heapq.heappush(self._heap, (ends_at, auction_id))
+        if self._wake is not None and self._heap[0][1] == auction_id:
+            self._wake.set()
+
+    def pop_due(self, now: datetime, limit: int) -> List[int]:
+        """
+        :return: up to `limit` auctions ended at `now`, the first ended first
+        """
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < limit:
+            _, auction_id = heapq.heappop(self._heap)
+            self._scheduled.discard(auction_id)
+            due.append(auction_id)
+        return due
+
+    def next_end(self) -> Optional[datetime]:
+        return self._heap[0][0] if self._heap else None
+
+    async def reload(self, now: datetime = None):
+        """
+        Schedules the open auctions ending within the horizon, already ended ones included
+        """
+        now = now or datetime.utcnow()
+        async with self.session_factory() as db:
+            rows = await async_crud.get_auctions_ending_before(db, now + timedelta(seconds=self.horizon))
+        for auction_id, ends_at in rows:
+            self.schedule(auction_id, ends_at)
+
+    async def settle_due(self, now: datetime = None) -> int:
+        """
+        Settles every scheduled auction ended at `now`, a batch per transaction
+        :return: number of auctions closed
+        """
+        now = now or datetime.utcnow()
+        settled = 0
+        while True:
+            batch = self.pop_due(now, self.batch_size)
+            if not batch:
+                return settled
+            async with self.session_factory() as db:
+                closed = await async_crud.settle_auctions(db, batch, now)
+            for status in closed.values():
+                metrics.AUCTIONS_SETTLED.inc(status)
+            settled += len(closed)
+
+    async def run(self):
+        """
+        Settles the auctions as they end, until cancelled
+        """
+        self._wake = asyncio.Event()
+        next_reload = datetime.utcnow()
+        backoff = 0
+        while True:
+            now = datetime.utcnow()
+            try:
+                if now >= next_reload:
+                    await self.reload(now)
+                    next_reload = now + timedelta(seconds=self.horizon / 2)
+                    if backoff:
+                        logger.info('auction settlement resumed')
+                        backoff = 0
+                await self.settle_due(now)
+            except OperationalError as error:
+                if not backoff:
+                    logger.error('auction settlement unavailable, retrying: %s', error.orig)
+                backoff = min(backoff * 2 or 1, self.horizon)
+                next_reload = now + timedelta(seconds=backoff)
+            except Exception:
+                # the popped auctions are still open: the next reload schedules them again
+                logger.exception('auction settlement failed')
+                next_reload = now + timedelta(seconds=1)
+            wake_at = min(filter(None, (self.next_end(), next_reload)))
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), max((wake_at - datetime.utcnow()).total_seconds(), 0))
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wake = None
+
+
+auction_scheduler = AuctionScheduler()
@@ -1,8 +1,18 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Optional
 from fastapi import Depends
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from passlib.context import CryptContext
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload
+from core.config import settings
 import exceptions
+import metrics
+import models
 
 SECRET_KEY = 'testing'
 ALGORITHM = 'HS256'
@@ -21,6 +31,71 @@ def verify_password(password, hashed_password):
     return bcrypt_context.verify(password, hashed_password)
 
 
+# bcrypt costs tens of milliseconds of CPU per call: the async routes hand it
+# to a worker pool, and refuse new work once too many jobs are waiting for it
+_hash_executor: Optional[Executor] = None
+_hash_executor_lock = threading.Lock()
+_hash_slots = threading.BoundedSemaphore(settings.PASSWORD_HASH_WORKERS + settings.PASSWORD_HASH_MAX_QUEUE)
+
+
+def get_hash_executor() -> Optional[Executor]:
+    """
+    Pool running the password hashing, created on first use according to settings
+    :return: the executor, None when hashing runs inline
+    """
+    global _hash_executor
+    if settings.PASSWORD_HASH_EXECUTOR == 'inline':
+        return None
+    with _hash_executor_lock:
+        if _hash_executor is None:
+            if settings.PASSWORD_HASH_EXECUTOR == 'process':
+                _hash_executor = ProcessPoolExecutor(max_workers=settings.PASSWORD_HASH_WORKERS)
+            else:
+                _hash_executor = ThreadPoolExecutor(
+                    max_workers=settings.PASSWORD_HASH_WORKERS,
+                    thread_name_prefix='bcrypt'
+                )
+    return _hash_executor
+
+
+def shutdown_hash_executor():
+    global _hash_executor
+    with _hash_executor_lock:
+        if _hash_executor is not None:
+            _hash_executor.shutdown(wait=False)
+            _hash_executor = None
+
+
+async def _run_hashing(fn, *args):
+    if not _hash_slots.acquire(blocking=False):
+        raise exceptions.server_busy()
+    start = time.perf_counter()
+    try:
+        executor = get_hash_executor()
+        if executor is None:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+    finally:
+        metrics.PASSWORD_HASH_TIME.observe(time.perf_counter() - start, fn.__name__)
+        _hash_slots.release()
+
+
+async def get_password_hash_async(password):
+    """
+    get_password_hash, computed on the hashing pool
+    :raise HTTPException: 503 when the hashing queue is full
+    """
+    return await _run_hashing(get_password_hash, password)
+
+
+async def verify_password_async(password, hashed_password):
+    """
+    verify_password, computed on the hashing pool
+    :raise HTTPException: 503 when the hashing queue is full
+    """
+    return await _run_hashing(verify_password, password, hashed_password)
+
+
 oauth2_bearer = OAuth2PasswordBearer(tokenUrl='token')
 
 
@@ -33,3 +108,48 @@ async def get_username_from_token(token: str = Depends(oauth2_bearer)):
     except JWTError:
         raise exceptions.token_exception()
     return username
+
+
+class CurrentIdentity:
+    """
+    Identity of the authenticated user, read from the JWT claims only: username,
+    user id and team id are known without querying the database. The routes needing
+    the rows call load (or load_async), which reads the team and the user at once.
+    Use as `identity: CurrentIdentity = Depends()`
+    """
+
+    def __init__(self, token: str = Depends(oauth2_bearer)):
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            raise exceptions.token_exception()
+        self.username: str = payload.get('sub')
+        self.user_id: int = payload.get('uid')
+        self.team_id: int = payload.get('tid')
+        # tokens issued before the ids were added to the claims are refused
+        if self.username is None or self.user_id is None or self.team_id is None:
+            raise exceptions.token_exception()
+        self.team: Optional[models.Team] = None
+
+    def load(self, db: Session) -> models.Team:
+        """
+        Loads the team of the user with its user row (team.user), in a single joined query,
+        once per request
+        :param db: session on the database of the user team
+        :raise HTTPException: token_exception when the team does not exist anymore
+        :return: the team
+        """
+        if self.team is None:
+            self.team = db.query(models.Team).options(joinedload(models.Team.user)) \
+                .filter(models.Team.id == self.team_id).first()
+            if self.team is None:
+                raise exceptions.token_exception()
+        return self.team
+
+    async def load_async(self, db: AsyncSession) -> models.Team:
+        """
+        load, on an async session
+        """
+        if self.team is None:
+            await db.run_sync(self.load)
+        return self.team
@@ -0,0 +1,88 @@
+"""
+Settlement throughput of the auction scheduler: `--auctions` auctions, one per
+player, all ending within the same minute, most of them with a bid from another
+team, are settled by `AuctionScheduler.settle_due` on a scratch sqlite database.
+Prints the settled auctions per second and the time to drain the minute, as json.
+
+    python -m benchmarks.auctions --auctions 30000 --batch-size 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from auctions import AuctionScheduler
+from database import async_database_url, create_async_database_engine, create_database_engine
+from seed_league import seed_league
+import models
+
+
+def seed_auctions(engine, auctions, teams, ends_at, rng):
+    rows = []
+    with engine.connect() as conn:
+        players = conn.execute(
+            models.Player.__table__.select().with_only_columns(models.Player.id, models.Player.team_id)
+            .order_by(models.Player.id).limit(auctions)
+        ).all()
+    for player_id, team_id in players:
+        bidder = rng.randint(1, teams - 1)
+        bidder += bidder >= team_id
+        with_bid = rng.random() < 0.9
+        rows.append({
+            'player_id': player_id, 'seller_team_id': team_id, 'reserve_price': 1000,
+            'ends_at': ends_at + timedelta(seconds=rng.random() * 60), 'status': 'open',
+            'best_bid': rng.randint(1, 20) * 1000 if with_bid else None,
+            'best_bidder_team_id': bidder if with_bid else None,
+        })
+    with engine.begin() as conn:
+        conn.execute(insert(models.Auction), rows)
+    return len(rows)
+
+
+async def settle(database_url, batch_size, now):
+    async_engine = create_async_database_engine(async_database_url(database_url))
+    session_local = sessionmaker(autoflush=False, expire_on_commit=False, class_=AsyncSession, bind=async_engine)
+    scheduler = AuctionScheduler(session_local, batch_size=batch_size, horizon=120)
+    start = time.perf_counter()
+    await scheduler.reload(now)
+    loaded = time.perf_counter()
+    settled = await scheduler.settle_due(now)
+    done = time.perf_counter()
+    await async_engine.dispose()
+    return {
+        'settled': settled, 'reload_seconds': round(loaded - start, 3), 'settle_seconds': round(done - loaded, 3),
+        'auctions_per_second': round(settled / (done - loaded)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--auctions', type=int, default=30000, help='auctions ending within the minute')
+    parser.add_argument('--batch-size', type=int, default=500, help='auctions settled per transaction')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'auctions.db')}"
+        engine = create_database_engine(url)
+        # 20 players per team
+        teams = max(2, -(-args.auctions // 20))
+        seed_league(engine, teams, seed=0)
+        ends_at = datetime.utcnow() - timedelta(seconds=60)
+        auctions = seed_auctions(engine, args.auctions, teams, ends_at, rng)
+        engine.dispose()
+        results = {'auctions': auctions, 'batch_size': args.batch_size}
+        results.update(asyncio.run(settle(url, args.batch_size, ends_at + timedelta(seconds=60))))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+helpers shared by the benchmarks
+"""
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from database import (
+    async_database_url, create_async_database_engine, create_database_engine, get_db, get_async_db
+)
+from main import app
+
+
+def percentiles(samples):
+    """
+    :param samples: durations in seconds
+    :return: count and p50/p95/p99 in milliseconds
+    """
+    if not samples:
+        return {}
+    samples = sorted(samples)
+
+    def pick(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 2)
+    return {'count': len(samples), 'p50_ms': pick(0.50), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99)}
+
+
+@asynccontextmanager
+async def app_client(database_url):
+    """
+    httpx client running the app in process, on the database at `database_url`
+    """
+    engine = create_database_engine(database_url)
+    session_local = sessionmaker(autoflush=False, bind=engine)
+    async_engine = create_async_database_engine(async_database_url(database_url))
+    async_session_local = sessionmaker(autoflush=False, expire_on_commit=False, class_=AsyncSession, bind=async_engine)
+
+    def override_get_db():
+        db = session_local()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    async def override_get_async_db():
+        async with async_session_local() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    try:
+        async with httpx.AsyncClient(app=app, base_url='http://bench', timeout=None) as client:
+            yield client
+    finally:
+        app.dependency_overrides.pop(get_db)
+        app.dependency_overrides.pop(get_async_db)
+        await async_engine.dispose()
+        engine.dispose()
+
+
+async def timed(samples, request):
+    """
+    awaits `request`, appending its duration to `samples`
+    """
+    start = time.perf_counter()
+    response = await request
+    samples.append(time.perf_counter() - start)
+    return response
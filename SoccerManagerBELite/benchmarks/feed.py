@@ -0,0 +1,117 @@
+"""
+Fan-out of the live market feed to many clients of one worker: a uvicorn worker
+is started on a scratch sqlite database, `--subscribers` Server-Sent Events
+connections are opened on `/market/feed`, then `--events` players are listed
+through `/market/sell`. For each listing, the delay until every subscriber got
+the `listed` event is measured; percentiles over all deliveries and the worker
+memory are printed as json.
+
+    python -m benchmarks.feed --subscribers 10000 --events 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.common import percentiles
+from database import create_database_engine
+import migrations
+
+
+async def subscribe(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f'GET /market/feed HTTP/1.1\r\nHost: {host}\r\nAccept: text/event-stream\r\n\r\n'.encode())
+    await writer.drain()
+    while b'event: snapshot' not in await reader.readuntil(b'\n\n'):
+        pass
+    return reader, writer
+
+
+async def wait_event(reader, name, sent_at, samples):
+    while name not in await reader.readuntil(b'\n\n'):
+        pass
+    samples.append(time.perf_counter() - sent_at[0])
+
+
+def worker_rss_mb(pid):
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return round(int(line.split()[1]) / 1024, 1)
+
+
+async def run(args, port, pid):
+    base = f'http://127.0.0.1:{port}'
+    async with httpx.AsyncClient(base_url=base, timeout=60) as client:
+        user = {'username': 'seller@example.com', 'password': 'password'}
+        await client.post('/auth/register', json=user)
+        token = (await client.post('/auth/login', data=user)).json()['token']
+        headers = {'Authorization': f'Bearer {token}'}
+
+        start = time.perf_counter()
+        connections = []
+        for offset in range(0, args.subscribers, args.connect_batch):
+            batch = min(args.connect_batch, args.subscribers - offset)
+            connections += await asyncio.gather(*(subscribe('127.0.0.1', port) for _ in range(batch)))
+        connected = time.perf_counter() - start
+
+        samples, sent_at = [], [0.0]
+        for n in range(args.events):
+            waits = [wait_event(reader, b'event: listed', sent_at, samples) for reader, _ in connections]
+            sent_at[0] = time.perf_counter()
+            response = await client.get(f'/market/sell?player_id={n % 20 + 1}&asking_price={1000 + n}',
+                                        headers=headers)
+            assert response.status_code == 200, response.text
+            await asyncio.gather(*waits)
+        rss = worker_rss_mb(pid)
+        for _, writer in connections:
+            writer.close()
+    return {
+        'subscribers': len(connections), 'events': args.events, 'connect_seconds': round(connected, 2),
+        'delivery': percentiles(samples), 'worker_rss_mb': rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscribers', type=int, default=10000)
+    parser.add_argument('--events', type=int, default=20)
+    parser.add_argument('--connect-batch', type=int, default=500, help='connections opened concurrently')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    # a socket per subscriber, in this process and in the worker
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'feed.db')}"
+        migrations.upgrade(create_database_engine(url))
+        env = dict(os.environ, DATABASE_URL=url, AUCTION_SCHEDULER='0', FEED_QUEUE_SIZE=str(args.events + 16))
+        worker = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(args.port), '--log-level', 'warning',
+             '--backlog', '4096'],
+            env=env
+        )
+        try:
+            for _ in range(100):
+                try:
+                    httpx.get(f'http://127.0.0.1:{args.port}/metrics')
+                    break
+                except httpx.TransportError:
+                    time.sleep(0.1)
+            results = asyncio.run(run(args, args.port, worker.pid))
+        finally:
+            worker.terminate()
+            worker.wait()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
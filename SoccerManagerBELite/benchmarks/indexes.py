@@ -0,0 +1,68 @@
+"""
+`/market/` and `/players/user` latency on a large league, without and then with
+the indexes created by `migrations.upgrade`.
+
+A scratch sqlite database is seeded with `--teams` teams (20 players each, so
+the default is 1M players) and `--listed` random players are put on the market.
+The indexes are dropped, both routes are timed, the migration is run, and both
+routes are timed again; percentiles are printed as json.
+
+    python -m benchmarks.indexes --teams 50000 --listed 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+
+from sqlalchemy import create_engine, inspect
+
+from benchmarks.common import app_client, percentiles, timed
+from seed_league import seed_league
+import migrations
+
+
+async def measure(database_path, requests):
+    async with app_client(f'sqlite:///{database_path}') as client:
+        response = await client.post('/auth/login', data={'username': 'manager1@example.com', 'password': 'password'})
+        headers = {'Authorization': f"Bearer {response.json()['token']}"}
+        market, players = [], []
+        for _ in range(requests):
+            response = await timed(market, client.get('/market/'))
+            assert response.status_code == 200, response.text
+            response = await timed(players, client.get('/players/user', headers=headers))
+            assert response.status_code == 200, response.text
+    return {'/market/': percentiles(market), '/players/user': percentiles(players)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--teams', type=int, default=50000)
+    parser.add_argument('--listed', type=int, default=2000, help='players on the market')
+    parser.add_argument('--requests', type=int, default=50, help='requests per route and phase')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'league.db')
+        engine = create_engine(f'sqlite:///{path}')
+        players = seed_league(engine, args.teams, seed=0)
+        listed = random.Random(0).sample(range(1, players + 1), args.listed)
+        with engine.begin() as conn:
+            conn.exec_driver_sql(
+                f"UPDATE players SET on_market = 1, requested_value = value WHERE id IN ({','.join(map(str, listed))})"
+            )
+            for index in inspect(conn).get_indexes('players'):
+                if index['name'] != 'ix_players_id':
+                    conn.exec_driver_sql(f"DROP INDEX {index['name']}")
+
+        results = {'players': players, 'listed': args.listed}
+        results['without_indexes'] = asyncio.run(measure(path, args.requests))
+        results['created_indexes'] = migrations.upgrade(engine)
+        results['with_indexes'] = asyncio.run(measure(path, args.requests))
+        engine.dispose()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""
+Load test of the API routes: register, login, market listing, sell, withdraw and buy.
+
+Seeds a database with `--users` users (each with its team and squad) and
+`--listed` players on the market, then runs one phase per route, `--requests`
+requests each, sent by `--concurrency` concurrent clients. Throughput and
+p50/p95/p99 latency of every route are printed as json (or written to `--output`),
+so that runs of different releases can be compared.
+
+By default the app runs in process (httpx ASGI transport) on a scratch sqlite
+database. To load a real server, seed a database and point the server at it:
+
+    python -m benchmarks.loadtest --database-url sqlite:///./load.db --seed-only
+    DATABASE_URL=sqlite:///./load.db uvicorn main:app --port 8000
+    python -m benchmarks.loadtest --database-url sqlite:///./load.db --skip-seed --url http://localhost:8000
+
+Sell, withdraw and buy are sent on behalf of the first `--concurrency` seeded users;
+the listed players belong to the other teams and are priced at `--price`, so that
+the buyers do not run out of budget.
+
+The seeded league is a single database (see seed_league): the load test does not
+run with SHARD_URLS set.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import tempfile
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+
+import httpx
+from sqlalchemy import select, update
+
+import authorizations
+from benchmarks.common import app_client, percentiles, timed
+from core.config import settings
+from database import create_database_engine
+from seed_league import seed_league
+import models
+
+ROUTES = ['register', 'login', 'market', 'sell', 'withdraw', 'buy']
+PREFIX = 'load'
+PASSWORD = 'password'
+
+
+def actor_teams_query(actors):
+    """
+    the teams of the first `actors` seeded users
+    """
+    return select(models.Team.id, models.User.username) \
+        .join(models.User, models.User.id == models.Team.user_id) \
+        .where(models.User.username.like(f'{PREFIX}%')) \
+        .order_by(models.Team.id).limit(actors)
+
+
+def seed(database_url, users, listed, price, actors, random_seed):
+    """
+    Seeds the league, and puts on the market `listed` players of the teams not used as actors
+    :return: number of players inserted
+    """
+    engine = create_database_engine(database_url)
+    players = seed_league(engine, users, seed=random_seed, prefix=PREFIX, password=PASSWORD)
+    with engine.begin() as conn:
+        actor_teams = actor_teams_query(actors).with_only_columns(models.Team.id).scalar_subquery()
+        listed_ids = select(models.Player.id).where(models.Player.team_id.not_in(actor_teams)) \
+            .order_by(models.Player.id).limit(listed).scalar_subquery()
+        conn.execute(
+            update(models.Player).where(models.Player.id.in_(listed_ids))
+            .values(on_market=True, requested_value=price)
+        )
+    engine.dispose()
+    return players
+
+
+def load_fixtures(database_url, actors):
+    """
+    Usernames and squads of the actors, and the players on the market owned by other teams
+    :return: list of (username, [player ids]), list of listed player ids
+    """
+    engine = create_database_engine(database_url)
+    with engine.connect() as conn:
+        teams = conn.execute(actor_teams_query(actors)).all()
+        squads = {team_id: [] for team_id, _ in teams}
+        for player_id, team_id in conn.execute(
+                select(models.Player.id, models.Player.team_id)
+                .where(models.Player.team_id.in_(squads), models.Player.on_market == False)  # noqa: E712
+                .order_by(models.Player.id)):
+            squads[team_id].append(player_id)
+        listed = conn.execute(
+            select(models.Player.id)
+            .where(models.Player.on_market == True, models.Player.team_id.not_in(squads))  # noqa: E712
+            .order_by(models.Player.id)
+        ).scalars().all()
+    engine.dispose()
+    return [(username, squads[team_id]) for team_id, username in teams], listed
+
+
+def round_robin(lists):
+    """
+    Interleaves the lists: first item of each list, then the second ones, ...
+    """
+    return [item for items in itertools.zip_longest(*lists) for item in items if item is not None]
+
+
+async def run_phase(client, requests, concurrency):
+    """
+    Sends `requests` (callables returning an awaitable response) from `concurrency` clients
+    :return: latency percentiles, throughput and status codes of the phase
+    """
+    samples, statuses = [], Counter()
+    jobs = iter(requests)
+
+    async def worker():
+        for request in jobs:
+            response = await timed(samples, request(client))
+            statuses[response.status_code] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    ok = sum(count for status, count in statuses.items() if status < 400)
+    report = {
+        'requests': len(requests), 'ok': ok, 'errors': len(requests) - ok,
+        'status': {str(status): count for status, count in sorted(statuses.items())},
+        'duration_s': round(elapsed, 3),
+        'throughput_rps': round(len(requests) / elapsed, 1) if elapsed else None,
+        **percentiles(samples),
+    }
+    return report
+
+
+async def run(client, actors, listed, routes, requests, concurrency, price, run_id):
+    """
+    Runs the phases of `routes`, in the order of ROUTES
+    :param client: httpx client, in process or on a server
+    :param actors: list of (username, [player ids]) of the users selling and buying
+    :param listed: ids of players on the market, owned by other teams
+    :param price: asking price of the players put on sale
+    :return: report of each route
+    """
+    tokens = []
+    for username, _ in actors:
+        response = await client.post('/auth/login', data={'username': username, 'password': PASSWORD})
+        response.raise_for_status()
+        tokens.append({'Authorization': f"Bearer {response.json()['token']}"})
+
+    phases = {
+        'register': [
+            lambda c, n=n: c.post('/auth/register', json={
+                'username': f'{PREFIX}-{run_id}-{n}@example.com', 'password': PASSWORD
+            })
+            for n in range(requests)
+        ],
+        'login': [
+            lambda c, username=username: c.post('/auth/login', data={'username': username, 'password': PASSWORD})
+            for username, _ in itertools.islice(itertools.cycle(actors), requests)
+        ],
+        'market': [lambda c: c.get('/market/')] * requests,
+    }
+    sales = round_robin([[(headers, player_id) for player_id in squad]
+                         for headers, (_, squad) in zip(tokens, actors)])[:requests]
+    phases['sell'] = [
+        lambda c, headers=headers, player_id=player_id: c.get(
+            '/market/sell', params={'player_id': player_id, 'asking_price': price}, headers=headers
+        )
+        for headers, player_id in sales
+    ]
+    phases['withdraw'] = [
+        lambda c, headers=headers, player_id=player_id: c.get(
+            '/market/withdraw', params={'player_id': player_id}, headers=headers
+        )
+        for headers, player_id in sales
+    ]
+    phases['buy'] = [
+        lambda c, headers=headers, player_id=player_id: c.get(
+            '/market/buy', params={'player_id': player_id}, headers=headers
+        )
+        for headers, player_id in zip(itertools.cycle(tokens), listed[:requests])
+    ]
+
+    results = {}
+    for route in ROUTES:
+        if route in routes:
+            results[route] = await run_phase(client, phases[route], concurrency)
+    return results
+
+
+@asynccontextmanager
+async def server_client(url, concurrency):
+    """
+    httpx client sending the requests to the server at `url`
+    """
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=None, limits=limits) as client:
+        yield client
+
+
+async def load(args, database_url):
+    actors, listed = load_fixtures(database_url, args.concurrency)
+    client = server_client(args.url, args.concurrency) if args.url else app_client(database_url)
+    async with client as client:
+        return await run(client, actors, listed, args.routes, args.requests, args.concurrency, args.price,
+                         int(time.time()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000, help='seeded users/teams')
+    parser.add_argument('--listed', type=int, default=1000, help='seeded players on the market')
+    parser.add_argument('--price', type=int, default=1000, help='asking price of the listed and sold players')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients, and acting users')
+    parser.add_argument('--routes', nargs='+', default=ROUTES, choices=ROUTES)
+    parser.add_argument('--seed', type=int, default=0, help='generator seed')
+    parser.add_argument('--database-url', help='database to seed and load, a scratch sqlite file by default')
+    parser.add_argument('--url', help='base url of a running server, the app runs in process when not set')
+    parser.add_argument('--seed-only', action='store_true', help='seed the database and exit')
+    parser.add_argument('--skip-seed', action='store_true', help='reuse a database seeded by a previous run')
+    parser.add_argument('--output', help='json report file, printed when not set')
+    args = parser.parse_args()
+    if (args.url or args.seed_only or args.skip_seed) and not args.database_url:
+        parser.error('--url, --seed-only and --skip-seed need --database-url')
+    if settings.SHARD_URLS:
+        parser.error('the load test seeds a single database, unset SHARD_URLS')
+
+    report = {'config': {key: value for key, value in vars(args).items() if key not in ('output', 'seed_only')}}
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = args.database_url or f"sqlite:///{os.path.join(tmp, 'load.db')}"
+        if not args.skip_seed:
+            start = time.perf_counter()
+            report['players'] = seed(database_url, args.users, args.listed, args.price, args.concurrency, args.seed)
+            report['seed_s'] = round(time.perf_counter() - start, 1)
+        if not args.seed_only:
+            report['routes'] = asyncio.run(load(args, database_url))
+            authorizations.shutdown_hash_executor()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Latency of the market listing while the server is hit by a login storm.
+
+Runs the app in process (httpx ASGI transport, one event loop, as a single
+uvicorn worker would) against a scratch database: `--logins` clients keep
+logging in while `--pollers` clients keep reading `/market/`, and the latency
+percentiles of both are printed as json, once per hashing executor.
+
+    python -m benchmarks.login_market --executor inline thread --duration 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+import authorizations
+from core.config import settings
+from database import Base
+from benchmarks.common import app_client, percentiles, timed
+
+
+async def worker(client, request, samples, stop_at):
+    while time.perf_counter() < stop_at:
+        response = await timed(samples, request(client))
+        assert response.status_code in (200, 503), response.text
+
+
+async def run(executor, logins, pollers, duration, database_path):
+    settings.PASSWORD_HASH_EXECUTOR = executor
+    authorizations.shutdown_hash_executor()
+
+    user = {'username': 'bench@example.com', 'password': 'password'}
+    login_samples, market_samples = [], []
+    async with app_client(f'sqlite:///{database_path}') as client:
+        await client.post('/auth/register', json=user)
+        stop_at = time.perf_counter() + duration
+        await asyncio.gather(
+            *[worker(client, lambda c: c.post('/auth/login', data=user), login_samples, stop_at)
+              for _ in range(logins)],
+            *[worker(client, lambda c: c.get('/market/'), market_samples, stop_at)
+              for _ in range(pollers)],
+        )
+    return {'executor': executor, 'login': percentiles(login_samples), 'market': percentiles(market_samples)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--executor', nargs='+', default=['inline', 'thread'],
+                        choices=['inline', 'thread', 'process'])
+    parser.add_argument('--logins', type=int, default=16, help='concurrent login clients')
+    parser.add_argument('--pollers', type=int, default=16, help='concurrent market clients')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per executor')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for executor in args.executor:
+            path = os.path.join(tmp, f'{executor}.db')
+            Base.metadata.create_all(bind=create_engine(f'sqlite:///{path}'))
+            results.append(asyncio.run(run(executor, args.logins, args.pollers, args.duration, path)))
+    authorizations.shutdown_hash_executor()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Throughput of the in memory order book: a random stream of order updates
+(new bids, cancelled bids, listings, price changes, withdrawals) with a crossing
+lookup after each of them, as the matching engine does, printed as json.
+
+    python -m benchmarks.orderbook --orders 200000 --players 50000
+"""
+import argparse
+import json
+import random
+import time
+
+from orderbook import BookAsk, BookBid, OrderBook
+from params import Role
+
+ROLES = [role.value for role in Role]
+COUNTRIES = ['Italy', 'France', 'Spain', 'Germany', 'Brazil']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=200000, help='order updates')
+    parser.add_argument('--players', type=int, default=50000)
+    parser.add_argument('--teams', type=int, default=2500)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    players = [
+        (player_id, rng.randint(1, args.teams), rng.choice(ROLES), rng.randint(18, 40), rng.choice(COUNTRIES))
+        for player_id in range(1, args.players + 1)
+    ]
+    book = OrderBook()
+    book.load([], [])
+    crossings, next_bid = 0, 1
+    start = time.perf_counter()
+    for _ in range(args.orders):
+        action = rng.random()
+        if action < 0.4:
+            # bids below the asks most of the time, so that the book fills up
+            price = rng.randint(500, 1100) * 1000
+            if rng.random() < 0.5:
+                bid = BookBid(next_bid, rng.randint(1, args.teams), price, player_id=rng.randint(1, args.players))
+            else:
+                bid = BookBid(next_bid, rng.randint(1, args.teams), price, role=rng.choice(ROLES),
+                              max_age=rng.choice([None, 25, 30]), country=rng.choice([None] + COUNTRIES))
+            book.add_bid(bid)
+            next_bid += 1
+            crossing = book.take_crossing(bid_id=bid.id)
+        elif action < 0.5:
+            book.remove_bid(rng.randint(1, next_bid))
+            crossing = None
+        elif action < 0.9:
+            player_id, team_id, role, age, country = rng.choice(players)
+            price = rng.randint(1000, 2000) * 1000
+            book.update_asks([(player_id, BookAsk(player_id, team_id, price, role, age, country))])
+            crossing = book.take_crossing(player_id=player_id)
+        else:
+            book.update_asks([(rng.randint(1, args.players), None)])
+            crossing = None
+        # a trade fills both orders
+        crossings += crossing is not None
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        'orders': args.orders, 'crossings': crossings, 'seconds': round(elapsed, 3),
+        'orders_per_second': round(args.orders / elapsed), 'bids': len(book.bids), 'asks': len(book.asks),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Cost of serializing a list of players: ORM objects validated through
+`schemas.DBPlayer.from_orm` and encoded like FastAPI does, against plain column
+rows encoded by `serializers.encode_players`.
+
+    python -m benchmarks.serialization --players 10000 --repeat 20
+"""
+import argparse
+import json
+import time
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+import crud
+import schemas
+import serializers
+from database import Base
+from generator import SquadGenerator
+import models
+
+
+def orm_path(db):
+    players = [schemas.DBPlayer.from_orm(player) for player in crud.get_players_on_market(db)]
+    return json.dumps(jsonable_encoder(players), separators=(',', ':')).encode()
+
+
+def rows_path(db):
+    return serializers.encode_players(crud.get_market_rows(db))
+
+
+def best_of(fn, engine, repeat):
+    timings = []
+    for _ in range(repeat):
+        with Session(engine) as db:
+            start = time.perf_counter()
+            body = fn(db)
+            timings.append(time.perf_counter() - start)
+    return min(timings), body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--players', type=int, default=10000, help='players on the market')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    generator = SquadGenerator(seed=0)
+    players = []
+    while len(players) < args.players:
+        players.extend(generator.squad(team_id=len(players) // 20 + 1))
+    for player in players:
+        player.update(on_market=True, requested_value=player['value'])
+    with engine.begin() as conn:
+        conn.execute(insert(models.Player), players[:args.players])
+
+    orm_time, orm_body = best_of(orm_path, engine, args.repeat)
+    rows_time, rows_body = best_of(rows_path, engine, args.repeat)
+    assert json.loads(orm_body) == json.loads(rows_body)
+    print(json.dumps({
+        'players': args.players,
+        'encoder': 'orjson' if serializers.orjson else 'json',
+        'orm_from_orm_ms': round(orm_time * 1000, 2),
+        'rows_encoder_ms': round(rows_time * 1000, 2),
+        'speedup': round(orm_time / rows_time, 1),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
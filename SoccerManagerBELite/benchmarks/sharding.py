@@ -0,0 +1,113 @@
+"""
+Write throughput against the number of shards: `--teams` teams are spread over
+1, 2, 4... sqlite shard files by sharding.jump_hash, then `--writers` processes
+list and withdraw players of their teams (one committed transaction each, through
+crud.put_player_for_sale and crud.remove_player_for_sale) for `--seconds`.
+Writers of teams on different shards do not share a write lock. Prints the writes
+per second and the speedup over one shard for each shard count, as json.
+
+    python -m benchmarks.sharding --shards 1 2 4 --writers 8 --synchronous FULL
+
+With `--synchronous FULL` every commit waits for an fsync, as a durable
+configuration would: shards then overlap their disk waits. With the default
+NORMAL journal, commits are CPU bound and can only scale with free cores.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+from sqlalchemy import event
+
+from sharding import ShardSet
+import crud
+import models
+
+
+def open_shards(urls, synchronous):
+    shard_set = ShardSet(urls)
+
+    def set_synchronous(dbapi_connection, connection_record):
+        dbapi_connection.execute(f'PRAGMA synchronous={synchronous}')
+
+    for engine in shard_set.engines:
+        event.listen(engine, 'connect', set_synchronous)
+    return shard_set
+
+
+def write(urls, synchronous, team_ids, seconds, start, counter):
+    shard_set = open_shards(urls, synchronous)
+    sessions = [shard_set.sessions[shard_set.shard_of(team_id)]() for team_id in team_ids]
+    players = [
+        db.query(models.Player).filter(models.Player.team_id == team_id).first()
+        for db, team_id in zip(sessions, team_ids)
+    ]
+    start.wait()
+    writes, n = 0, 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        db, player = sessions[n % len(sessions)], players[n % len(players)]
+        if player.on_market:
+            crud.remove_player_for_sale(db, player)
+        else:
+            crud.put_player_for_sale(db, player, 1000 + n)
+        writes += 1
+        n += 1
+    with counter.get_lock():
+        counter.value += writes
+
+
+def run(shards, args, tmp):
+    urls = [f"sqlite:///{os.path.join(tmp, f'shards{shards}-{n}.db')}" for n in range(shards)]
+    shard_set = open_shards(urls, args.synchronous)
+    shard_set.upgrade()
+    for team_id in range(1, args.teams + 1):
+        with shard_set.sessions[shard_set.shard_of(team_id)]() as db:
+            crud.register_team(db, team_id, f'user{team_id}@example.com', [team_id * 32 + n for n in range(1, 21)])
+    for engine in shard_set.engines:
+        engine.dispose()
+
+    team_ids = list(range(1, args.teams + 1))
+    start, counter = multiprocessing.Event(), multiprocessing.Value('l', 0)
+    writers = [
+        multiprocessing.Process(target=write, args=(
+            urls, args.synchronous, team_ids[n::args.writers], args.seconds, start, counter
+        ))
+        for n in range(args.writers)
+    ]
+    for writer in writers:
+        writer.start()
+    time.sleep(1)
+    start.set()
+    for writer in writers:
+        writer.join()
+    return round(counter.value / args.seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--teams', type=int, default=64)
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--synchronous', choices=['OFF', 'NORMAL', 'FULL'], default='NORMAL')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for shards in args.shards:
+            writes = run(shards, args, tmp)
+            results.append({
+                'shards': shards, 'writes_per_second': writes,
+                'speedup': round(writes / results[0]['writes_per_second'], 2) if results else 1.0,
+            })
+    print(json.dumps({
+        'teams': args.teams, 'writers': args.writers, 'synchronous': args.synchronous, 'cpus': os.cpu_count(),
+        'results': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
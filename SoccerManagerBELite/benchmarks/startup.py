@@ -0,0 +1,87 @@
+"""
+Cold start of a worker: each run is a fresh interpreter that imports the app,
+answers a first request in process and draws a first squad from the generator.
+The time of each step, `ready` (import and first response) and the wall time of
+the whole process (interpreter start and exit included) are reported as
+percentiles (json), for the generator with and without its compiled pools cache.
+
+    python -m benchmarks.startup --runs 10 --budget 1.0
+
+With `--budget`, exits with status 1 when `ready` exceeds the budget in seconds at p95.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import percentiles
+
+# run in the child interpreter, prints the duration of each step
+CHILD = '''
+import asyncio, json, time
+import httpx
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+async def first_request():
+    async with httpx.AsyncClient(app=main.app, base_url='http://bench') as client:
+        response = await client.get('/metrics')
+        assert response.status_code == 200
+
+asyncio.run(first_request())
+responded = time.perf_counter()
+import generator
+generator.get_generator().squad(team_id=1)
+generated = time.perf_counter()
+print(json.dumps({
+    'import': imported - start, 'first_response': responded - imported, 'first_squad': generated - responded
+}))
+'''
+
+
+def run_child(env):
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', CHILD], env=env, check=True, capture_output=True, text=True)
+    steps = json.loads(output.stdout.splitlines()[-1])
+    steps['process'] = time.perf_counter() - start
+    return steps
+
+
+def measure(runs, env):
+    samples = {}
+    for _ in range(runs):
+        steps = run_child(env)
+        # imports and first request: the time a worker spends before it can serve
+        steps['ready'] = steps['import'] + steps['first_response']
+        for step, seconds in steps.items():
+            samples.setdefault(step, []).append(seconds)
+    return {step: percentiles(values) for step, values in samples.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='interpreters started per configuration')
+    parser.add_argument('--budget', type=float, help='maximum p95 seconds until ready to serve')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        base = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'startup.db')}")
+        cache = os.path.join(tmp, 'pools.pickle')
+        results['without_pools_cache'] = measure(args.runs, dict(base, GENERATOR_CACHE=''))
+        run_child(dict(base, GENERATOR_CACHE=cache))
+        results['with_pools_cache'] = measure(args.runs, dict(base, GENERATOR_CACHE=cache))
+    print(json.dumps(results, indent=2))
+    if args.budget is not None:
+        slowest = max(result['ready']['p95_ms'] for result in results.values()) / 1000
+        if slowest > args.budget:
+            print(f'ready in {slowest:.3f}s at p95, over the budget of {args.budget}s', file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,456 @@
+# server side cache of the hot reads, shared by the workers
+#
+# Responses are kept already serialized, keyed by their query string, in a
+# pluggable backend: an in-process LRU (`memory://`, one worker), a SQLite file
+# shared by the workers of a host (`sqlite:///path`, on /dev/shm for a shared
+# memory store) or a Redis server (`redis://host:port/db`; `fakeredis://` is an
+# in-process stand-in implementing the same commands).
+#
+# Every entry depends on a topic: `market` for the listing, `team:<id>` for the
+# details and roster of a team. The backend keeps a version per topic, and the
+# entries are stored under the version read before querying the database.
+# The data behind a topic only changes through the mutations in `crud`, which
+# publish the topics they changed on the `invalidation_bus` once committed: the
+# versions are bumped in the backend, so every worker misses the old entries on
+# its next read, and a page computed from data older than the bump is stored
+# under a version nobody reads anymore. The old entries are evicted by the
+# backend (LRU, FIFO or TTL).
+#
+# The SQLite and Redis backends do blocking I/O. The async routes go through
+# the *_async methods of PageCache, which run them in the thread pool, and the
+# topics published by crud inside AsyncSession.run_sync are held by
+# InvalidationBus.defer, then bumped off the event loop by async_crud.
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence
+from urllib.parse import urlsplit
+
+from starlette.concurrency import run_in_threadpool
+
+import serializers
+from core.config import settings
+
+MARKET = 'market'
+# standing bids, published along with MARKET to keep the order books of the workers current
+ORDERS = 'orders'
+
+
+def team_topic(team_id: int) -> str:
+    return f'team:{team_id}'
+
+
+class CachedPage(NamedTuple):
+    body: bytes
+    etag: str
+    headers: Dict[str, str]
+
+    def encode(self) -> bytes:
+        return serializers.dumps([self.etag, self.headers]) + b'\n' + self.body
+
+    @classmethod
+    def decode(cls, value: bytes) -> 'CachedPage':
+        meta, body = value.split(b'\n', 1)
+        etag, headers = json.loads(meta)
+        return cls(body, etag, headers)
+
+
+class CacheBackend(ABC):
+    """
+    Storage of the entries and of the topic versions
+    """
+    name = ''
+    # the methods wait on I/O: kept off the event loop
+    blocking = True
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: bytes):
+        ...
+
+    @abstractmethod
+    def versions(self, topics: Sequence[str]) -> List[int]:
+        """
+        :return: current version of each topic, 0 for the ones never bumped
+        """
+
+    @abstractmethod
+    def bump(self, topics: Iterable[str]):
+        ...
+
+    @abstractmethod
+    def size(self) -> int:
+        ...
+
+    @abstractmethod
+    def clear(self):
+        """
+        Drops every entry; versions are kept, they never go back
+        """
+
+
+class MemoryBackend(CacheBackend):
+    """
+    In-process LRU, for a single worker
+    """
+    name = 'memory'
+    blocking = False
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def versions(self, topics: Sequence[str]) -> List[int]:
+        with self._lock:
+            return [self._versions.get(topic, 0) for topic in topics]
+
+    def bump(self, topics: Iterable[str]):
+        with self._lock:
+            for topic in topics:
+                self._versions[topic] = self._versions.get(topic, 0) + 1
+
+    def size(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    SQLite file shared by the workers of a host, in WAL mode so that readers never wait.
+    Entries are evicted first in, first out beyond `max_entries`
+    """
+    name = 'sqlite'
+
+    def __init__(self, path: str, max_entries: int = 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._sets = 0
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_versions '
+                         '(topic TEXT PRIMARY KEY, version INTEGER NOT NULL) WITHOUT ROWID')
+
+    def _connection(self) -> sqlite3.Connection:
+        # one connection per thread: the sync routes run in a thread pool
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self._connection().execute('SELECT value FROM cache_entries WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: bytes):
+        conn = self._connection()
+        # a replaced entry gets a new rowid: rowids follow the insertion order
+        conn.execute('INSERT OR REPLACE INTO cache_entries (key, value) VALUES (?, ?)', (key, value))
+        self._sets += 1
+        if self._sets % 64 == 0:
+            conn.execute('DELETE FROM cache_entries WHERE rowid <= (SELECT max(rowid) FROM cache_entries) - ?',
+                         (self.max_entries,))
+
+    def versions(self, topics: Sequence[str]) -> List[int]:
+        rows = dict(self._connection().execute(
+            f'SELECT topic, version FROM cache_versions WHERE topic IN ({",".join("?" * len(topics))})', topics
+        ).fetchall())
+        return [rows.get(topic, 0) for topic in topics]
+
+    def bump(self, topics: Iterable[str]):
+        self._connection().executemany(
+            'INSERT INTO cache_versions (topic, version) VALUES (?, 1) '
+            'ON CONFLICT (topic) DO UPDATE SET version = version + 1',
+            [(topic,) for topic in topics]
+        )
+
+    def size(self) -> int:
+        return self._connection().execute('SELECT count(*) FROM cache_entries').fetchone()[0]
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache_entries')
+
+
+class RedisBackend(CacheBackend):
+    """
+    Redis server, through a `redis.Redis` client or any object with the same commands.
+    Entries expire after `ttl` seconds; the server eviction policy bounds the memory
+    """
+    name = 'redis'
+
+    def __init__(self, client, ttl: int = 300, prefix: str = 'soccermanager:'):
+        self.client = client
+        self.ttl = ttl
+        self.entry_prefix = f'{prefix}cache:'
+        self.version_prefix = f'{prefix}version:'
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(self.entry_prefix + key)
+
+    def set(self, key: str, value: bytes):
+        self.client.set(self.entry_prefix + key, value, ex=self.ttl)
+
+    def versions(self, topics: Sequence[str]) -> List[int]:
+        return [int(version or 0) for version in self.client.mget([self.version_prefix + topic for topic in topics])]
+
+    def bump(self, topics: Iterable[str]):
+        for topic in topics:
+            self.client.incr(self.version_prefix + topic)
+
+    def size(self) -> int:
+        return sum(1 for _ in self.client.scan_iter(f'{self.entry_prefix}*'))
+
+    def clear(self):
+        for key in list(self.client.scan_iter(f'{self.entry_prefix}*')):
+            self.client.delete(key)
+
+
+class FakeRedis:
+    """
+    In-process stand-in of a Redis server, with the commands used by RedisBackend
+    """
+
+    def __init__(self):
+        self._values: Dict[str, bytes] = {}
+        self._expires: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key: str) -> Optional[bytes]:
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self._values.pop(key, None)
+            del self._expires[key]
+        return self._values.get(key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._live(key)
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        with self._lock:
+            return [self._live(key) for key in keys]
+
+    def set(self, key: str, value: bytes, ex: int = None):
+        with self._lock:
+            self._values[key] = value
+            if ex:
+                self._expires[key] = time.monotonic() + ex
+            else:
+                self._expires.pop(key, None)
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            value = int(self._live(key) or 0) + 1
+            self._values[key] = str(value).encode()
+            return value
+
+    def delete(self, *keys: str) -> int:
+        with self._lock:
+            deleted = 0
+            for key in keys:
+                deleted += self._values.pop(key, None) is not None
+                self._expires.pop(key, None)
+            return deleted
+
+    def scan_iter(self, match: str):
+        prefix = match.rstrip('*')
+        with self._lock:
+            # _live drops the expired keys: iterate over a copy
+            keys = [key for key in list(self._values) if key.startswith(prefix) and self._live(key) is not None]
+        return iter(keys)
+
+
+def create_backend(url: str = None) -> CacheBackend:
+    """
+    :param url: `memory://`, `sqlite:///path`, `redis://host:port/db` or `fakeredis://`
+    :return: the backend at `url`, settings.CACHE_URL by default
+    """
+    url = url or settings.CACHE_URL
+    scheme = urlsplit(url).scheme
+    if scheme == 'memory':
+        return MemoryBackend(settings.CACHE_MAX_ENTRIES)
+    if scheme == 'sqlite':
+        return SQLiteBackend(url[len('sqlite:///'):], settings.CACHE_MAX_ENTRIES)
+    if scheme == 'fakeredis':
+        return RedisBackend(FakeRedis(), settings.CACHE_TTL)
+    if scheme in ('redis', 'rediss'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('the redis cache backend needs the `redis` package')
+        return RedisBackend(redis.Redis.from_url(url), settings.CACHE_TTL)
+    raise ValueError(f'unsupported cache url: {url}')
+
+
+class InvalidationBus:
+    """
+    Carries the topics changed by the committed mutations: their versions are bumped
+    in the shared backend, then the in-process listeners are called
+    """
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self._listeners: List[Callable[[Sequence[str]], None]] = []
+        self._deferred: ContextVar[Optional[List[str]]] = ContextVar('deferred_topics', default=None)
+
+    def subscribe(self, listener: Callable[[Sequence[str]], None]):
+        self._listeners.append(listener)
+
+    def publish(self, *topics: str):
+        deferred = self._deferred.get()
+        if deferred is not None:
+            deferred.extend(topics)
+            return
+        topics = list(dict.fromkeys(topics))
+        self.backend.bump(topics)
+        for listener in self._listeners:
+            listener(topics)
+
+    @contextmanager
+    def defer(self):
+        """
+        Holds the topics published in the block (and in the AsyncSession.run_sync called from it),
+        for publish_async to bump them after the block
+        :return: the list of the held topics
+        """
+        token = self._deferred.set([])
+        try:
+            yield self._deferred.get()
+        finally:
+            self._deferred.reset(token)
+
+    async def versions_async(self, topics: Sequence[str]) -> List[int]:
+        """
+        backend.versions, in the thread pool when the backend blocks
+        """
+        if self.backend.blocking:
+            return await run_in_threadpool(self.backend.versions, topics)
+        return self.backend.versions(topics)
+
+    async def publish_async(self, *topics: str):
+        """
+        publish, the versions being bumped in the thread pool when the backend blocks
+        """
+        if not topics:
+            return
+        if self.backend.blocking:
+            await run_in_threadpool(self.publish, *topics)
+        else:
+            self.publish(*topics)
+
+
+class PageCache:
+    """
+    Serialized responses, stored under the version of their topic
+    :param namespace: prefix of the keys
+    :param topic: topic of the entries when none is given
+    """
+
+    def __init__(self, namespace: str, bus: InvalidationBus, topic: str = None):
+        self.namespace = namespace
+        self.bus = bus
+        self.topic = topic or namespace
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def backend(self) -> CacheBackend:
+        return self.bus.backend
+
+    @property
+    def version(self) -> int:
+        return self.version_of(self.topic)
+
+    def version_of(self, topic: str) -> int:
+        return self.backend.versions([topic])[0]
+
+    def _key(self, key: str, topic: str, version: int) -> str:
+        return f'{self.namespace}:{topic}:{version}:{key}'
+
+    def get(self, key: str, topic: str = None) -> Optional[CachedPage]:
+        topic = topic or self.topic
+        value = self.backend.get(self._key(key, topic, self.version_of(topic)))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return CachedPage.decode(value)
+
+    def put(self, key: str, version: int, body: bytes, headers: Dict[str, str] = None,
+            topic: str = None) -> CachedPage:
+        """
+        Stores a serialized page
+        :param key: page key, from the request query
+        :param version: version of the topic read before querying the database
+        :param body: serialized page
+        :param headers: extra response headers of the page
+        :param topic: topic of the page, the cache topic by default
+        :return: the page; stored under `version`, it is never read once the topic changed
+        """
+        page = CachedPage(body, f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"', headers or {})
+        self.backend.set(self._key(key, topic or self.topic, version), page.encode())
+        return page
+
+    async def _call(self, method: Callable, *args, **kwargs):
+        if self.backend.blocking:
+            return await run_in_threadpool(method, *args, **kwargs)
+        return method(*args, **kwargs)
+
+    async def version_async(self) -> int:
+        return await self._call(self.version_of, self.topic)
+
+    async def get_async(self, key: str, topic: str = None) -> Optional[CachedPage]:
+        return await self._call(self.get, key, topic)
+
+    async def put_async(self, key: str, version: int, body: bytes, headers: Dict[str, str] = None,
+                        topic: str = None) -> CachedPage:
+        return await self._call(self.put, key, version, body, headers, topic)
+
+    async def stats_async(self) -> Dict:
+        return await self._call(self.stats)
+
+    def invalidate(self, topic: str = None):
+        self.bus.publish(topic or self.topic)
+
+    def stats(self) -> Dict:
+        return {
+            'hits': self.hits, 'misses': self.misses, 'pages': self.backend.size(), 'version': self.version,
+            'backend': self.backend.name,
+        }
+
+
+invalidation_bus = InvalidationBus(create_backend())
+market_cache = PageCache('market', invalidation_bus, MARKET)
+team_cache = PageCache('team', invalidation_bus)
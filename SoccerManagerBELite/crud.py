@@ -4,9 +4,22 @@ from sqlalchemy.orm import Session
 import models
 import schemas
 import utils
+import exceptions
+from cache import MARKET, ORDERS, invalidation_bus, team_topic
+from feed import market_feed
+from core.config import settings
+from orderbook import BookAsk, BookBid, OrderBook, order_book
+from generator import get_generator
 from authorizations import get_password_hash, verify_password
-from typing import List
-from sqlalchemy import func
+from datetime import datetime, timedelta
+from uuid import uuid4
+from typing import Dict, List, Optional, Set, Tuple
+from fastapi import HTTPException
+from sqlalchemy import String, bindparam, cast, func, insert, or_, select, true, tuple_, union_all, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import Select
+from sqlalchemy.engine import Result, Row
 
 
 def get_user_by_id(db: Session, user_id: int) -> models.User:
@@ -17,6 +30,17 @@ def get_user_by_username(db: Session, username: str) -> models.User:
     return db.query(models.User).filter(models.User.username == username).first()
 
 
+def get_user_and_team(db: Session, username: str) -> Tuple[models.User, models.Team]:
+    """
+    User and its team, loaded with a single joined query
+    :return: (user, team), (None, None) if the user does not exist
+    """
+    row = db.query(models.User, models.Team) \
+        .outerjoin(models.Team, models.Team.user_id == models.User.id) \
+        .filter(models.User.username == username).first()
+    return row if row else (None, None)
+
+
 def get_team_by_user_id(db: Session, user_id: int) -> models.Team:
     return db.query(models.Team).filter(models.Team.user_id == user_id).first()
 
@@ -33,47 +57,194 @@ def get_player_by_player_id(db: Session, player_id: int) -> models.Player:
     return db.query(models.Player).filter(models.Player.id == player_id).first()
 
 
-def get_players_on_market(db: Session) -> List[models.Player]:
-    return db.query(models.Player).where(models.Player.on_market).all()
+def _filter_market(query, filters: schemas.MarketFilter = None):
+    # same predicate as the ix_players_market partial indexes
+    query = query.where(models.Player.on_market == true())
+    if filters:
+        if filters.role:
+            query = query.where(models.Player.role == filters.role.value)
+        if filters.country:
+            query = query.where(models.Player.country == filters.country)
+        if filters.min_age is not None:
+            query = query.where(models.Player.age >= filters.min_age)
+        if filters.max_age is not None:
+            query = query.where(models.Player.age <= filters.max_age)
+        if filters.min_price is not None:
+            query = query.where(models.Player.requested_value >= filters.min_price)
+        if filters.max_price is not None:
+            query = query.where(models.Player.requested_value <= filters.max_price)
+    return query
+
+
+# sort keys of the market listing, each backed by a partial index together with the id
+MARKET_SORT_COLUMNS = {
+    'id': models.Player.id,
+    'price': models.Player.requested_value,
+    'value': models.Player.value,
+}
+
+# columns of the players responses (schemas.DBPlayer) and exports, with the API types
+PLAYER_COLUMNS = (
+    models.Player.id, models.Player.name, models.Player.surname, models.Player.country,
+    models.Player.role, models.Player.age, models.Player.value,
+    cast(models.Player.team_id, String).label('team_id'),
+)
+MARKET_COLUMNS = PLAYER_COLUMNS + (models.Player.requested_value,)
+
+
+def _market_page(query, filters: schemas.MarketFilter, sort: str, order: str, after: Tuple, limit: int):
+    query = _filter_market(query, filters)
+    key = MARKET_SORT_COLUMNS[sort]
+    columns = (models.Player.id,) if key is models.Player.id else (key, models.Player.id)
+    if after is not None:
+        position = tuple_(*columns)
+        last = after[1:] if len(columns) == 1 else after
+        query = query.where(position < tuple_(*last) if order == 'desc' else position > tuple_(*last))
+    query = query.order_by(*(column.desc() if order == 'desc' else column.asc() for column in columns))
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def get_players_on_market(
+        db: Session,
+        filters: schemas.MarketFilter = None,
+        sort: str = 'id',
+        order: str = 'asc',
+        after: Tuple = None,
+        limit: int = None
+        ) -> List[models.Player]:
+    """
+    Players on the market list, filtered and sorted, a page at a time
+    :param db: database session
+    :param filters: optional role, country, age and asking price constraints
+    :param sort: one of MARKET_SORT_COLUMNS, ties are broken by player id
+    :param order: 'asc' or 'desc'
+    :param after: (sort key, id) of the last player of the previous page
+    :param limit: maximum number of players, all of them if None
+    :return: list of the players
+    """
+    return _market_page(db.query(models.Player), filters, sort, order, after, limit).all()
+
+
+def get_market_rows(
+        db: Session,
+        filters: schemas.MarketFilter = None,
+        sort: str = 'id',
+        order: str = 'asc',
+        after: Tuple = None,
+        limit: int = None
+        ) -> List[Row]:
+    """
+    Same as get_players_on_market, returning plain MARKET_COLUMNS rows instead of
+    ORM objects, for the responses serialized without models
+    """
+    return _market_page(db.query(*MARKET_COLUMNS), filters, sort, order, after, limit).all()
+
+
+def get_team_player_rows(db: Session, team_id: int) -> List[Row]:
+    """
+    Same as get_players_by_team_id, returning plain PLAYER_COLUMNS rows
+    """
+    return db.query(*PLAYER_COLUMNS).filter(models.Player.team_id == team_id).all()
+
+
+# rows fetched from the cursor at a time
+EXPORT_BATCH_SIZE = 1000
+
 
+def market_export_statement(filters: schemas.MarketFilter = None) -> Select:
+    """
+    :param filters: optional market filters
+    :return: statement selecting the exported columns of the market list, by player id
+    """
+    return _filter_market(select(*MARKET_COLUMNS), filters).order_by(models.Player.id)
 
-def create_user(db: Session, user: schemas.User) -> models.User:
+
+def team_players_export_statement(team_id: int) -> Select:
+    """
+    :return: statement selecting the exported columns of the players of a team, by player id
+    """
+    return select(*PLAYER_COLUMNS).where(models.Player.team_id == team_id).order_by(models.Player.id)
+
+
+def export_team_players(db: Session, team_id: int) -> Result:
+    """
+    :return: result streaming the exported columns of the players of a team
+    """
+    return db.execute(team_players_export_statement(team_id).execution_options(yield_per=EXPORT_BATCH_SIZE))
+
+
+def create_user(db: Session, user: schemas.User, hashed_password: str = None) -> models.User:
+    if hashed_password is None:
+        hashed_password = get_password_hash(user.password)
     db_user = models.User(
         username=user.username,
-        hashed_password=get_password_hash(user.password))
+        hashed_password=hashed_password)
     db.add(db_user)
     db.commit()
     return db_user
 
 
-def create_team(db: Session, team: schemas.Team):
-    db_team = models.Team(
-        name=team.name,
-        user_id=team.user_id,
-        budget=team.budget,
-        country=team.country
-    )
-    db.add(db_team)
-    db.commit()
+def register_user(db: Session, user: schemas.User, hashed_password: str) -> models.User:
+    """
+    Registers a user along with its generated team and players, in a single transaction:
+    either all of them are stored, or none is.
+    Players are written with one executemany insert
+    :param db: database session
+    :param user: username and password
+    :param hashed_password: password hash to store
+    :raise IntegrityError: the username is already registered
+    :return: the new user
+    """
+    try:
+        db_user = models.User(username=user.username, hashed_password=hashed_password)
+        db.add(db_user)
+        db.flush()
+        generator = get_generator()
+        db_team = models.Team(**generator.team(db_user.id, db_user.username))
+        db.add(db_team)
+        db.flush()
+        db.execute(insert(models.Player), generator.squad(db_team.id))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return db_user
+
+
+def register_team(db: Session, user_id: int, username: str, player_ids: List[int]) -> models.Team:
+    """
+    Creates the generated team and players of a registered user on its shard, in a single transaction.
+    The team takes the id of the user, the players the given ids; the shard keeps a copy of the user
+    row, without its password, for the team foreign key
+    :param db: session of the shard of the user
+    :param user_id: id of the user in the users database
+    :param username: its username, used for the team name
+    :param player_ids: ids of the players, one per role of the squad
+    :return: the new team
+    """
+    try:
+        db.add(models.User(id=user_id, username=username))
+        generator = get_generator()
+        db_team = models.Team(id=user_id, **generator.team(user_id, username))
+        db.add(db_team)
+        db.flush()
+        squad = generator.squad(db_team.id)
+        db.execute(insert(models.Player), [dict(player, id=player_id) for player, player_id in zip(squad, player_ids)])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
     return db_team
 
 
-def create_players(db: Session, players: List[schemas.MarketPlayer]):
-    for player in players:
-        db_player = models.Player(
-            name=player.name,
-            surname=player.surname,
-            country=player.country,
-            role=player.role,
-            age=player.age,
-            team_id=player.team_id,
-            value=player.value,
-            on_market=player.on_market,
-            requested_value=player.requested_value
-        )
-        db.add(db_player)
+def delete_user(db: Session, user_id: int):
+    """
+    Deletes a user without team, when the creation of its team on its shard failed
+    """
+    db.query(models.User).filter(models.User.id == user_id).delete(synchronize_session=False)
     db.commit()
-    return
 
 
 def authenticate_user(db: Session, username: str, password: str):
@@ -91,6 +262,7 @@ def update_team(db: Session, team: models.Team, team_name, country):
     if country:
         team.country = country
     db.commit()
+    invalidation_bus.publish(team_topic(team.id))
     return team
 
 
@@ -101,37 +273,936 @@ def update_player(db, player: models.Player, player_name, player_surname, player
         player.surname = player_surname
     if player_country:
         player.country = player_country
+    listed, team_id = player.on_market, player.team_id
+    asks = _book_asks([player]) if listed else []
     db.commit()
+    if listed:
+        invalidation_bus.publish(MARKET, team_topic(team_id))
+        order_book.update_asks(asks)
+    else:
+        invalidation_bus.publish(team_topic(team_id))
     return player
 
 
-def get_team_value(db: Session, team: models.Team):
-    team_value = db.query(func.sum(models.Player.value).label('team_value')) \
-        .filter(models.Player.team_id == team.id).group_by(models.Player.team_id).scalar()
-    return team_value
+def check_team_values(db: Session) -> List[Tuple[int, int, int]]:
+    """
+    Compares the stored team values with the sum of their players values
+    :param db: database session
+    :return: (team id, stored value, sum of players values) of every inconsistent team
+    """
+    players_value = func.coalesce(func.sum(models.Player.value), 0)
+    return db.query(models.Team.id, models.Team.value, players_value) \
+        .outerjoin(models.Player, models.Player.team_id == models.Team.id) \
+        .group_by(models.Team.id, models.Team.value) \
+        .having(models.Team.value != players_value) \
+        .all()
+
+
+def rebuild_team_values(db: Session) -> int:
+    """
+    Recomputes every stored team value from its players
+    :param db: database session
+    :return: number of teams updated
+    """
+    players_value = select(func.coalesce(func.sum(models.Player.value), 0)) \
+        .where(models.Player.team_id == models.Team.id) \
+        .scalar_subquery()
+    updated = db.query(models.Team).update({models.Team.value: players_value}, synchronize_session=False)
+    db.commit()
+    return updated
 
 
 def put_player_for_sale(db: Session, player: models.Player, price: int):
     player.on_market = True
     player.requested_value = price
+    asks = _book_asks([player])
+    team_id = player.team_id
     db.commit()
+    invalidation_bus.publish(MARKET, team_topic(team_id))
+    order_book.update_asks(asks)
     return player
 
 
-def acquire_player(db: Session, player: models.Player, user_team: models.Team):
-    seller_team = get_team_by_team_id(db, player.team_id)
-    user_team.budget -= player.requested_value
-    seller_team.budget += player.requested_value
-    player.team_id = user_team.id
-    player.value = utils.random_markup(player.value)
-    player.on_market = False
-    player.requested_value = None
-    db.commit()
+def get_players_by_ids(db: Session, player_ids: List[int]) -> Dict[int, models.Player]:
+    """
+    :return: players with the given ids, by id, loaded with a single IN query
+    """
+    players = db.query(models.Player).filter(models.Player.id.in_(set(player_ids))).all()
+    return {player.id: player for player in players}
+
+
+def put_players_for_sale(db: Session, team_id: int, orders: List[Tuple[int, int]]) -> List[schemas.BatchItemResult]:
+    """
+    Lists many players of a team at once, in one transaction; invalid items are reported and skipped
+    :param db: database session
+    :param team_id: team owning the players
+    :param orders: (player id, asking price) pairs
+    :return: result of each order, in order
+    """
+    players = get_players_by_ids(db, [player_id for player_id, _ in orders])
+    auctioned = get_auctioned_player_ids(db, list(players))
+    results = []
+    for player_id, price in orders:
+        player = players.get(player_id)
+        if not player:
+            error = exceptions.player_does_not_exist()
+        elif player.team_id != team_id:
+            error = exceptions.player_unavailable()
+        elif player_id in auctioned:
+            error = exceptions.player_in_auction()
+        elif price <= 0:
+            error = exceptions.invalid_price()
+        else:
+            msg = 'player already on the market, updated price' if player.on_market else 'player put on the market'
+            player.on_market = True
+            player.requested_value = price
+            results.append((player_id, True, msg, player))
+            continue
+        results.append((player_id, False, error.detail, None))
+    return _commit_batch(db, results)
+
+
+def remove_players_for_sale(db: Session, team_id: int, player_ids: List[int]) -> List[schemas.BatchItemResult]:
+    """
+    Withdraws many players of a team from the market at once, in one transaction;
+    invalid items are reported and skipped
+    :param db: database session
+    :param team_id: team owning the players
+    :param player_ids: players to withdraw
+    :return: result of each withdrawal, in order
+    """
+    players = get_players_by_ids(db, player_ids)
+    results = []
+    for player_id in player_ids:
+        player = players.get(player_id)
+        if not player:
+            error = exceptions.player_does_not_exist()
+        elif player.team_id != team_id:
+            error = exceptions.player_unavailable()
+        elif not player.on_market:
+            error = exceptions.player_not_on_sale()
+        else:
+            player.on_market = False
+            player.requested_value = None
+            results.append((player_id, True, 'player withdrawn from market listing', player))
+            continue
+        results.append((player_id, False, error.detail, None))
+    return _commit_batch(db, results)
+
+
+def _commit_batch(db: Session, results: List[Tuple]) -> List[schemas.BatchItemResult]:
+    # serialized before the commit expires the players
+    batch = [
+        schemas.BatchItemResult(
+            player_id=player_id, ok=ok, msg=msg, player=schemas.MarketPlayer.from_orm(player) if ok else None
+        )
+        for player_id, ok, msg, player in results
+    ]
+    if any(item.ok for item in batch):
+        asks = _book_asks([player for _, ok, _, player in results if ok])
+        team_ids = {player.team_id for _, ok, _, player in results if ok}
+        db.commit()
+        invalidation_bus.publish(MARKET, *map(team_topic, team_ids))
+        order_book.update_asks(asks)
+    return batch
+
+
+def acquire_player(db: Session, player: models.Player, user_team: models.Team, bid_id: int = None):
+    """
+    Transfers a listed player to the user team at its asking price.
+    The transfer is made of conditional UPDATEs, each guarded on the state it expects, in
+    one short transaction: the player must still be listed by the same team at the same
+    price, and the buyer budget must cover the price. When a guard fails nothing is
+    written, so concurrent buyers cannot both get the player or overdraw a budget.
+    Teams are updated in id order, so that concurrent transfers lock them in the same order.
+    The sale is recorded in the transfers ledger by the same transaction
+    :param db: database session
+    :param player: the player, as read by the caller
+    :param user_team: the buyer team
+    :param bid_id: standing bid of the buyer filled by the transfer, deleted with it
+    :raise HTTPException: player_not_on_sale if the listing changed, insufficient_funds,
+    bid_does_not_exist if the bid was cancelled
+    :return: the transferred player
+    """
+    player_id, price, seller_team_id, old_value = player.id, player.requested_value, player.team_id, player.value
+    if not player.on_market or price is None:
+        raise exceptions.player_not_on_sale()
+    new_value = utils.random_markup(old_value)
+    try:
+        moved = db.query(models.Player).filter(
+            models.Player.id == player_id,
+            models.Player.on_market == true(),
+            models.Player.team_id == seller_team_id,
+            models.Player.requested_value == price,
+            models.Player.value == old_value
+        ).update({
+            models.Player.team_id: user_team.id,
+            models.Player.value: new_value,
+            models.Player.on_market: False,
+            models.Player.requested_value: None
+        }, synchronize_session='evaluate')
+        if moved != 1:
+            raise exceptions.player_not_on_sale()
+        for team_id in sorted((seller_team_id, user_team.id)):
+            if team_id == user_team.id:
+                paid = db.query(models.Team).filter(
+                    models.Team.id == user_team.id,
+                    models.Team.budget >= price
+                ).update({
+                    models.Team.budget: models.Team.budget - price,
+                    models.Team.value: models.Team.value + new_value
+                }, synchronize_session='evaluate')
+                if paid != 1:
+                    raise exceptions.insufficient_funds()
+            else:
+                db.query(models.Team).filter(models.Team.id == seller_team_id).update({
+                    models.Team.budget: models.Team.budget + price,
+                    models.Team.value: models.Team.value - old_value
+                }, synchronize_session='evaluate')
+        record_transfers(db, [{
+            'player_id': player_id, 'seller_team_id': seller_team_id, 'buyer_team_id': user_team.id,
+            'price': price, 'old_value': old_value, 'new_value': new_value,
+            'source': 'market' if bid_id is None else 'bid'
+        }])
+        if bid_id is not None and \
+                db.query(models.Bid).filter(models.Bid.id == bid_id).delete(synchronize_session=False) != 1:
+            raise exceptions.bid_does_not_exist()
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    invalidation_bus.publish(MARKET, team_topic(seller_team_id), team_topic(user_team.id))
+    order_book.update_asks([(player_id, None)])
     return player
 
 
 def remove_player_for_sale(db: Session, player: models.Player):
     player.on_market = False
     player.requested_value = None
+    player_id, team_id = player.id, player.team_id
     db.commit()
+    invalidation_bus.publish(MARKET, team_topic(team_id))
+    order_book.update_asks([(player_id, None)])
     return player
+
+
+def _book_asks(players: List[models.Player]) -> List[Tuple[int, Optional[BookAsk]]]:
+    # read before the commit expires the players
+    return [(player.id, BookAsk.from_player(player)) for player in players]
+
+
+# topics of the order book content: listings and standing bids
+ORDER_BOOK_TOPICS = (MARKET, ORDERS)
+invalidation_bus.subscribe(order_book.published)
+
+
+def load_order_book(db: Session, versions: List[int] = None) -> OrderBook:
+    """
+    Rebuilds the order book from the standing bids and the listed players
+    :param versions: current versions of ORDER_BOOK_TOPICS, read here when not given
+    :return: the loaded book
+    """
+    if versions is None:
+        versions = invalidation_bus.backend.versions(ORDER_BOOK_TOPICS)
+    bids = db.query(
+        models.Bid.id, models.Bid.team_id, models.Bid.max_price, models.Bid.player_id, models.Bid.role,
+        models.Bid.min_age, models.Bid.max_age, models.Bid.country
+    ).order_by(models.Bid.id).all()
+    asks = db.query(
+        models.Player.id, models.Player.team_id, models.Player.requested_value, models.Player.role,
+        models.Player.age, models.Player.country, models.Player.on_market
+    ).filter(models.Player.on_market == true()).order_by(models.Player.id).all()
+    order_book.load(map(BookBid.from_row, bids), filter(None, map(BookAsk.from_player, asks)),
+                    dict(zip(ORDER_BOOK_TOPICS, versions)))
+    return order_book
+
+
+def _loaded_order_book(db: Session, versions: List[int] = None) -> OrderBook:
+    """
+    The order book, loaded again when another worker changed the listings or the bids since
+    :param versions: current versions of ORDER_BOOK_TOPICS, read here when not given
+    """
+    if versions is None:
+        versions = invalidation_bus.backend.versions(ORDER_BOOK_TOPICS)
+    if not order_book.loaded or order_book.changed_elsewhere(dict(zip(ORDER_BOOK_TOPICS, versions))):
+        load_order_book(db, versions)
+    return order_book
+
+
+def get_team_bids(db: Session, team_id: int) -> List[models.Bid]:
+    return db.query(models.Bid).filter(models.Bid.team_id == team_id).order_by(models.Bid.id).all()
+
+
+def place_bid(db: Session, team_id: int, order: schemas.BidOrder,
+              versions: List[int] = None) -> Tuple[schemas.Bid, List[schemas.Trade]]:
+    """
+    Stores a standing bid, and executes it at once if an ask crosses it
+    :param db: database session
+    :param team_id: bidding team
+    :param order: target (player_id, or role with optional age and country constraints) and max_price
+    :param versions: current versions of ORDER_BOOK_TOPICS, read here when not given
+    :return: the bid, and the trade filling it if any
+    """
+    book = _loaded_order_book(db, versions)
+    bid = models.Bid(team_id=team_id, **dict(order.dict(), role=order.role.value if order.role else None))
+    db.add(bid)
+    db.flush()
+    placed = schemas.Bid.from_orm(bid)
+    book_bid = BookBid.from_row(bid)
+    db.commit()
+    invalidation_bus.publish(ORDERS)
+    book.add_bid(book_bid)
+    return placed, _match_orders(db, book, bid_id=placed.id)
+
+
+def cancel_bid(db: Session, team_id: int, bid_id: int) -> schemas.Bid:
+    """
+    :raise HTTPException: bid_does_not_exist, also when the bid belongs to another team
+    :return: the cancelled bid
+    """
+    bid = db.query(models.Bid).filter(models.Bid.id == bid_id, models.Bid.team_id == team_id).first()
+    if not bid:
+        raise exceptions.bid_does_not_exist()
+    cancelled = schemas.Bid.from_orm(bid)
+    db.delete(bid)
+    db.commit()
+    invalidation_bus.publish(ORDERS)
+    order_book.remove_bid(bid_id)
+    return cancelled
+
+
+# bound on the crossings retried when orders turn out stale
+MATCH_ATTEMPTS = 100
+
+
+def match_orders(db: Session, bid_id: int = None, player_id: int = None,
+                 versions: List[int] = None) -> List[schemas.Trade]:
+    """
+    Executes the crossing of a new bid with the best ask it accepts, or of a newly listed
+    player with the best bid accepting it, in price-time priority.
+    The trade goes through acquire_player, at the asking price, and consumes the bid.
+    Before trading, both orders are checked against the database: cancelled bids are dropped,
+    bids the buyer cannot afford at the moment are skipped (they stay in the book, and in the
+    database), changed listings are refreshed, and the next crossing is tried
+    :param db: database session
+    :param bid_id: the new bid
+    :param player_id: the newly listed player
+    :param versions: current versions of ORDER_BOOK_TOPICS, read here when not given
+    :return: the trade executed, if any
+    """
+    return _match_orders(db, _loaded_order_book(db, versions), bid_id, player_id)
+
+
+def _match_orders(db: Session, book: OrderBook, bid_id: int = None, player_id: int = None) -> List[schemas.Trade]:
+    # bids skipped for now, kept out of the book while matching so that other bids get a chance
+    skipped = []
+    try:
+        for _ in range(MATCH_ATTEMPTS):
+            crossing = book.take_crossing(bid_id=bid_id, player_id=player_id)
+            if crossing is None:
+                break
+            bid, ask = crossing
+            # fresh reads: the session may hold objects older than concurrent trades
+            player = db.query(models.Player).populate_existing().filter(models.Player.id == ask.player_id).first()
+            listed = BookAsk.from_player(player) if player else None
+            if listed is None or listed.price != ask.price or listed.team_id != ask.team_id:
+                book.restore(bid=bid)
+                book.update_asks([(ask.player_id, listed)])
+                continue
+            if not db.query(models.Bid.id).filter(models.Bid.id == bid.id).first():
+                book.restore(ask=ask)
+                continue
+            buyer = db.query(models.Team).populate_existing().filter(models.Team.id == bid.team_id).first()
+            if buyer.budget < ask.price:
+                skipped.append(bid)
+                book.restore(ask=ask)
+                continue
+            try:
+                acquire_player(db, player, buyer, bid_id=bid.id)
+            except HTTPException:
+                # lost a race with another request: checked again on the next attempt
+                book.restore(bid=bid, ask=ask)
+                continue
+            return [schemas.Trade(
+                bid_id=bid.id, player_id=ask.player_id, price=ask.price,
+                seller_team_id=ask.team_id, buyer_team_id=bid.team_id
+            )]
+        return []
+    finally:
+        for bid in skipped:
+            book.restore(bid=bid)
+
+
+def get_open_auction(db: Session, player_id: int) -> Optional[models.Auction]:
+    return db.query(models.Auction) \
+        .filter(models.Auction.player_id == player_id, models.Auction.status == 'open').first()
+
+
+def get_auctioned_player_ids(db: Session, player_ids: List[int]) -> Set[int]:
+    """
+    :return: the players among `player_ids` in an open auction, read with a single IN query
+    """
+    rows = db.query(models.Auction.player_id) \
+        .filter(models.Auction.player_id.in_(set(player_ids)), models.Auction.status == 'open').all()
+    return {row.player_id for row in rows}
+
+
+def get_open_auctions(db: Session, limit: int = 100) -> List[models.Auction]:
+    """
+    :return: open auctions, the first ending first
+    """
+    return db.query(models.Auction).filter(models.Auction.status == 'open') \
+        .order_by(models.Auction.ends_at, models.Auction.id).limit(limit).all()
+
+
+def get_auctions_ending_before(db: Session, until: datetime) -> List[Row]:
+    """
+    :return: (id, ends_at) of the open auctions ending before `until`, from the open auctions index
+    """
+    return db.query(models.Auction.id, models.Auction.ends_at) \
+        .filter(models.Auction.status == 'open', models.Auction.ends_at <= until).all()
+
+
+def start_auction(db: Session, player: models.Player, reserve_price: int, duration: int,
+                  now: datetime = None) -> schemas.Auction:
+    """
+    Puts a player up for auction, until `duration` seconds from now
+    :param db: database session
+    :param player: auctioned player, not on the market list
+    :param reserve_price: lowest accepted bid
+    :param duration: seconds until the auction ends
+    :param now: current time, naive UTC
+    :raise HTTPException: player_in_auction if the player is in another open auction
+    :return: the auction
+    """
+    now = now or datetime.utcnow()
+    auction = models.Auction(
+        player_id=player.id, seller_team_id=player.team_id, reserve_price=reserve_price,
+        ends_at=now + timedelta(seconds=duration), status='open'
+    )
+    db.add(auction)
+    try:
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        raise exceptions.player_in_auction()
+    started = schemas.Auction.from_orm(auction)
+    db.commit()
+    return started
+
+
+def place_auction_bid(db: Session, auction_id: int, team: models.Team, amount: int,
+                      now: datetime = None) -> schemas.Auction:
+    """
+    Raises the best bid of an open auction. The bid is recorded by a conditional UPDATE, so that
+    of concurrent bids only the ones above the best bid at the time they are written succeed.
+    The budget of the bidder is checked again when the auction is settled
+    :param db: database session
+    :param auction_id: auction id
+    :param team: bidding team
+    :param amount: bid
+    :param now: current time, naive UTC
+    :raise HTTPException: auction_does_not_exist, player_already_yours, auction_closed,
+    bid_too_low, insufficient_funds
+    :return: the auction with the new best bid
+    """
+    now = now or datetime.utcnow()
+    auction = db.query(models.Auction).filter(models.Auction.id == auction_id).first()
+    if not auction:
+        raise exceptions.auction_does_not_exist()
+    if auction.seller_team_id == team.id:
+        raise exceptions.player_already_yours()
+    if auction.status != 'open' or auction.ends_at <= now:
+        raise exceptions.auction_closed()
+    if amount < auction.reserve_price or (auction.best_bid is not None and amount <= auction.best_bid):
+        raise exceptions.bid_too_low()
+    if amount > team.budget:
+        raise exceptions.insufficient_funds()
+    raised = db.query(models.Auction).filter(
+        models.Auction.id == auction_id,
+        models.Auction.status == 'open',
+        models.Auction.ends_at > now,
+        or_(models.Auction.best_bid.is_(None), models.Auction.best_bid < amount)
+    ).update({
+        models.Auction.best_bid: amount,
+        models.Auction.best_bidder_team_id: team.id
+    }, synchronize_session=False)
+    if raised != 1:
+        db.rollback()
+        raise exceptions.bid_too_low()
+    result = schemas.Auction.from_orm(auction).copy(update={'best_bid': amount, 'best_bidder_team_id': team.id})
+    db.commit()
+    return result
+
+
+def settle_auctions(db: Session, auction_ids: List[int], now: datetime = None) -> Dict[int, str]:
+    """
+    Closes a batch of ended auctions in one transaction, with a fixed number of statements
+    whatever the size of the batch. The auctions are claimed first, which locks them (the whole
+    database for SQLite) until the commit; then the players and the teams involved are read,
+    locked, in one query each. Each auction with a bid is sold to the best bidder at the bid
+    price on the same terms as acquire_player: the player must still belong to the seller,
+    off the market list, the buyer budget must cover the price (auctions are settled in id
+    order against the running budgets), and the player value gets utils.random_markup, which
+    the team values follow. Otherwise the auction closes unsold.
+    The transfers are then written with one executemany per table, and recorded in the ledger
+    :param db: database session
+    :param auction_ids: auctions due
+    :param now: current time, naive UTC
+    :return: new status of each closed auction, by id; auctions not ended at `now`,
+    or already closed, are skipped
+    """
+    now = now or datetime.utcnow()
+    auction_ids = set(auction_ids)
+    try:
+        db.query(models.Auction).filter(
+            models.Auction.id.in_(auction_ids),
+            models.Auction.status == 'open',
+            models.Auction.ends_at <= now
+        ).update({models.Auction.status: 'settling'}, synchronize_session=False)
+        auctions = db.query(
+            models.Auction.id, models.Auction.player_id, models.Auction.seller_team_id,
+            models.Auction.best_bid, models.Auction.best_bidder_team_id
+        ).filter(models.Auction.id.in_(auction_ids), models.Auction.status == 'settling') \
+            .order_by(models.Auction.id).all()
+        bids = [auction for auction in auctions if auction.best_bid is not None]
+        players = {
+            player.id: player for player in db.query(
+                models.Player.id, models.Player.team_id, models.Player.value, models.Player.on_market
+            ).filter(models.Player.id.in_({auction.player_id for auction in bids})).with_for_update()
+        }
+        team_ids = {auction.seller_team_id for auction in bids} | {auction.best_bidder_team_id for auction in bids}
+        budgets = dict(
+            db.query(models.Team.id, models.Team.budget).filter(models.Team.id.in_(team_ids)).with_for_update()
+        )
+        sold, moves, deltas = [], [], {}
+        for auction in bids:
+            player = players.get(auction.player_id)
+            buyer, seller, price = auction.best_bidder_team_id, auction.seller_team_id, auction.best_bid
+            if player is None or player.team_id != seller or player.on_market or budgets[buyer] < price:
+                continue
+            new_value = utils.random_markup(player.value)
+            budgets[buyer] -= price
+            budgets[seller] += price
+            for team_id, budget_delta, value_delta in ((buyer, -price, new_value), (seller, price, -player.value)):
+                delta = deltas.setdefault(team_id, [0, 0])
+                delta[0] += budget_delta
+                delta[1] += value_delta
+            moves.append({
+                'player_id': player.id, 'seller_team_id': seller, 'buyer_team_id': buyer, 'price': price,
+                'old_value': player.value, 'new_value': new_value, 'source': 'auction'
+            })
+            sold.append(auction.id)
+        if moves:
+            db.execute(_SETTLE_PLAYER, moves)
+            # in id order, so that concurrent transfers lock the teams in the same order
+            db.execute(_SETTLE_TEAM, [
+                {'team_id': team_id, 'budget_delta': budget_delta, 'value_delta': value_delta}
+                for team_id, (budget_delta, value_delta) in sorted(deltas.items())
+            ])
+            record_transfers(db, moves, now)
+            db.query(models.Auction).filter(models.Auction.id.in_(sold)) \
+                .update({models.Auction.status: 'sold'}, synchronize_session=False)
+        db.query(models.Auction).filter(models.Auction.id.in_(auction_ids), models.Auction.status == 'settling') \
+            .update({models.Auction.status: 'unsold'}, synchronize_session=False)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    if deltas:
+        invalidation_bus.publish(*map(team_topic, sorted(deltas)))
+    # no route of this worker makes these sales: they are published to the feed here
+    for move in moves:
+        market_feed.publish('sold', {
+            'player_id': move['player_id'], 'price': move['price'], 'seller_team_id': move['seller_team_id'],
+            'buyer_team_id': move['buyer_team_id']
+        })
+    sold = set(sold)
+    return {auction.id: 'sold' if auction.id in sold else 'unsold' for auction in auctions}
+
+
+# statements of the auction settlement, run once per batch with a list of parameters
+_SETTLE_PLAYER = update(models.Player).where(
+    models.Player.id == bindparam('player_id'),
+    models.Player.team_id == bindparam('seller_team_id'),
+    models.Player.value == bindparam('old_value')
+).values(team_id=bindparam('buyer_team_id'), value=bindparam('new_value'), on_market=False, requested_value=None)
+_SETTLE_TEAM = update(models.Team).where(models.Team.id == bindparam('team_id')).values(
+    budget=models.Team.budget + bindparam('budget_delta'),
+    value=models.Team.value + bindparam('value_delta')
+)
+
+
+TRANSFER_TOTALS = ('spent', 'earned', 'bought', 'sold')
+
+
+def record_transfers(db: Session, transfers: List[Dict], now: datetime = None, team_ids: Set[int] = None):
+    """
+    Appends sales to the transfers ledger and adds them to the team totals, in the transaction
+    of the caller: one executemany INSERT, and one upsert of the totals of every team involved
+    :param db: database session
+    :param transfers: player_id, seller_team_id, buyer_team_id, price, old_value, new_value and source of each sale
+    :param now: time of the sales, naive UTC
+    :param team_ids: teams whose totals are updated, every team involved by default
+    (a shard only keeps the totals of its own teams)
+    """
+    now = now or datetime.utcnow()
+    db.execute(insert(models.Transfer), [dict(transfer, created_at=now) for transfer in transfers])
+    totals = {}
+    for transfer in transfers:
+        for team_id, column, count in (
+                (transfer['buyer_team_id'], 'spent', 'bought'), (transfer['seller_team_id'], 'earned', 'sold')
+        ):
+            if team_ids is not None and team_id not in team_ids:
+                continue
+            team = totals.setdefault(team_id, dict({total: 0 for total in TRANSFER_TOTALS}, team_id=team_id))
+            team[column] += transfer['price']
+            team[count] += 1
+    dialect_insert = postgresql.insert if db.get_bind().dialect.name == 'postgresql' else sqlite.insert
+    statement = dialect_insert(models.TeamTransferTotals).values([totals[team_id] for team_id in sorted(totals)])
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[models.TeamTransferTotals.team_id],
+        set_={
+            total: getattr(models.TeamTransferTotals, total) + getattr(statement.excluded, total)
+            for total in TRANSFER_TOTALS
+        }
+    ))
+
+
+def get_player_transfers(db: Session, player_id: int, before: int = None, limit: int = 50) -> List[models.Transfer]:
+    """
+    :param before: id of the last transfer already served, for the next page
+    :return: transfers of the player, newest first, read from the (player_id, id) index
+    """
+    query = db.query(models.Transfer).filter(models.Transfer.player_id == player_id)
+    if before is not None:
+        query = query.filter(models.Transfer.id < before)
+    return query.order_by(models.Transfer.id.desc()).limit(limit).all()
+
+
+def get_team_transfers(db: Session, team_id: int, before: int = None, limit: int = 50) -> List[models.Transfer]:
+    """
+    Sales and purchases of a team in one query: the last `limit` ids of each side are read from
+    the seller and buyer indexes, and merged
+    :param before: id of the last transfer already served, for the next page
+    :return: transfers of the team, newest first
+    """
+    sides = []
+    for column in (models.Transfer.seller_team_id, models.Transfer.buyer_team_id):
+        side = select(models.Transfer.id).where(column == team_id)
+        if before is not None:
+            side = side.where(models.Transfer.id < before)
+        sides.append(select(side.order_by(models.Transfer.id.desc()).limit(limit).subquery()))
+    return db.query(models.Transfer).filter(models.Transfer.id.in_(union_all(*sides))) \
+        .order_by(models.Transfer.id.desc()).limit(limit).all()
+
+
+def get_transfer_totals(db: Session, team_id: int) -> schemas.TransferTotals:
+    """
+    :return: money spent and earned, players bought and sold by the team, from the rollup
+    """
+    totals = db.query(models.TeamTransferTotals).filter(models.TeamTransferTotals.team_id == team_id).first()
+    return schemas.TransferTotals.from_orm(totals) if totals else schemas.TransferTotals(team_id=team_id)
+
+
+def claim_idempotency_key(db: Session, user_id: int, key: str, fingerprint: str, now: datetime = None,
+                          ttl: int = None, lock_timeout: int = None) -> Optional[models.IdempotencyKey]:
+    """
+    Registers a request sent with an idempotency key as pending, unless the key is already
+    known. An expired record of the key is taken over, as well as a record still pending after
+    `lock_timeout` seconds (the worker running the request was lost)
+    :param db: database session
+    :param user_id: user sending the request: keys are scoped by user
+    :param key: Idempotency-Key header
+    :param fingerprint: hash of the request
+    :param now: current time, naive UTC
+    :param ttl: seconds the record is kept
+    :param lock_timeout: seconds after which a pending record is taken over
+    :return: None when the caller got the key and runs the request, the record of the key otherwise
+    """
+    now = now or datetime.utcnow()
+    ttl = ttl or settings.IDEMPOTENCY_TTL
+    lock_timeout = lock_timeout or settings.IDEMPOTENCY_LOCK_SECONDS
+    claim = {
+        models.IdempotencyKey.fingerprint: fingerprint, models.IdempotencyKey.status: 'pending',
+        models.IdempotencyKey.status_code: None, models.IdempotencyKey.headers: None,
+        models.IdempotencyKey.body: None, models.IdempotencyKey.created_at: now,
+        models.IdempotencyKey.expires_at: now + timedelta(seconds=ttl),
+    }
+    # a retry finds the record with one query; the record may go away between the
+    # statements (released by a failed request, or purged): the claim is then tried again
+    for _ in range(3):
+        record = get_idempotency_key(db, user_id, key)
+        if record is None:
+            try:
+                db.execute(insert(models.IdempotencyKey).values(
+                    user_id=user_id, key=key, **{column.key: value for column, value in claim.items()}
+                ))
+                db.commit()
+                return None
+            except IntegrityError:
+                db.rollback()
+                continue
+        lost = record.status == 'pending' and record.created_at <= now - timedelta(seconds=lock_timeout)
+        if record.expires_at > now and not lost:
+            return record
+        taken = db.query(models.IdempotencyKey).filter(
+            models.IdempotencyKey.user_id == user_id,
+            models.IdempotencyKey.key == key,
+            models.IdempotencyKey.status == record.status,
+            models.IdempotencyKey.created_at == record.created_at
+        ).update(claim, synchronize_session=False)
+        db.commit()
+        if taken:
+            return None
+    raise exceptions.idempotency_key_in_progress()
+
+
+def get_idempotency_key(db: Session, user_id: int, key: str) -> Optional[models.IdempotencyKey]:
+    # read again when already in the session: the record changes under other sessions
+    return db.query(models.IdempotencyKey).populate_existing().filter(
+        models.IdempotencyKey.user_id == user_id, models.IdempotencyKey.key == key
+    ).first()
+
+
+def save_idempotent_response(db: Session, user_id: int, key: str, status_code: int, headers: str, body: bytes):
+    """
+    Stores the response of the request holding a pending idempotency key
+    :param headers: response headers, as json
+    """
+    db.query(models.IdempotencyKey).filter(
+        models.IdempotencyKey.user_id == user_id,
+        models.IdempotencyKey.key == key,
+        models.IdempotencyKey.status == 'pending'
+    ).update({
+        models.IdempotencyKey.status: 'done', models.IdempotencyKey.status_code: status_code,
+        models.IdempotencyKey.headers: headers, models.IdempotencyKey.body: body
+    }, synchronize_session=False)
+    db.commit()
+
+
+def release_idempotency_key(db: Session, user_id: int, key: str):
+    """
+    Forgets a pending idempotency key, after its request failed: a retry runs again
+    """
+    db.query(models.IdempotencyKey).filter(
+        models.IdempotencyKey.user_id == user_id,
+        models.IdempotencyKey.key == key,
+        models.IdempotencyKey.status == 'pending'
+    ).delete(synchronize_session=False)
+    db.commit()
+
+
+def purge_idempotency_keys(db: Session, now: datetime = None) -> int:
+    """
+    Deletes the expired idempotency keys
+    :return: number of keys deleted
+    """
+    deleted = db.query(models.IdempotencyKey).filter(
+        models.IdempotencyKey.expires_at <= (now or datetime.utcnow())
+    ).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+
+def _transfer_columns(transfer: models.ShardTransfer) -> Dict:
+    return {
+        column: getattr(transfer, column) for column in
+        ('id', 'player_id', 'seller_team_id', 'buyer_team_id', 'price', 'old_value', 'new_value', 'created_at')
+    }
+
+
+def _transfer_sale(transfer: models.ShardTransfer) -> Dict:
+    return {
+        'player_id': transfer.player_id, 'seller_team_id': transfer.seller_team_id,
+        'buyer_team_id': transfer.buyer_team_id, 'price': transfer.price, 'old_value': transfer.old_value,
+        'new_value': transfer.new_value, 'source': 'market'
+    }
+
+
+def get_shard_transfer(db: Session, transfer_id: str) -> Optional[models.ShardTransfer]:
+    return db.query(models.ShardTransfer).filter(models.ShardTransfer.id == transfer_id) \
+        .populate_existing().first()
+
+
+def get_reserved_transfers(db: Session, before: datetime) -> List[models.ShardTransfer]:
+    """
+    :return: cross-shard transfers of this seller shard reserved before `before` and not finished yet
+    """
+    return db.query(models.ShardTransfer).filter(
+        models.ShardTransfer.status == 'reserved',
+        models.ShardTransfer.created_at < before
+    ).order_by(models.ShardTransfer.created_at).all()
+
+
+def reserve_transfer(db: Session, player: models.Player, buyer_team_id: int,
+                     now: datetime = None) -> models.ShardTransfer:
+    """
+    First step of a sale to a team of another shard, on the seller shard: the player is taken off
+    the market and out of the seller team, guarded as in acquire_player, and the transfer is
+    recorded as 'reserved', in one transaction. Without a team, the player can be neither sold nor
+    listed again until the transfer is done or cancelled
+    :param db: session of the seller shard
+    :param player: the player, as read by the caller
+    :param buyer_team_id: the buyer team, on another shard
+    :raise HTTPException: player_not_on_sale if the listing changed
+    :return: the reserved transfer, with the new value of the player
+    """
+    player_id, price, seller_team_id, old_value = player.id, player.requested_value, player.team_id, player.value
+    if not player.on_market or price is None:
+        raise exceptions.player_not_on_sale()
+    transfer = models.ShardTransfer(
+        id=uuid4().hex, player_id=player_id, seller_team_id=seller_team_id, buyer_team_id=buyer_team_id,
+        price=price, old_value=old_value, new_value=utils.random_markup(old_value), status='reserved',
+        created_at=now or datetime.utcnow()
+    )
+    try:
+        reserved = db.query(models.Player).filter(
+            models.Player.id == player_id,
+            models.Player.on_market == true(),
+            models.Player.team_id == seller_team_id,
+            models.Player.requested_value == price,
+            models.Player.value == old_value
+        ).update({
+            models.Player.team_id: None,
+            models.Player.on_market: False,
+            models.Player.requested_value: None
+        }, synchronize_session=False)
+        if reserved != 1:
+            raise exceptions.player_not_on_sale()
+        db.query(models.Team).filter(models.Team.id == seller_team_id) \
+            .update({models.Team.value: models.Team.value - old_value}, synchronize_session=False)
+        db.add(transfer)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    invalidation_bus.publish(MARKET, team_topic(seller_team_id))
+    order_book.update_asks([(player_id, None)])
+    return transfer
+
+
+def decide_transfer(db: Session, transfer: models.ShardTransfer, status: str) -> str:
+    """
+    Records the decision on a cross-shard transfer on the buyer shard, unless one was already recorded
+    :param db: session of the buyer shard
+    :param status: 'received' or 'cancelled'
+    :return: the decision recorded, this one or the previous one
+    """
+    try:
+        db.add(models.ShardTransfer(**_transfer_columns(transfer), status=status))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return get_shard_transfer(db, transfer.id).status
+    return status
+
+
+def receive_transfer(db: Session, transfer: models.ShardTransfer, player: models.Player) -> str:
+    """
+    Second step of a cross-shard sale, on the buyer shard: in one transaction, the decision
+    'received' is recorded, the buyer pays the price if its budget covers it, gets the player with
+    its new value, and the purchase is added to the ledger. When the budget does not cover the
+    price, 'cancelled' is recorded instead. A transfer already decided is left as it is
+    :param db: session of the buyer shard
+    :param transfer: the reserved transfer
+    :param player: the player, as read on the seller shard
+    :return: the decision, 'received' or 'cancelled'
+    """
+    try:
+        db.add(models.ShardTransfer(**_transfer_columns(transfer), status='received'))
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        return get_shard_transfer(db, transfer.id).status
+    try:
+        paid = db.query(models.Team).filter(
+            models.Team.id == transfer.buyer_team_id,
+            models.Team.budget >= transfer.price
+        ).update({
+            models.Team.budget: models.Team.budget - transfer.price,
+            models.Team.value: models.Team.value + transfer.new_value
+        }, synchronize_session=False)
+        if paid != 1:
+            db.rollback()
+            return decide_transfer(db, transfer, 'cancelled')
+        db.execute(insert(models.Player).values(
+            id=transfer.player_id, name=player.name, surname=player.surname, country=player.country,
+            role=player.role, age=player.age, team_id=transfer.buyer_team_id, value=transfer.new_value,
+            on_market=False, requested_value=None
+        ))
+        record_transfers(db, [_transfer_sale(transfer)], team_ids={transfer.buyer_team_id})
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    invalidation_bus.publish(team_topic(transfer.buyer_team_id))
+    return 'received'
+
+
+def complete_transfer(db: Session, transfer_id: str) -> bool:
+    """
+    Last step of a cross-shard sale received by the buyer, on the seller shard: the reserved player
+    is deleted, the seller is paid and the sale is added to the ledger, in one transaction
+    :param db: session of the seller shard
+    :return: False if the transfer was not reserved anymore
+    """
+    transfer = get_shard_transfer(db, transfer_id)
+    try:
+        done = db.query(models.ShardTransfer).filter(
+            models.ShardTransfer.id == transfer_id,
+            models.ShardTransfer.status == 'reserved'
+        ).update({models.ShardTransfer.status: 'done'}, synchronize_session=False)
+        if done != 1:
+            db.rollback()
+            return False
+        db.query(models.Player).filter(
+            models.Player.id == transfer.player_id,
+            models.Player.team_id.is_(None)
+        ).delete(synchronize_session=False)
+        db.query(models.Team).filter(models.Team.id == transfer.seller_team_id) \
+            .update({models.Team.budget: models.Team.budget + transfer.price}, synchronize_session=False)
+        record_transfers(db, [_transfer_sale(transfer)], team_ids={transfer.seller_team_id})
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    invalidation_bus.publish(team_topic(transfer.seller_team_id))
+    return True
+
+
+def cancel_transfer(db: Session, transfer_id: str) -> bool:
+    """
+    Undoes the reservation of a cross-shard sale the buyer did not receive, on the seller shard:
+    the player is back in the seller team, listed at the same price
+    :param db: session of the seller shard
+    :return: False if the transfer was not reserved anymore
+    """
+    transfer = get_shard_transfer(db, transfer_id)
+    try:
+        cancelled = db.query(models.ShardTransfer).filter(
+            models.ShardTransfer.id == transfer_id,
+            models.ShardTransfer.status == 'reserved'
+        ).update({models.ShardTransfer.status: 'cancelled'}, synchronize_session=False)
+        if cancelled != 1:
+            db.rollback()
+            return False
+        db.query(models.Player).filter(
+            models.Player.id == transfer.player_id,
+            models.Player.team_id.is_(None)
+        ).update({
+            models.Player.team_id: transfer.seller_team_id,
+            models.Player.on_market: True,
+            models.Player.requested_value: transfer.price
+        }, synchronize_session=False)
+        db.query(models.Team).filter(models.Team.id == transfer.seller_team_id) \
+            .update({models.Team.value: models.Team.value + transfer.old_value}, synchronize_session=False)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    invalidation_bus.publish(MARKET, team_topic(transfer.seller_team_id))
+    player = get_player_by_player_id(db, transfer.player_id)
+    if player is not None:
+        order_book.update_asks(_book_asks([player]))
+    return True
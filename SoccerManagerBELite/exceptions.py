@@ -68,3 +68,100 @@ def insufficient_funds():
     )
 
 
+def server_busy():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="server busy, retry later",
+        headers={'Retry-After': '1'}
+    )
+
+
+def invalid_cursor():
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="invalid pagination cursor"
+    )
+
+
+def invalid_bid():
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="a bid targets either a player_id or a role"
+    )
+
+
+def bid_does_not_exist():
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="bid with the given id does not exist"
+    )
+
+
+def player_in_auction():
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="player already in an open auction"
+    )
+
+
+def player_on_market():
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="player on the market list, withdraw it before the auction"
+    )
+
+
+def invalid_auction_duration():
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="auction duration out of the allowed range"
+    )
+
+
+def auction_does_not_exist():
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="auction with the given id does not exist"
+    )
+
+
+def auction_closed():
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="auction closed"
+    )
+
+
+def bid_too_low():
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="bid below the reserve price or not above the best bid"
+    )
+
+
+def invalid_idempotency_key():
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="Idempotency-Key must be 1 to 255 characters long"
+    )
+
+
+def idempotency_key_reused():
+    return HTTPException(
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        detail="Idempotency-Key already used for another request"
+    )
+
+
+def idempotency_key_in_progress():
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="a request with this Idempotency-Key is still in progress, retry later"
+    )
+
+
+def not_available_with_shards():
+    return HTTPException(
+        status_code=status.HTTP_501_NOT_IMPLEMENTED,
+        detail="not available when the teams are sharded"
+    )
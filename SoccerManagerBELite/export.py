@@ -0,0 +1,66 @@
+# streaming exports
+#
+# Rows are encoded as they come from the database cursor and sent in chunks,
+# so the memory used by an export does not depend on the number of rows.
+
+import csv
+import io
+import json
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, Sequence
+
+MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# rows encoded per chunk sent to the client
+CHUNK_SIZE = 500
+
+
+class RowEncoder:
+    """
+    Encodes result rows as NDJSON (one json object per line) or CSV (with a header line)
+    """
+
+    def __init__(self, columns: Sequence[str], export_format: str):
+        self.columns = list(columns)
+        self.export_format = export_format
+
+    def header(self) -> bytes:
+        if self.export_format == 'csv':
+            return self.encode_chunk([self.columns])
+        return b''
+
+    def encode_chunk(self, rows: Sequence[Sequence]) -> bytes:
+        if self.export_format == 'csv':
+            buffer = io.StringIO()
+            csv.writer(buffer, lineterminator='\n').writerows(rows)
+            return buffer.getvalue().encode()
+        return b''.join(
+            json.dumps(dict(zip(self.columns, row)), separators=(',', ':')).encode() + b'\n'
+            for row in rows
+        )
+
+
+def encode_rows(rows: Iterable[Sequence], encoder: RowEncoder) -> Iterator[bytes]:
+    yield encoder.header()
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            yield encoder.encode_chunk(chunk)
+            chunk = []
+    if chunk:
+        yield encoder.encode_chunk(chunk)
+
+
+async def aencode_rows(rows: AsyncIterable[Sequence], encoder: RowEncoder) -> AsyncIterator[bytes]:
+    yield encoder.header()
+    chunk = []
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            yield encoder.encode_chunk(chunk)
+            chunk = []
+    if chunk:
+        yield encoder.encode_chunk(chunk)
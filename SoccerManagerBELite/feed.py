@@ -0,0 +1,193 @@
+# live market feed
+#
+# `market_feed` pushes the market changes to the clients of `/market/feed`
+# (Server-Sent Events) and `/market/feed/ws` (WebSocket), instead of them
+# polling `/market/`. A client gets a snapshot of the listing, then one event per
+# change: `listed` (new listing or new price), `withdrawn` and `sold`.
+# Each event is serialized once, in both framings, and the same object is queued
+# to every subscriber. Queues are bounded: a subscriber falling `queue_size`
+# events behind is dropped, and its connection closed, so that a slow client
+# never delays the others or grows the memory of the worker.
+# Subscribers are grouped by event loop: events published from another loop or
+# thread are handed over with `call_soon_threadsafe`.
+# Changes are published by the routes making them (listings, withdrawals, sales,
+# renames of listed players) and by crud.settle_auctions for the auction sales.
+# The feed is per process, and is not carried by the cache invalidation bus,
+# which only knows topics: a client gets the changes made by the worker it is
+# connected to. Serve the feed with a single worker, or the clients of a worker
+# miss the changes made by the others.
+
+import asyncio
+import threading
+from typing import AsyncIterator, Dict, Optional, Set
+
+from fastapi import WebSocket, status
+
+import serializers
+from core.config import settings
+
+
+class FeedEvent:
+    """
+    Event serialized once, as a WebSocket text message and as a Server-Sent Event
+    """
+    __slots__ = ('seq', 'type', 'text', 'sse')
+
+    def __init__(self, seq: int, type: str, data):
+        self.seq = seq
+        self.type = type
+        self.text = serializers.dumps({'seq': seq, 'type': type, 'data': data}).decode()
+        self.sse = f'id: {seq}\nevent: {type}\ndata: {self.text}\n\n'
+
+
+class Subscriber:
+    """
+    Queue of the events of one client; None is queued when it is dropped
+    """
+    __slots__ = ('queue', 'loop', 'dropped')
+
+    def __init__(self, queue_size: int):
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size + 1)
+        self.loop = asyncio.get_running_loop()
+        self.dropped = False
+
+    async def get(self) -> Optional[FeedEvent]:
+        return await self.queue.get()
+
+
+class MarketFeed:
+    """
+    :param queue_size: events a subscriber may fall behind before being dropped
+    """
+
+    def __init__(self, queue_size: int = None):
+        self.queue_size = queue_size or settings.FEED_QUEUE_SIZE
+        self.dropped = 0
+        # sequence number of the last event published
+        self.seq = 0
+        self._subscribers: Dict[asyncio.AbstractEventLoop, Set[Subscriber]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(map(len, self._subscribers.values()))
+
+    def subscribe(self) -> Subscriber:
+        """
+        Registers a subscriber, from the event loop of its connection
+        """
+        subscriber = Subscriber(self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(subscriber.loop, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.loop)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.loop]
+
+    def publish(self, type: str, data) -> FeedEvent:
+        """
+        Queues an event to every subscriber, from any thread
+        :param type: 'listed', 'withdrawn' or 'sold'
+        :param data: json serializable content
+        :return: the event
+        """
+        try:
+            current = asyncio.get_running_loop()
+        except RuntimeError:
+            current = None
+        with self._lock:
+            self.seq += 1
+            event = FeedEvent(self.seq, type, data)
+            groups = [(loop, list(subscribers)) for loop, subscribers in self._subscribers.items()]
+        for loop, subscribers in groups:
+            if loop is current:
+                self._deliver(subscribers, event)
+            elif not loop.is_closed():
+                loop.call_soon_threadsafe(self._deliver, subscribers, event)
+        return event
+
+    def _deliver(self, subscribers, event: FeedEvent):
+        for subscriber in subscribers:
+            if subscriber.dropped:
+                continue
+            queue = subscriber.queue
+            if queue.qsize() < self.queue_size:
+                queue.put_nowait(event)
+            else:
+                # too slow: its backlog is discarded, the connection is closed on the next read
+                subscriber.dropped = True
+                self.dropped += 1
+                self.unsubscribe(subscriber)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+
+def snapshot_message(seq: int, players: bytes) -> str:
+    """
+    :param seq: sequence number of the last event published before the snapshot was read:
+    the events after it are queued to the client, and may already be part of the snapshot
+    :param players: serialized market listing
+    :return: the snapshot, as a json message
+    """
+    return f'{{"seq":{seq},"type":"snapshot","data":{players.decode()}}}'
+
+
+async def sse_stream(feed: MarketFeed, subscriber: Subscriber, snapshot: str,
+                     heartbeat: float = None) -> AsyncIterator[str]:
+    """
+    Server-Sent Events of a subscriber: the snapshot, then the events as they are published,
+    with a comment line every `heartbeat` seconds without events to keep the connection open.
+    Ends with a `dropped` event when the subscriber falls behind
+    """
+    heartbeat = heartbeat or settings.FEED_HEARTBEAT_SECONDS
+    try:
+        yield f'event: snapshot\ndata: {snapshot}\n\n'
+        while True:
+            try:
+                event = await asyncio.wait_for(subscriber.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            if event is None:
+                yield 'event: dropped\ndata: {}\n\n'
+                return
+            yield event.sse
+    finally:
+        feed.unsubscribe(subscriber)
+
+
+async def websocket_stream(feed: MarketFeed, subscriber: Subscriber, websocket: WebSocket, snapshot: str):
+    """
+    Sends the snapshot then the events to an accepted WebSocket, until the client disconnects.
+    A subscriber falling behind is disconnected with code 1013 (try again later)
+    """
+
+    async def send_events():
+        await websocket.send_text(snapshot)
+        while True:
+            event = await subscriber.get()
+            if event is None:
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                return
+            await websocket.send_text(event.text)
+
+    async def wait_disconnect():
+        while (await websocket.receive())['type'] != 'websocket.disconnect':
+            pass
+
+    tasks = [asyncio.ensure_future(send_events()), asyncio.ensure_future(wait_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        feed.unsubscribe(subscriber)
+
+
+market_feed = MarketFeed()
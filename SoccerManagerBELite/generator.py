@@ -0,0 +1,172 @@
+# generation engine for teams and players
+#
+# Name and country pools are read once per process; names are drawn with
+# the frequencies of the `names` distribution files through alias tables,
+# so every draw costs O(1) whatever the size of the pool.
+# `names` and `pycountry` are only imported when the pools are built: the
+# built pools are pickled to settings.GENERATOR_CACHE, and later processes
+# load them from there without touching either package.
+
+import os
+import pickle
+import random
+from functools import lru_cache
+from importlib import metadata
+from typing import Dict, List, Optional, Sequence, Tuple
+import params
+from core.config import settings
+
+
+class AliasTable:
+    """
+    Walker/Vose alias table: weighted sampling in O(1) per draw,
+    after an O(n) construction
+    """
+
+    def __init__(self, items: Sequence, weights: Sequence[float]):
+        n = len(items)
+        total = float(sum(weights))
+        scaled = [w * n / total for w in weights]
+        self.items = tuple(items)
+        self.probability = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, g = small.pop(), large.pop()
+            self.probability[s] = scaled[s]
+            self.alias[s] = g
+            scaled[g] -= 1.0 - scaled[s]
+            (small if scaled[g] < 1.0 else large).append(g)
+
+    def sample(self, rng: random.Random):
+        x = rng.random() * len(self.items)
+        i = int(x)
+        if x - i < self.probability[i]:
+            return self.items[i]
+        return self.items[self.alias[i]]
+
+
+def _read_name_distribution(filename: str) -> Tuple[List[str], List[float]]:
+    pool, weights = [], []
+    with open(filename) as name_file:
+        for line in name_file:
+            name, frequency, _, _ = line.split()
+            pool.append(name.capitalize())
+            weights.append(float(frequency))
+    return pool, weights
+
+
+def build_pools() -> Tuple[AliasTable, AliasTable, Tuple[str, ...]]:
+    """
+    Pools built from the `names` distribution files and the `pycountry` database
+    :return: first names and last names alias tables, tuple of country names
+    """
+    import names
+    import pycountry
+    first_names = AliasTable(*_read_name_distribution(names.FILES['first:male']))
+    last_names = AliasTable(*_read_name_distribution(names.FILES['last']))
+    countries = tuple(country.name for country in pycountry.countries)
+    return first_names, last_names, countries
+
+
+def _sources_version() -> Tuple[str, str, int]:
+    # a cache written from other versions of the sources is rebuilt
+    return metadata.version('names'), metadata.version('pycountry'), pickle.HIGHEST_PROTOCOL
+
+
+@lru_cache(maxsize=None)
+def load_pools(cache_path: Optional[str] = None) -> Tuple[AliasTable, AliasTable, Tuple[str, ...]]:
+    """
+    Pools shared by every generator of the process, read from the compiled cache when it is current,
+    else built and written to it
+    :param cache_path: compiled pools file, settings.GENERATOR_CACHE by default, '' for no cache
+    :return: first names and last names alias tables, tuple of country names
+    """
+    cache_path = settings.GENERATOR_CACHE if cache_path is None else cache_path
+    version = _sources_version()
+    if cache_path:
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                cached_version, pools = pickle.load(cache_file)
+            if cached_version == version:
+                return pools
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            pass
+    pools = build_pools()
+    if cache_path:
+        try:
+            # written aside and renamed, so that concurrent workers never read a partial file
+            temporary_path = f'{cache_path}.{os.getpid()}'
+            with open(temporary_path, 'wb') as cache_file:
+                pickle.dump((version, pools), cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, cache_path)
+        except OSError:
+            pass
+    return pools
+
+
+class SquadGenerator:
+    """
+    Generates teams and squads of players as plain dictionaries of column values,
+    ready to be inserted in the database.
+    Generators built with the same seed produce the same sequence
+    """
+
+    def __init__(self, seed: Optional[int] = None):
+        self.rng = random.Random(seed)
+        self.first_names, self.last_names, self.countries = load_pools()
+        self.roles = [role for role, n in params.team_size.items() for _ in range(n)]
+
+    def country(self) -> str:
+        return self.countries[int(self.rng.random() * len(self.countries))]
+
+    def team(self, user_id: int, username: str) -> Dict:
+        """
+        :param user_id: id of the user owning the team
+        :param username: its username, used for the team name
+        :return: team columns, without id, valued as the squad generated for it
+        """
+        return {
+            'user_id': user_id,
+            'name': f'Team of {username}',
+            'country': self.country(),
+            'budget': params.budget,
+            'value': len(self.roles) * params.initial_player_value,
+        }
+
+    def squad(self, team_id: int) -> List[Dict]:
+        """
+        Whole squad of a team, with the composition given by params.team_size
+        :param team_id: id of the team owning the players
+        :return: players columns, without id
+        """
+        rng = self.rng
+        first_names, last_names = self.first_names, self.last_names
+        return [
+            {
+                'name': first_names.sample(rng),
+                'surname': last_names.sample(rng),
+                'country': self.country(),
+                'role': role,
+                'age': rng.randint(18, 40),
+                'team_id': team_id,
+                'value': params.initial_player_value,
+                'on_market': False,
+                'requested_value': None,
+            }
+            for role in self.roles
+        ]
+
+
+_default_generator: Optional[SquadGenerator] = None
+
+
+def get_generator() -> SquadGenerator:
+    """
+    generator used by the API, seeded from settings.GENERATOR_SEED when set
+    """
+    global _default_generator
+    if _default_generator is None:
+        _default_generator = SquadGenerator(settings.GENERATOR_SEED)
+    return _default_generator
@@ -0,0 +1,198 @@
+# idempotent retries of the market mutations
+#
+# A client may send an `Idempotency-Key` header with the routes of
+# IDEMPOTENT_ROUTES, and send the same key again when it retries after a
+# timeout. The first request claims the key in the `idempotency_keys` table,
+# runs, and stores its response there; the retries get that response replayed,
+# with an `Idempotent-Replayed: true` header, without running the route again.
+# A retry arriving while the first request is still running waits for it (on an
+# in-process event when both run on the same event loop, by polling the table
+# otherwise) for up to IDEMPOTENCY_WAIT_SECONDS, then gets a 409.
+# Keys are scoped by user and bound to a fingerprint of the request: a key sent
+# again with another method, path, query or body is refused with a 422.
+# Every answer below 500 is kept, refusals (4xx, raised as HTTPException) included:
+# when the route fails unexpectedly or answers a server error the key is
+# released, and the next retry runs the request again.
+
+import asyncio
+import hashlib
+import json
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Callable, Dict, Tuple
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import async_crud
+import authorizations
+import exceptions
+import metrics
+from core.config import settings
+from database import get_async_db
+
+IDEMPOTENCY_HEADER = 'idempotency-key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+
+# routes accepting an Idempotency-Key, as 'METHOD path'
+IDEMPOTENT_ROUTES = {
+    'GET /market/sell',
+    'GET /market/withdraw',
+    'GET /market/buy',
+    'POST /market/sell/batch',
+    'POST /market/withdraw/batch',
+    'POST /market/bids',
+    'DELETE /market/bids/{bid_id}',
+    'POST /market/auctions',
+    'POST /market/auctions/{auction_id}/bids',
+}
+
+# seconds between two reads of a key pending in another worker
+POLL_SECONDS = 0.05
+# keys claimed by this process between two purges of the expired keys
+PURGE_EVERY = 1000
+
+# requests running in this process, by (user id, key): (event loop, event set when done)
+_in_flight: Dict[Tuple[int, str], Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = {}
+_claims = 0
+
+
+def request_fingerprint(request: Request, body: bytes) -> str:
+    """
+    :return: hash of the method, path, query and body of the request
+    """
+    digest = hashlib.sha256()
+    for part in (request.method, request.url.path, str(sorted(request.query_params.multi_items()))):
+        digest.update(part.encode())
+        digest.update(b'\0')
+    digest.update(body)
+    return digest.hexdigest()
+
+
+@asynccontextmanager
+async def _session(request: Request) -> AsyncSession:
+    # the session of the routes, overrides included
+    dependency = request.app.dependency_overrides.get(get_async_db, get_async_db)
+    sessions = dependency()
+    try:
+        yield await sessions.__anext__()
+    finally:
+        await sessions.aclose()
+
+
+def _replay(record) -> Response:
+    response = Response(content=record.body, status_code=record.status_code, headers=json.loads(record.headers))
+    response.headers[REPLAYED_HEADER] = 'true'
+    return response
+
+
+async def _wait(scope: Tuple[int, str], timeout: float):
+    running = _in_flight.get(scope)
+    if running is not None and running[0] is asyncio.get_running_loop():
+        try:
+            await asyncio.wait_for(running[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    else:
+        await asyncio.sleep(min(POLL_SECONDS, timeout))
+
+
+async def _claim(request: Request, user_id: int, key: str, fingerprint: str):
+    """
+    :return: None once the key is claimed by this request, the stored response of the first one otherwise
+    """
+    global _claims
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        async with _session(request) as db:
+            record = await async_crud.claim_idempotency_key(db, user_id, key, fingerprint)
+            if record is None:
+                _claims += 1
+                if _claims % PURGE_EVERY == 0:
+                    await async_crud.purge_idempotency_keys(db, datetime.utcnow())
+                return None
+        if record.fingerprint != fingerprint:
+            raise exceptions.idempotency_key_reused()
+        if record.status == 'done':
+            return record
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise exceptions.idempotency_key_in_progress()
+        await _wait((user_id, key), remaining)
+
+
+async def run_idempotent(request: Request, key: str, handler: Callable, route: str) -> Response:
+    """
+    Runs the route handler once for a key: the first request runs it and stores its response,
+    the duplicates wait for it and get the stored response
+    :param route: path of the route, for the metrics
+    :raise HTTPException: invalid_idempotency_key, idempotency_key_reused,
+    idempotency_key_in_progress when the first request is still running after the wait;
+    HTTPException of the handler with a status of 500 or more, after releasing the key
+    """
+    if not 0 < len(key) <= MAX_KEY_LENGTH:
+        raise exceptions.invalid_idempotency_key()
+    identity = authorizations.CurrentIdentity(await authorizations.oauth2_bearer(request))
+    fingerprint = request_fingerprint(request, await request.body())
+    scope = (identity.user_id, key)
+    record = await _claim(request, identity.user_id, key, fingerprint)
+    if record is not None:
+        metrics.IDEMPOTENT_REPLAYS.inc(route)
+        return _replay(record)
+
+    done = asyncio.Event()
+    _in_flight[scope] = (asyncio.get_running_loop(), done)
+    try:
+        try:
+            response = await handler(request)
+        except HTTPException as exc:
+            if exc.status_code >= 500:
+                async with _session(request) as db:
+                    await async_crud.release_idempotency_key(db, identity.user_id, key)
+                raise
+            # a refused request is an answer as well: its retries get it replayed
+            response = JSONResponse({'detail': exc.detail}, status_code=exc.status_code, headers=exc.headers)
+        except BaseException:
+            async with _session(request) as db:
+                await async_crud.release_idempotency_key(db, identity.user_id, key)
+            raise
+        async with _session(request) as db:
+            if response.status_code >= 500:
+                await async_crud.release_idempotency_key(db, identity.user_id, key)
+            else:
+                headers = {
+                    name.decode('latin-1'): value.decode('latin-1') for name, value in response.raw_headers
+                    if name != b'content-length'
+                }
+                await async_crud.save_idempotent_response(
+                    db, identity.user_id, key, response.status_code, json.dumps(headers), response.body
+                )
+        return response
+    finally:
+        if _in_flight.get(scope, (None, None))[1] is done:
+            del _in_flight[scope]
+        done.set()
+
+
+class IdempotentRoute(APIRoute):
+    """
+    Route class of the routers with routes in IDEMPOTENT_ROUTES: requests of those routes
+    sent with an Idempotency-Key header are run once per key
+    """
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        if not any(f'{method} {self.path}' in IDEMPOTENT_ROUTES for method in self.methods):
+            return handler
+
+        async def idempotent_handler(request: Request) -> Response:
+            key = request.headers.get(IDEMPOTENCY_HEADER)
+            if key is None:
+                return await handler(request)
+            return await run_idempotent(request, key, handler, self.path)
+
+        return idempotent_handler
@@ -1,8 +1,14 @@
-from fastapi import FastAPI
-from database import engine
+from fastapi import FastAPI, Response
+from starlette.concurrency import run_in_threadpool
+from database import engine, async_engine
 from core.config import settings
 from routers import auth, market, players, team
-import models
+import migrations
+import authorizations
+import metrics
+import query_budget
+import sharding
+from auctions import auction_scheduler
 
 
 app = FastAPI(
@@ -11,9 +17,69 @@ app = FastAPI(
 )
 
 
-models.Base.metadata.create_all(bind=engine)
-
 app.include_router(auth.router)
 app.include_router(market.router)
 app.include_router(players.router)
 app.include_router(team.router)
+
+app.add_middleware(metrics.MetricsMiddleware)
+if settings.QUERY_DEBUG:
+    app.add_middleware(
+        query_budget.QueryBudgetMiddleware,
+        default_budget=settings.QUERY_BUDGET,
+        repeat_threshold=settings.QUERY_REPEAT_THRESHOLD
+    )
+metrics.instrument_engine(engine)
+metrics.instrument_engine(async_engine)
+if sharding.shards is not None:
+    for shard_engine in sharding.shards.engines + sharding.shards.async_engines:
+        metrics.instrument_engine(shard_engine)
+
+
+@app.get('/metrics', tags=['metrics'])
+async def metrics_endpoint():
+    """
+    Service metrics in the Prometheus text format: request latency, in flight requests,
+    database queries and time per request, pool checkout wait, bcrypt time, market cache counters
+    :return: metrics text
+    """
+    # the cache callbacks may query the cache backend
+    return Response(content=await run_in_threadpool(metrics.render), media_type=metrics.CONTENT_TYPE)
+
+
+@app.on_event('startup')
+def migrate_database():
+    # the schema is created by `python migrations.py`, not when the app is imported
+    if settings.DB_MIGRATE_ON_STARTUP:
+        migrations.upgrade(engine)
+        if sharding.shards is not None:
+            sharding.shards.upgrade()
+
+
+@app.on_event('startup')
+async def start_transfer_resumer():
+    # finishes the cross-shard transfers left reserved by a failed request or a crashed worker
+    if sharding.shards is not None:
+        sharding.transfer_resumer.start()
+
+
+@app.on_event('shutdown')
+async def stop_transfer_resumer():
+    await sharding.transfer_resumer.stop()
+
+
+@app.on_event('startup')
+async def start_auction_scheduler():
+    # settles the auctions as they end
+    if settings.AUCTION_SCHEDULER:
+        auction_scheduler.start()
+
+
+@app.on_event('shutdown')
+async def stop_auction_scheduler():
+    await auction_scheduler.stop()
+
+
+@app.on_event('shutdown')
+def shutdown_hash_executor():
+    authorizations.shutdown_hash_executor()
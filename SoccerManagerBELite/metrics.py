@@ -0,0 +1,282 @@
+# service metrics, in the Prometheus text format
+#
+# `MetricsMiddleware` times every request and labels it with the router (first
+# tag of the route), method and route path; `instrument_engine` hooks the
+# SQLAlchemy engine events to count the queries and their time, globally and for
+# the request being served, and times the connection pool checkouts.
+# Recording is a lock and a few additions per event, so it can stay on in production.
+
+import bisect
+import threading
+import time
+import weakref
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from cache import market_cache, team_cache
+from feed import market_feed
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+DB_TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs: Iterable[Tuple[str, str]]) -> str:
+    text = ','.join(f'{name}="{_escape(value)}"' for name, value in pairs)
+    return '{' + text + '}' if text else ''
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+# every metric, in creation order
+REGISTRY = []
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self) -> Iterable[Tuple[str, Iterable[Tuple[str, str]], float]]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield self.name, zip(self.labelnames, labels), value
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # count of each bucket, then sum
+                state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(state)) for labels, state in self._values.items()]
+        for labels, state in values:
+            pairs = list(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state):
+                cumulative += count
+                yield f'{self.name}_bucket', pairs + [('le', '+Inf' if bound == float('inf') else repr(bound))], \
+                    cumulative
+            yield f'{self.name}_sum', pairs, state[-1]
+            yield f'{self.name}_count', pairs, cumulative
+
+
+class CallbackMetric(Metric):
+    """
+    metric read from `function` when rendered, returning {label values: value}
+    """
+
+    def __init__(self, name: str, documentation: str, kind: str, function: Callable[[], Dict[Tuple, float]],
+                 labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self.function = function
+
+    def samples(self):
+        for labels, value in self.function().items():
+            yield self.name, zip(self.labelnames, labels), value
+
+
+REQUEST_LABELS = ('router', 'method', 'route')
+REQUESTS = Counter('http_requests_total', 'HTTP requests served', REQUEST_LABELS + ('status',))
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency', REQUEST_LABELS)
+REQUESTS_IN_FLIGHT = Gauge('http_requests_in_flight', 'HTTP requests being served')
+REQUEST_QUERIES = Histogram('http_request_db_queries', 'Database queries per HTTP request', REQUEST_LABELS,
+                            buckets=QUERY_BUCKETS)
+REQUEST_DB_TIME = Histogram('http_request_db_seconds', 'Database time per HTTP request', REQUEST_LABELS,
+                            buckets=DB_TIME_BUCKETS)
+DB_QUERIES = Counter('db_queries_total', 'Database statements executed')
+DB_QUERY_TIME = Histogram('db_query_duration_seconds', 'Database statement latency', buckets=DB_TIME_BUCKETS)
+DB_POOL_CHECKOUT = Histogram('db_pool_checkout_seconds', 'Wait for a connection from the pool',
+                             buckets=DB_TIME_BUCKETS)
+PASSWORD_HASH_TIME = Histogram('password_hash_seconds', 'bcrypt hashing and verification time, queue included',
+                               ('operation',))
+IDEMPOTENT_REPLAYS = Counter('idempotent_replays_total', 'Market mutations answered with a stored response',
+                             ('route',))
+AUCTIONS_SETTLED = Counter('auctions_settled_total', 'Auctions closed by the expiration scheduler', ('status',))
+CallbackMetric('market_cache_hits_total', 'Market listing pages served from the cache', 'counter',
+               lambda: {(): market_cache.hits})
+CallbackMetric('market_cache_misses_total', 'Market listing pages computed from the database', 'counter',
+               lambda: {(): market_cache.misses})
+CallbackMetric('market_cache_pages', 'Entries in the cache backend, all topics', 'gauge',
+               lambda: {(): market_cache.backend.size()})
+CallbackMetric('team_cache_hits_total', 'Team details and rosters served from the cache', 'counter',
+               lambda: {(): team_cache.hits})
+CallbackMetric('team_cache_misses_total', 'Team details and rosters read from the database', 'counter',
+               lambda: {(): team_cache.misses})
+CallbackMetric('market_feed_subscribers', 'Clients of the live market feed', 'gauge',
+               lambda: {(): len(market_feed)})
+CallbackMetric('market_feed_dropped_total', 'Market feed clients dropped for falling behind', 'counter',
+               lambda: {(): market_feed.dropped})
+
+
+def render() -> str:
+    """
+    :return: every metric, in the Prometheus text exposition format
+    """
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+class RequestStats:
+    __slots__ = ('queries', 'db_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+# stats of the request being served; sync routes run on copies of the request
+# context, so they update the same object
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar('request_stats', default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    DB_QUERIES.inc()
+    DB_QUERY_TIME.observe(elapsed)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += elapsed
+
+
+def _handle_error(exception_context):
+    starts = exception_context.connection.info.get('query_start') if exception_context.connection else None
+    if starts:
+        starts.pop()
+
+
+def _instrument_pool(pool):
+    connect = pool.connect
+
+    def timed_connect():
+        start = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            DB_POOL_CHECKOUT.observe(time.perf_counter() - start)
+    pool.connect = timed_connect
+
+
+_instrumented_engines = weakref.WeakSet()
+
+
+def instrument_engine(engine):
+    """
+    Counts and times the statements run on `engine`, and its pool checkouts
+    :param engine: Engine or AsyncEngine, instrumented once
+    """
+    if isinstance(engine, AsyncEngine):
+        engine = engine.sync_engine
+    if engine in _instrumented_engines:
+        return
+    _instrumented_engines.add(engine)
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+    # dispose() replaces the pool
+    event.listen(engine, 'engine_disposed', lambda disposed: _instrument_pool(disposed.pool))
+    _instrument_pool(engine.pool)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency, status, queries and database time of each request
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUESTS_IN_FLIGHT.dec()
+            _request_stats.reset(token)
+            # set by the router on the matched route
+            route = scope.get('route')
+            tags = getattr(route, 'tags', None)
+            labels = (str(tags[0]) if tags else '', scope['method'], getattr(route, 'path', 'unmatched'))
+            REQUESTS.inc(*labels, str(status))
+            REQUEST_LATENCY.observe(elapsed, *labels)
+            REQUEST_QUERIES.observe(stats.queries, *labels)
+            REQUEST_DB_TIME.observe(stats.db_time, *labels)
@@ -0,0 +1,87 @@
+"""
+Brings an existing database up to the current models: creates missing tables,
+columns and indexes, and fills the new columns. Safe to run repeatedly.
+
+    python migrations.py --database-url sqlite:///./soccermanager.db
+
+The shard databases of SHARD_URLS, if any, are upgraded as well.
+"""
+import argparse
+from sqlalchemy import inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn
+from core.config import settings
+from database import Base, SQLALCHEMY_DATABASE_URL, create_database_engine
+import crud
+import models  # noqa: F401, registers the tables on Base
+
+
+def add_missing_columns(engine: Engine, log=None):
+    """
+    Adds to the existing tables the columns declared in the models and missing from the database
+    :param engine: database engine
+    :param log: optional callable receiving progress messages
+    :return: (table, column) names of the added columns
+    """
+    inspector = inspect(engine)
+    added = []
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    if log:
+                        log(f'adding column {column.name} to {table.name}')
+                    ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {ddl}')
+                    added.append((table.name, column.name))
+    return added
+
+
+def upgrade(engine: Engine, log=None):
+    """
+    Creates the tables, columns and indexes missing from the database
+    :param engine: database engine
+    :param log: optional callable receiving progress messages
+    :return: names of the created indexes
+    """
+    added = add_missing_columns(engine, log)
+    if ('team', 'value') in added:
+        with Session(engine) as db:
+            crud.rebuild_team_values(db)
+    Base.metadata.create_all(bind=engine)
+    # the pooled SQLite connections may answer the index pragmas from the schema
+    # they read before create_all: the indexes are listed on new connections
+    engine.dispose()
+    inspector = inspect(engine)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                if log:
+                    log(f'creating index {index.name} on {table.name}')
+                index.create(bind=engine)
+                created.append(index.name)
+    if created and engine.dialect.name == 'sqlite':
+        # planner statistics, so that the new indexes get picked
+        with engine.begin() as conn:
+            conn.exec_driver_sql('ANALYZE')
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=SQLALCHEMY_DATABASE_URL)
+    args = parser.parse_args()
+    upgrade(create_database_engine(args.database_url), log=print)
+    for url in settings.SHARD_URLS:
+        print(f'shard {url}')
+        upgrade(create_database_engine(url), log=print)
+
+
+if __name__ == '__main__':
+    main()
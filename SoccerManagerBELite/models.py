@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Index, LargeBinary, true
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -19,6 +19,8 @@ class Team(Base):
     name = Column(String)
     country = Column(String)
     budget = Column(Integer)
+    # sum of the players values, kept up to date by every write moving players or changing their value
+    value = Column(Integer, nullable=False, default=0, server_default='0')
 
     user = relationship('User', back_populates='team')
     players = relationship('Player', back_populates='team')
@@ -32,9 +34,155 @@ class Player(Base):
     country = Column(String)
     role = Column(String)
     age = Column(Integer)
-    team_id = Column(Integer, ForeignKey("team.id"))
+    team_id = Column(Integer, ForeignKey("team.id"), index=True)
     value = Column(Integer)
     on_market = Column(Boolean)
     requested_value = Column(Integer)
 
     team = relationship('Team', back_populates='players')
+
+
+class Bid(Base):
+    """
+    Standing order of a team to buy a player, up to `max_price`: either the player
+    `player_id`, or any player of `role` within the optional age and country constraints.
+    The id gives the time priority among bids at the same price
+    """
+    __tablename__ = 'bids'
+    id = Column(Integer, primary_key=True, index=True)
+    team_id = Column(Integer, ForeignKey('team.id'), index=True, nullable=False)
+    player_id = Column(Integer, ForeignKey('players.id'), index=True)
+    role = Column(String)
+    min_age = Column(Integer)
+    max_age = Column(Integer)
+    country = Column(String)
+    max_price = Column(Integer, nullable=False)
+
+
+class Auction(Base):
+    """
+    Timed sale of a player: bids from `reserve_price` up raise `best_bid` until `ends_at`,
+    when the scheduler transfers the player to the best bidder (status 'sold') or closes
+    the auction without a sale ('unsold'). End times are naive UTC
+    """
+    __tablename__ = 'auctions'
+    id = Column(Integer, primary_key=True, index=True)
+    player_id = Column(Integer, ForeignKey('players.id'), index=True, nullable=False)
+    seller_team_id = Column(Integer, ForeignKey('team.id'), nullable=False)
+    reserve_price = Column(Integer, nullable=False)
+    ends_at = Column(DateTime, nullable=False)
+    best_bid = Column(Integer)
+    best_bidder_team_id = Column(Integer, ForeignKey('team.id'))
+    status = Column(String, nullable=False, default='open', server_default='open')
+
+
+class Transfer(Base):
+    """
+    Ledger of the sales, one row per transfer, written in the transaction of the sale and
+    never updated: price paid, value of the player before and after, teams and time.
+    `source` is 'market' (/market/buy), 'bid' (standing bid) or 'auction'.
+    The id gives the order of the transfers
+    """
+    __tablename__ = 'transfers'
+    id = Column(Integer, primary_key=True)
+    player_id = Column(Integer, ForeignKey('players.id'), nullable=False)
+    seller_team_id = Column(Integer, ForeignKey('team.id'), nullable=False)
+    buyer_team_id = Column(Integer, ForeignKey('team.id'), nullable=False)
+    price = Column(Integer, nullable=False)
+    old_value = Column(Integer, nullable=False)
+    new_value = Column(Integer, nullable=False)
+    source = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+
+class TeamTransferTotals(Base):
+    """
+    Rollup of the transfers ledger by team, updated with each transfer
+    """
+    __tablename__ = 'team_transfer_totals'
+    team_id = Column(Integer, ForeignKey('team.id'), primary_key=True)
+    spent = Column(Integer, nullable=False, default=0, server_default='0')
+    earned = Column(Integer, nullable=False, default=0, server_default='0')
+    bought = Column(Integer, nullable=False, default=0, server_default='0')
+    sold = Column(Integer, nullable=False, default=0, server_default='0')
+
+
+class IdempotencyKey(Base):
+    """
+    Outcome of a market mutation sent with an Idempotency-Key header, kept until `expires_at`
+    to be replayed to the retries of the request: 'pending' while the first request runs,
+    then 'done' with its status code, headers (json) and body. `fingerprint` hashes the
+    method, path, query and body, so that a key sent again with another request is refused
+    """
+    __tablename__ = 'idempotency_keys'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)
+    status = Column(String, nullable=False)
+    status_code = Column(Integer)
+    headers = Column(String)
+    body = Column(LargeBinary)
+    created_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class ShardTransfer(Base):
+    """
+    Step of a sale between teams of two shards, kept on both. On the seller shard the row is
+    'reserved' when the player is taken off the market, then 'done' once the seller is paid, or
+    'cancelled' when the player is listed again. On the buyer shard the row is the decision:
+    'received' when the buyer paid and got the player, 'cancelled' when it did not; being
+    written once under the transfer id, it tells a resumed transfer which way to finish
+    """
+    __tablename__ = 'shard_transfers'
+    id = Column(String, primary_key=True)
+    player_id = Column(Integer, nullable=False)
+    seller_team_id = Column(Integer, nullable=False)
+    buyer_team_id = Column(Integer, nullable=False)
+    price = Column(Integer, nullable=False)
+    old_value = Column(Integer, nullable=False)
+    new_value = Column(Integer, nullable=False)
+    status = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+
+# partial indexes covering only the players on the market list
+_on_market = {
+    'sqlite_where': Player.on_market == true(),
+    'postgresql_where': Player.on_market == true(),
+}
+
+# market listing, carrying every listed column so that the listing is
+# answered from the index alone
+Index(
+    'ix_players_market',
+    Player.id, Player.name, Player.surname, Player.country, Player.role, Player.age,
+    Player.value, Player.team_id, Player.requested_value, Player.on_market,
+    **_on_market
+)
+
+# keyset pagination of the market, one index per sort key and common filter:
+# pages are read with an index seek after the cursor position, whatever the depth
+Index('ix_players_market_price', Player.requested_value, Player.id, **_on_market)
+Index('ix_players_market_value', Player.value, Player.id, **_on_market)
+Index('ix_players_market_role_price', Player.role, Player.requested_value, Player.id, **_on_market)
+Index('ix_players_market_country_price', Player.country, Player.requested_value, Player.id, **_on_market)
+
+_open_auction = {
+    'sqlite_where': Auction.status == 'open',
+    'postgresql_where': Auction.status == 'open',
+}
+
+# expiration order of the open auctions, read by the scheduler
+Index('ix_auctions_open_ends_at', Auction.ends_at, Auction.id, **_open_auction)
+# a player is in one open auction at most
+Index('ux_auctions_open_player', Auction.player_id, unique=True, **_open_auction)
+
+# history of a player and transfers of a team, newest first, by keyset pagination on the id
+Index('ix_transfers_player', Transfer.player_id, Transfer.id)
+Index('ix_transfers_seller', Transfer.seller_team_id, Transfer.id)
+Index('ix_transfers_buyer', Transfer.buyer_team_id, Transfer.id)
+# purge of the expired idempotency keys
+Index('ix_idempotency_keys_expires_at', IdempotencyKey.expires_at)
+# cross-shard transfers left reserved, resumed after a crash
+Index('ix_shard_transfers_status', ShardTransfer.status, ShardTransfer.created_at)
@@ -0,0 +1,283 @@
+# in memory order book of the transfer market
+#
+# Asks are the listed players, at the asking price set through /market/sell.
+# Bids are standing orders of the teams, for one player or for any player of a
+# role within optional age and country constraints, up to a maximum price.
+# Both sides are heaps giving a deterministic price-time priority: the highest
+# bid first, then the oldest (lowest id); the cheapest ask first, then the first
+# listed. Heap entries are dropped lazily: an entry is skipped once the order it
+# was pushed for has been changed or removed.
+#
+# The book only mirrors the database: `crud` loads it, keeps the asks up to date
+# after each committed listing change, and executes the crossings through
+# `crud.acquire_player`. Orders crossing are taken out of the book before the
+# trade is attempted, so interleaved requests never execute the same order twice.
+#
+# Each worker has its own book. It records the versions of the `market` and
+# `orders` cache topics it was loaded at, and counts the bumps of its own
+# process (see cache.InvalidationBus): when the shared versions went further,
+# another worker listed players or placed bids, and the book is loaded again.
+
+import heapq
+import itertools
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class BookBid:
+    __slots__ = ('id', 'team_id', 'player_id', 'role', 'min_age', 'max_age', 'country', 'max_price')
+
+    def __init__(self, id: int, team_id: int, max_price: int, player_id: int = None, role: str = None,
+                 min_age: int = None, max_age: int = None, country: str = None):
+        self.id = id
+        self.team_id = team_id
+        self.max_price = max_price
+        self.player_id = player_id
+        self.role = role
+        self.min_age = min_age
+        self.max_age = max_age
+        self.country = country
+
+    @classmethod
+    def from_row(cls, bid) -> 'BookBid':
+        return cls(bid.id, bid.team_id, bid.max_price, bid.player_id, bid.role, bid.min_age, bid.max_age, bid.country)
+
+    @property
+    def key(self) -> Tuple[int, int]:
+        # heap order: highest price, then oldest
+        return -self.max_price, self.id
+
+    def accepts(self, ask: 'BookAsk') -> bool:
+        """
+        :return: True if the bid crosses the ask: price, target and constraints, from another team
+        """
+        if ask.price > self.max_price or ask.team_id == self.team_id:
+            return False
+        if self.player_id is not None:
+            return self.player_id == ask.player_id
+        return self.role == ask.role \
+            and (self.min_age is None or ask.age >= self.min_age) \
+            and (self.max_age is None or ask.age <= self.max_age) \
+            and (self.country is None or ask.country == self.country)
+
+
+class BookAsk:
+    __slots__ = ('player_id', 'team_id', 'price', 'role', 'age', 'country', 'seq')
+
+    def __init__(self, player_id: int, team_id: int, price: int, role: str, age: int, country: str, seq: int = 0):
+        self.player_id = player_id
+        self.team_id = team_id
+        self.price = price
+        self.role = role
+        self.age = age
+        self.country = country
+        self.seq = seq
+
+    @classmethod
+    def from_player(cls, player) -> Optional['BookAsk']:
+        """
+        :return: the ask of a player, None when it is not listed
+        """
+        if not player.on_market or player.requested_value is None:
+            return None
+        return cls(player.id, player.team_id, player.requested_value, player.role, player.age, player.country)
+
+    @property
+    def key(self) -> Tuple[int, int]:
+        # heap order: cheapest, then first listed
+        return self.price, self.seq
+
+
+class OrderBook:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """
+        Empties the book, to be loaded again from the database
+        """
+        with self._lock:
+            self.loaded = False
+            # topic versions the book was loaded at, and bumps published by this process since
+            self.versions: Dict[str, int] = {}
+            self._published: Dict[str, int] = defaultdict(int)
+            self.bids: Dict[int, BookBid] = {}
+            self.asks: Dict[int, BookAsk] = {}
+            # heaps of (key, id): bids by player id and by (role, country or None),
+            # asks by role and by (role, country), so that the country constraint
+            # selects a heap instead of filtering it
+            self._player_bids: Dict[int, List] = defaultdict(list)
+            self._role_bids: Dict[Tuple[str, Optional[str]], List] = defaultdict(list)
+            self._role_asks: Dict[Tuple[str, Optional[str]], List] = defaultdict(list)
+            self._seq = itertools.count()
+
+    def load(self, bids: Iterable[BookBid], asks: Iterable[BookAsk], versions: Dict[str, int] = None):
+        """
+        Replaces the content of the book
+        :param bids: standing bids
+        :param asks: listed players, in listing order
+        :param versions: versions of the topics of the orders, read before the bids and asks
+        """
+        self.clear()
+        with self._lock:
+            for bid in bids:
+                self._add_bid(bid)
+            for ask in asks:
+                self._set_ask(ask)
+            self.versions = dict(versions or {})
+            self.loaded = True
+
+    def published(self, topics: Iterable[str]):
+        """
+        Listener of the invalidation bus: counts the bumps of this process
+        """
+        with self._lock:
+            for topic in topics:
+                if topic in self.versions:
+                    self._published[topic] += 1
+
+    def changed_elsewhere(self, versions: Dict[str, int]) -> bool:
+        """
+        :param versions: current versions of the topics of the orders
+        :return: whether another process bumped them since the book was loaded
+        """
+        with self._lock:
+            return any(
+                version != self.versions.get(topic, version) + self._published[topic]
+                for topic, version in versions.items()
+            )
+
+    def _add_bid(self, bid: BookBid):
+        self.bids[bid.id] = bid
+        if bid.player_id is not None:
+            heap = self._player_bids[bid.player_id]
+        else:
+            heap = self._role_bids[bid.role, bid.country]
+        heapq.heappush(heap, (bid.key, bid.id))
+
+    def _set_ask(self, ask: BookAsk):
+        ask.seq = next(self._seq)
+        self.asks[ask.player_id] = ask
+        self._push_ask(ask)
+
+    def _push_ask(self, ask: BookAsk):
+        heapq.heappush(self._role_asks[ask.role, None], (ask.key, ask.player_id))
+        heapq.heappush(self._role_asks[ask.role, ask.country], (ask.key, ask.player_id))
+
+    def add_bid(self, bid: BookBid):
+        with self._lock:
+            if self.loaded:
+                self._add_bid(bid)
+
+    def remove_bid(self, bid_id: int) -> Optional[BookBid]:
+        with self._lock:
+            return self.bids.pop(bid_id, None)
+
+    def update_asks(self, asks: Iterable[Tuple[int, Optional[BookAsk]]]):
+        """
+        Mirrors committed listing changes
+        :param asks: (player id, its ask or None when the player is not listed anymore)
+        """
+        with self._lock:
+            if not self.loaded:
+                return
+            for player_id, ask in asks:
+                if ask is None:
+                    self.asks.pop(player_id, None)
+                else:
+                    current = self.asks.get(player_id)
+                    if current is None or (current.price, current.team_id, current.country) != \
+                            (ask.price, ask.team_id, ask.country):
+                        self._set_ask(ask)
+                    else:
+                        # same listing: keeps its time priority
+                        current.age = ask.age
+
+    def _valid_bid(self, entry) -> Optional[BookBid]:
+        bid = self.bids.get(entry[1])
+        return bid if bid is not None and bid.key == entry[0] else None
+
+    def _valid_ask(self, entry) -> Optional[BookAsk]:
+        ask = self.asks.get(entry[1])
+        return ask if ask is not None and ask.key == entry[0] else None
+
+    @staticmethod
+    def _first(heap: List, valid, in_price, accepts) -> Optional[object]:
+        """
+        First valid order of the heap, in priority order, accepted by `accepts`.
+        The scan stops at the first order out of price (`in_price` False): the next ones are worse.
+        Stale entries met on the way are discarded, the skipped valid ones are pushed back
+        """
+        skipped, found = [], None
+        while heap:
+            entry = heapq.heappop(heap)
+            order = valid(entry)
+            if order is None:
+                continue
+            skipped.append(entry)
+            if not in_price(order):
+                break
+            if accepts(order):
+                found = order
+                break
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return found
+
+    def _best_bid(self, ask: BookAsk) -> Optional[BookBid]:
+        candidates = [
+            self._first(heap, self._valid_bid, lambda bid: bid.max_price >= ask.price, lambda bid: bid.accepts(ask))
+            for heap in (
+                self._player_bids.get(ask.player_id),
+                self._role_bids.get((ask.role, None)),
+                self._role_bids.get((ask.role, ask.country)),
+            ) if heap
+        ]
+        candidates = [bid for bid in candidates if bid is not None]
+        return min(candidates, key=lambda bid: bid.key) if candidates else None
+
+    def _best_ask(self, bid: BookBid) -> Optional[BookAsk]:
+        if bid.player_id is not None:
+            ask = self.asks.get(bid.player_id)
+            return ask if ask is not None and bid.accepts(ask) else None
+        heap = self._role_asks.get((bid.role, bid.country))
+        return self._first(heap, self._valid_ask, lambda ask: ask.price <= bid.max_price, bid.accepts) \
+            if heap else None
+
+    def take_crossing(self, bid_id: int = None, player_id: int = None) -> Optional[Tuple[BookBid, BookAsk]]:
+        """
+        Best crossing of a bid (with the best ask it accepts) or of the ask of a player
+        (with the best bid accepting it). Both orders are taken out of the book: the caller
+        executes the trade, and puts back with `restore` the orders still standing if it fails
+        :return: (bid, ask), None when nothing crosses
+        """
+        with self._lock:
+            if bid_id is not None:
+                bid = self.bids.get(bid_id)
+                ask = self._best_ask(bid) if bid is not None else None
+            else:
+                ask = self.asks.get(player_id)
+                bid = self._best_bid(ask) if ask is not None else None
+            if bid is None or ask is None:
+                return None
+            del self.bids[bid.id]
+            del self.asks[ask.player_id]
+            return bid, ask
+
+    def restore(self, bid: BookBid = None, ask: BookAsk = None):
+        """
+        Puts back orders taken by `take_crossing`, with their original priority
+        """
+        with self._lock:
+            # the heap entries may have been discarded meanwhile: pushed again, duplicates are harmless
+            if bid is not None and bid.id not in self.bids:
+                self._add_bid(bid)
+            if ask is not None and ask.player_id not in self.asks:
+                self.asks[ask.player_id] = ask
+                self._push_ask(ask)
+
+
+order_book = OrderBook()
@@ -0,0 +1,63 @@
+# keyset pagination helpers
+#
+# A cursor is an opaque token carrying the sort key and the id of the last row
+# of a page: the next page starts right after it, through an index seek,
+# instead of skipping rows with OFFSET.
+
+import base64
+import binascii
+import json
+from typing import Dict, Optional, Tuple
+from starlette.requests import Request
+import exceptions
+
+
+# json types accepted for the sort key of a cursor, by sort: the ids are integers,
+# the prices (requested_value) and values are numbers
+CURSOR_KEY_TYPES = {
+    'id': (int,),
+    'price': (int, float),
+    'value': (int, float),
+}
+
+
+def encode_cursor(sort: str, order: str, key, row_id: int) -> str:
+    payload = json.dumps([sort, order, key, row_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: Optional[str], sort: str, order: str) -> Optional[Tuple]:
+    """
+    :param cursor: token returned with the previous page, if any
+    :param sort: sort requested for this page
+    :param order: order requested for this page
+    :raise HTTPException: malformed cursor, cursor issued for another sort, or sort key
+        of another type than the sort column
+    :return: (sort key, id) of the last row already served, None for the first page
+    """
+    if not cursor:
+        return None
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, cursor_order, key, row_id = json.loads(payload)
+    except (binascii.Error, ValueError, TypeError):
+        raise exceptions.invalid_cursor()
+    if (cursor_sort, cursor_order) != (sort, order) or not _is_a(row_id, (int,)) \
+            or not _is_a(key, CURSOR_KEY_TYPES.get(sort, (int, float))):
+        raise exceptions.invalid_cursor()
+    return key, row_id
+
+
+def _is_a(value, types: Tuple[type, ...]) -> bool:
+    # json true and false are bools, which are ints for isinstance
+    return isinstance(value, types) and not isinstance(value, bool)
+
+
+def next_page_headers(request: Request, next_cursor: str) -> Dict[str, str]:
+    """
+    :return: X-Next-Cursor and Link headers pointing to the page after `next_cursor`
+    """
+    return {
+        'X-Next-Cursor': next_cursor,
+        'Link': f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"',
+    }
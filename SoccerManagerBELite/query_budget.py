@@ -0,0 +1,159 @@
+# query budgets
+#
+# `QueryCounter` records the statements run on every engine while it is open,
+# so that tests can assert an upper bound on the queries of an endpoint.
+# `QueryBudgetMiddleware`, installed in debug mode, logs the requests running
+# more statements than their route budget, or the same statement shape many
+# times over (an N+1 pattern: one query per row of a previous result).
+
+import logging
+import re
+from collections import Counter
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# statements allowed per request, by method and route; asserted by the tests and
+# checked by the middleware in debug mode
+ROUTE_BUDGETS = {
+    ('POST', '/auth/register'): 3,
+    ('POST', '/auth/login'): 1,
+    ('GET', '/market/'): 1,
+    ('GET', '/market/sell'): 3,
+    ('GET', '/market/withdraw'): 2,
+    ('POST', '/market/sell/batch'): 3,
+    ('POST', '/market/withdraw/batch'): 2,
+    ('GET', '/market/buy'): 7,
+    ('POST', '/market/bids'): 2,
+    ('GET', '/market/bids'): 1,
+    ('DELETE', '/market/bids/{bid_id}'): 2,
+    ('POST', '/market/auctions'): 2,
+    ('GET', '/market/auctions'): 1,
+    ('POST', '/market/auctions/{auction_id}/bids'): 3,
+    ('GET', '/players/user'): 1,
+    ('GET', '/players/update'): 3,
+    ('GET', '/players/{player_id}/history'): 1,
+    ('GET', '/team/user'): 1,
+    ('GET', '/team/update'): 3,
+    ('GET', '/team/transfers'): 1,
+    ('GET', '/team/transfers/totals'): 1,
+}
+
+_IN_LIST = re.compile(r'\bIN \((?:\s*(?:\?|%\(\w+\)s|:\w+|\$\d+)\s*,?)+\)', re.IGNORECASE)
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SPACES = re.compile(r'\s+')
+
+
+def statement_shape(statement: str) -> str:
+    """
+    :param statement: SQL statement, as sent to the driver
+    :return: the statement with literals and expanded IN lists collapsed, so that the same
+    query run with different parameters has the same shape
+    """
+    shape = _IN_LIST.sub('IN (?)', statement)
+    shape = _LITERAL.sub('?', shape)
+    return _SPACES.sub(' ', shape).strip()
+
+
+class QueryCounter:
+    """
+    Statements run on any engine while the counter is open:
+
+        with QueryCounter() as queries:
+            client.get('/market/buy?player_id=1', headers=headers)
+        queries.assert_at_most(8)
+    """
+
+    def __init__(self):
+        self.statements: List[str] = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(Engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(Engine, 'before_cursor_execute', self._record)
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    def repeated(self, threshold: int = 2) -> List[Tuple[str, int]]:
+        """
+        :param threshold: minimum number of runs
+        :return: statement shapes run at least `threshold` times, with their count
+        """
+        return [(shape, n) for shape, n in Counter(map(statement_shape, self.statements)).most_common()
+                if n >= threshold]
+
+    def report(self) -> str:
+        return '\n'.join(f'{n} x {shape}' for shape, n in Counter(map(statement_shape, self.statements)).items())
+
+    def assert_at_most(self, budget: int):
+        """
+        :raise AssertionError: more than `budget` statements were run, listing them
+        """
+        assert self.count <= budget, f'{self.count} queries, budget {budget}:\n{self.report()}'
+
+    def assert_no_repeats(self, threshold: int = 2):
+        """
+        :raise AssertionError: a statement shape was run `threshold` times or more
+        """
+        repeated = self.repeated(threshold)
+        assert not repeated, 'repeated queries:\n' + '\n'.join(f'{n} x {shape}' for shape, n in repeated)
+
+
+# statements of the request being served, for the middleware
+_request_statements: ContextVar[Optional[List[str]]] = ContextVar('request_statements', default=None)
+
+
+def _record_request_statement(conn, cursor, statement, parameters, context, executemany):
+    statements = _request_statements.get()
+    if statements is not None:
+        statements.append(statement)
+
+
+class QueryBudgetMiddleware:
+    """
+    ASGI middleware logging a warning for the requests exceeding their query budget,
+    or repeating a statement shape `repeat_threshold` times or more
+    :param budgets: budget by (method, route path), ROUTE_BUDGETS by default
+    :param default_budget: budget of the other routes
+    :param repeat_threshold: runs of the same statement shape reported as a possible N+1
+    """
+
+    def __init__(self, app, budgets: Dict[Tuple[str, str], int] = None, default_budget: int = 10, repeat_threshold: int = 5):
+        self.app = app
+        self.budgets = ROUTE_BUDGETS if budgets is None else budgets
+        self.default_budget = default_budget
+        self.repeat_threshold = repeat_threshold
+        if not event.contains(Engine, 'before_cursor_execute', _record_request_statement):
+            event.listen(Engine, 'before_cursor_execute', _record_request_statement)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        statements = []
+        token = _request_statements.set(statements)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_statements.reset(token)
+            method, route = scope['method'], getattr(scope.get('route'), 'path', scope['path'])
+            self.check(f"{method} {route}", self.budgets.get((method, route), self.default_budget), statements)
+
+    def check(self, request: str, budget: int, statements: List[str]):
+        shapes = Counter(map(statement_shape, statements))
+        if len(statements) > budget:
+            logger.warning('%s ran %d queries, over its budget of %d', request, len(statements), budget)
+        for shape, n in shapes.items():
+            if n >= self.repeat_threshold:
+                logger.warning('%s ran %d times the same query, possible N+1: %s', request, n, shape)
@@ -1,15 +1,16 @@
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import IntegrityError
 from fastapi import APIRouter, Depends
 from fastapi.security import OAuth2PasswordRequestForm
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import jwt
 import exceptions
-import crud
+import async_crud
 import schemas
-from authorizations import SECRET_KEY, ALGORITHM
-from database import get_db
-from utils import generate_team, generate_players
+import sharding
+from authorizations import SECRET_KEY, ALGORITHM, get_password_hash_async, verify_password_async
+from database import get_async_db
 
 
 router = APIRouter(
@@ -19,7 +20,7 @@ router = APIRouter(
 
 
 @router.post("/login")
-async def login_token(data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login_token(data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
     """
     The function verify the user and password, and it returns a JWT token valid 30 minutes
     for authentication across the API
@@ -27,37 +28,52 @@ async def login_token(data: OAuth2PasswordRequestForm = Depends(), db: Session =
     :param db: the database session
     :return: json with 'msg' confirming validation and a 'token' object
     """
-    user = crud.authenticate_user(db, data.username, data.password)
-    if not user:
+    user, team = await async_crud.get_user_and_team(db, data.username)
+    if not user or not await verify_password_async(data.password, user.hashed_password):
         raise exceptions.user_exception()
-    token = create_access_token(user.username, timedelta(minutes=30))
+    # a sharded team has the id of its user, and is not in the users database
+    if sharding.shards is not None:
+        team_id = user.id
+    elif team is None:
+        # a user without a team cannot be authorized on the team routes
+        raise exceptions.user_exception()
+    else:
+        team_id = team.id
+    token = create_access_token(user.username, timedelta(minutes=30), user.id, team_id)
     return {'msg': f'User {data.username} validated', 'token': token}
 
 
 @router.post("/register")
-async def create_user(user: schemas.User, db: Session = Depends(get_db)):
+async def create_user(user: schemas.User, db: AsyncSession = Depends(get_async_db)):
     """
     endpoint to register users in the database
-    team is created, along with a standard set of players according to params
+    team is created, along with a standard set of players according to params,
+    all in one transaction. A taken username is refused by the database unique constraint.
+    When sharded, the team and players are created on the shard of the user
     :param user: username and password
     :param db: database session
     """
-    db_user = crud.get_user_by_username(db, username=user.username)
-    if db_user:
+    hashed_password = await get_password_hash_async(user.password)
+    try:
+        if sharding.shards is not None:
+            await sharding.register_user(db, user, hashed_password)
+        else:
+            await async_crud.register_user(db, user, hashed_password)
+    except IntegrityError:
         raise exceptions.user_exists()
-    new_user = crud.create_user(db, user)
-    team = generate_team(user=new_user)
-    new_team = crud.create_team(db, team)
-    players = generate_players(new_team)
-    crud.create_players(db, players)
     return {'msg': 'User and team successfully created'}
 
 
-def create_access_token(username: str, expires_by: Optional[timedelta] = None):
+def create_access_token(username: str, expires_by: Optional[timedelta] = None,
+                        user_id: int = None, team_id: int = None):
     """
     convenience function to create a JWT token from the username
+    the user and team ids are carried as claims, so that requests are authorized
+    without looking the user up (see authorizations.CurrentIdentity)
     :param username: database user email
     :param expires_by: validity of the token
+    :param user_id: database user id
+    :param team_id: database id of the user team
     :return: JWT token
     """
     if expires_by:
@@ -66,7 +82,8 @@ def create_access_token(username: str, expires_by: Optional[timedelta] = None):
         expire = datetime.utcnow() + timedelta(minutes=15)
     encode = {
         'sub': username,
+        'uid': user_id,
+        'tid': team_id,
         'exp': expire
     }
     return jwt.encode(encode, SECRET_KEY, algorithm=ALGORITHM)
-
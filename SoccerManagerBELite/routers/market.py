@@ -1,122 +1,464 @@
-from sqlalchemy.orm import Session
-from fastapi import Depends, APIRouter
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List
+from fastapi import Body, Depends, APIRouter, Query, Request, Response, WebSocket
+from fastapi.responses import StreamingResponse
 import exceptions
 import authorizations
+import async_crud
 import crud
+import export
+import feed
+import pagination
 import schemas
-from database import get_db
+import serializers
+import sharding
+from database import get_async_db
+from cache import market_cache
+from feed import market_feed
+from idempotency import IdempotentRoute
+from auctions import auction_scheduler
+from core.config import settings
+from sharding import ShardSessions, get_shard_sessions, get_team_async_db, single_database
 
 
 router = APIRouter(
     prefix='/market',
-    tags=['market']
+    tags=['market'],
+    route_class=IdempotentRoute
 )
 
+FEED_SNAPSHOT_KEY = 'feed:snapshot'
+
+
+def publish_trades(trades: List[schemas.Trade]):
+    for trade in trades:
+        publish_sale(trade.player_id, trade.price, trade.seller_team_id, trade.buyer_team_id)
+
+
+def publish_sale(player_id: int, price: int, seller_team_id: int, buyer_team_id: int):
+    market_feed.publish('sold', {
+        'player_id': player_id, 'price': price, 'seller_team_id': seller_team_id, 'buyer_team_id': buyer_team_id
+    })
+
 
 @router.get("/sell")
 async def sell_player(
         player_id: int,
         asking_price: int,
-        username: str = Depends(authorizations.get_username_from_token),
-        db: Session = Depends(get_db)
+        identity: authorizations.CurrentIdentity = Depends(),
+        db: AsyncSession = Depends(get_team_async_db)
         ):
     """
     API call to put a player on the market list.
-    The player is available for exchange at the requested price
+    The player is available for exchange at the requested price, and is sold at once
+    to the best standing bid reaching that price, if any.
     Subsequent call of this function on the same player update the price
     :param player_id: integer id of the player in the database
     :param asking_price: integer price, greater than 0
-    :param username: username extracted from the JWT
-    :param db: database session
-    :return: details of the player put on the market
+    :param identity: user and team identified by the JWT claims
+    :param db: session on the database of the user team
+    :return: details of the player put on the market, and the trade if it was sold
     """
-    user = crud.get_user_by_username(db, username)
-    if not user:
-        raise exceptions.user_exception()
-    player = crud.get_player_by_player_id(db, player_id)
+    player = await async_crud.get_player_by_player_id(db, player_id)
     if not player:
         raise exceptions.player_does_not_exist()
-    user_team = crud.get_team_by_user_id(db, user.id)
-    if player.team_id != user_team.id:
+    if player.team_id != identity.team_id:
         raise exceptions.player_unavailable()
     if asking_price <= 0:
         raise exceptions.invalid_price()
+    if await async_crud.get_open_auction(db, player_id):
+        raise exceptions.player_in_auction()
     if player.on_market:
         msg = 'player already on the market, updated price'
     else:
         msg = 'player put on the market'
-    db_player = crud.put_player_for_sale(db, player, asking_price)
-    return {'msg': msg, 'player': schemas.MarketPlayer.from_orm(db_player)}
+    db_player = await async_crud.put_player_for_sale(db, player, asking_price)
+    market_feed.publish('listed', schemas.MarketPlayer.from_orm(db_player).dict())
+    # standing bids are not available when sharded
+    trades = await async_crud.match_orders(db, player_id=player_id) if sharding.shards is None else []
+    if trades:
+        msg = 'player sold to a standing bid'
+        publish_trades(trades)
+    return {'msg': msg, 'player': schemas.MarketPlayer.from_orm(db_player), 'trades': trades}
 
 
 @router.get("/withdraw")
 async def withdraw_player(
         player_id: int,
-        username: str = Depends(authorizations.get_username_from_token),
-        db: Session = Depends(get_db)
+        identity: authorizations.CurrentIdentity = Depends(),
+        db: AsyncSession = Depends(get_team_async_db)
         ):
     """
     Withdraws the player on market list, and returns it to the player.
     The player would not be available for sale
     :param player_id: player id on the database
-    :param username: current user identified by JWT token
-    :param db: database session
+    :param identity: user and team identified by the JWT claims
+    :param db: session on the database of the user team
     :return: player details
     """
-    user = crud.get_user_by_username(db, username)
-    if not user:
-        raise exceptions.user_exception()
-    player = crud.get_player_by_player_id(db, player_id)
+    player = await async_crud.get_player_by_player_id(db, player_id)
     if not player:
         raise exceptions.player_does_not_exist()
-    user_team = crud.get_team_by_user_id(db, user.id)
-    if player.team_id != user_team.id:
+    if player.team_id != identity.team_id:
         raise exceptions.player_unavailable()
     if not player.on_market:
         raise exceptions.player_not_on_sale()
-    db_player = crud.remove_player_for_sale(db, player)
+    db_player = await async_crud.remove_player_for_sale(db, player)
+    market_feed.publish('withdrawn', {'player_id': player_id})
     msg = 'player withdrawn from market listing'
     return {'msg': msg, 'player': schemas.MarketPlayer.from_orm(db_player)}
 
 
+@router.post("/sell/batch", response_model=schemas.BatchResult)
+async def sell_players(
+        orders: List[schemas.SaleOrder] = Body(..., min_items=1, max_items=500),
+        identity: authorizations.CurrentIdentity = Depends(),
+        db: AsyncSession = Depends(get_team_async_db)
+        ):
+    """
+    Puts many players on the market list at once, each at its own asking price, in one transaction.
+    Each order is validated as in /market/sell: invalid orders are reported and skipped,
+    the valid ones are applied. Listed players crossing a standing bid are then sold
+    :param orders: list of player_id and asking_price
+    :param identity: user and team identified by the JWT claims
+    :param db: session on the database of the user team
+    :return: number of players listed, the result of each order and the trades
+    """
+    results = await async_crud.put_players_for_sale(
+        db, identity.team_id, [(order.player_id, order.asking_price) for order in orders]
+    )
+    trades = []
+    for result in results:
+        if result.ok:
+            market_feed.publish('listed', result.player.dict())
+    for result in results:
+        if result.ok and sharding.shards is None:
+            trades.extend(await async_crud.match_orders(db, player_id=result.player_id))
+    publish_trades(trades)
+    listed = sum(result.ok for result in results)
+    return {'msg': f'{listed} of {len(results)} players put on the market', 'results': results, 'trades': trades}
+
+
+@router.post("/withdraw/batch", response_model=schemas.BatchResult)
+async def withdraw_players(
+        player_ids: List[int] = Body(..., min_items=1, max_items=500),
+        identity: authorizations.CurrentIdentity = Depends(),
+        db: AsyncSession = Depends(get_team_async_db)
+        ):
+    """
+    Withdraws many players from the market list at once, in one transaction.
+    Each player is validated as in /market/withdraw: invalid ones are reported and skipped
+    :param player_ids: list of player ids
+    :param identity: user and team identified by the JWT claims
+    :param db: session on the database of the user team
+    :return: number of players withdrawn, and the result of each withdrawal
+    """
+    results = await async_crud.remove_players_for_sale(db, identity.team_id, player_ids)
+    for result in results:
+        if result.ok:
+            market_feed.publish('withdrawn', {'player_id': result.player_id})
+    withdrawn = sum(result.ok for result in results)
+    return {'msg': f'{withdrawn} of {len(results)} players withdrawn from market listing', 'results': results}
+
+
 @router.get("/buy")
 async def buy_player(
         player_id: int,
-        username: str = Depends(authorizations.get_username_from_token),
-        db: Session = Depends(get_db)
+        identity: authorizations.CurrentIdentity = Depends(),
+        sessions: ShardSessions = Depends(get_shard_sessions)
         ):
     """
     Acquire the player from the market at the requested price.
     The transaction happens if the user has enough money to buy it, and gets it on its team
-    The player is not on the market anymore, and its value is updated
+    The player is not on the market anymore, and its value is updated.
+    Concurrent buyers of the same player are safe: only one of them gets it.
+    A player of a team on another shard is bought with sharding.transfer_player
     :param player_id: exchanged player id
-    :param username: the user identified by the JWT token
-    :param db: database session
+    :param identity: user and team identified by the JWT claims
+    :param sessions: database sessions, on the shards when sharded
     :return: player details
     """
-    user = crud.get_user_by_username(db, username)
-    if not user:
-        raise exceptions.user_exception()
-    player = crud.get_player_by_player_id(db, player_id)
+    db = sessions.for_team(identity.team_id)
+    player, seller_db = await sharding.find_player(sessions, player_id)
     if not player:
         raise exceptions.player_does_not_exist()
-    user_team = crud.get_team_by_user_id(db, user.id)
-    if player.team_id == user_team.id:
+    if player.team_id == identity.team_id:
         raise exceptions.player_already_yours()
+    if not player.on_market:
+        raise exceptions.player_not_on_sale()
+    user_team = await identity.load_async(db)
     if player.requested_value > user_team.budget:
         raise exceptions.insufficient_funds()
-    db_player = crud.acquire_player(db, player, user_team)
+    price, seller_team_id = player.requested_value, player.team_id
+    if seller_db is db:
+        db_player = await async_crud.acquire_player(db, player, user_team)
+    else:
+        db_player = await sharding.transfer_player(seller_db, db, player, user_team)
+    publish_sale(player_id, price, seller_team_id, user_team.id)
     msg = 'player acquired'
     return {'msg': msg, 'player': schemas.MarketPlayer.from_orm(db_player)}
 
 
-@router.get("/")
-async def market_list(db: Session = Depends(get_db)):
+@router.post("/bids", dependencies=[Depends(single_database)])
+async def place_bid(
+        order: schemas.BidOrder,
+        identity: authorizations.CurrentIdentity = Depends(),
+        db: AsyncSession = Depends(get_async_db)
+        ):
+    """
+    Places a standing bid: the team buys, up to `max_price`, either the player `player_id`,
+    or any player of `role` aged between `min_age` and `max_age` and from `country` (all optional).
+    The bid is matched at once with the cheapest listed player it accepts, else it waits for
+    a listing crossing it. Bids are served by price, then by time; trades are made at the asking price
+    and fill the bid
+    :param order: bid target and maximum price
+    :param identity: user and team identified by the JWT claims
+    :param db: database session
+    :return: the bid, and the trade if it was filled
+    """
+    if (order.player_id is None) == (order.role is None):
+        raise exceptions.invalid_bid()
+    if order.max_price <= 0:
+        raise exceptions.invalid_price()
+    if order.player_id is not None:
+        player = await async_crud.get_player_by_player_id(db, order.player_id)
+        if not player:
+            raise exceptions.player_does_not_exist()
+        if player.team_id == identity.team_id:
+            raise exceptions.player_already_yours()
+    bid, trades = await async_crud.place_bid(db, identity.team_id, order)
+    publish_trades(trades)
+    msg = 'bid filled' if trades else 'bid placed'
+    return {'msg': msg, 'bid': bid, 'trades': trades}
+
+
+@router.get("/bids", response_model=List[schemas.Bid], dependencies=[Depends(single_database)])
+async def team_bids(
+        identity: authorizations.CurrentIdentity = Depends(),
+        db: AsyncSession = Depends(get_async_db)
+        ):
+    """
+    Standing bids of the user team
+    :param identity: user and team identified by the JWT claims
+    :param db: database session
+    :return: list of bids, oldest first
+    """
+    return await async_crud.get_team_bids(db, identity.team_id)
+
+
+@router.delete("/bids/{bid_id}", dependencies=[Depends(single_database)])
+async def cancel_bid(
+        bid_id: int,
+        identity: authorizations.CurrentIdentity = Depends(),
+        db: AsyncSession = Depends(get_async_db)
+        ):
+    """
+    Cancels a standing bid of the user team
+    :param bid_id: bid id
+    :param identity: user and team identified by the JWT claims
+    :param db: database session
+    :return: the cancelled bid
+    """
+    bid = await async_crud.cancel_bid(db, identity.team_id, bid_id)
+    return {'msg': 'bid cancelled', 'bid': bid}
+
+
+@router.post("/auctions", dependencies=[Depends(single_database)])
+async def start_auction(
+        order: schemas.AuctionOrder,
+        identity: authorizations.CurrentIdentity = Depends(),
+        db: AsyncSession = Depends(get_async_db)
+        ):
+    """
+    Puts a player of the user team up for auction for `duration` seconds. Bids from the
+    reserve price up are accepted until the end; then the player is transferred to the best
+    bidder at the bid price, as in /market/buy, or stays with the team when nobody bid or the
+    best bidder cannot pay anymore. A player is either on the market list or in an auction
+    :param order: player, reserve price and duration in seconds
+    :param identity: user and team identified by the JWT claims
+    :param db: database session
+    :return: the auction
+    """
+    player = await async_crud.get_player_by_player_id(db, order.player_id)
+    if not player:
+        raise exceptions.player_does_not_exist()
+    if player.team_id != identity.team_id:
+        raise exceptions.player_unavailable()
+    if player.on_market:
+        raise exceptions.player_on_market()
+    if order.reserve_price <= 0:
+        raise exceptions.invalid_price()
+    if not settings.AUCTION_MIN_DURATION <= order.duration <= settings.AUCTION_MAX_DURATION:
+        raise exceptions.invalid_auction_duration()
+    auction = await async_crud.start_auction(db, player, order.reserve_price, order.duration)
+    auction_scheduler.schedule(auction.id, auction.ends_at)
+    return {'msg': 'auction started', 'auction': auction}
+
+
+@router.get("/auctions", response_model=List[schemas.Auction], dependencies=[Depends(single_database)])
+async def open_auctions(
+        limit: int = Query(100, ge=1, le=500),
+        db: AsyncSession = Depends(get_async_db)
+        ):
+    """
+    Open auctions, the first ending first
+    :param limit: number of auctions
+    :param db: database session
+    :return: list of auctions, with their best bid
+    """
+    return await async_crud.get_open_auctions(db, limit)
+
+
+@router.post("/auctions/{auction_id}/bids", dependencies=[Depends(single_database)])
+async def bid_on_auction(
+        auction_id: int,
+        amount: int,
+        identity: authorizations.CurrentIdentity = Depends(),
+        db: AsyncSession = Depends(get_async_db)
+        ):
+    """
+    Bids on an open auction: the bid must reach the reserve price and exceed the best bid,
+    and the team must afford it. The best bid at the end wins the player
+    :param auction_id: auction id
+    :param amount: integer bid
+    :param identity: user and team identified by the JWT claims
+    :param db: database session
+    :return: the auction, with the bid as best bid
+    """
+    team = await identity.load_async(db)
+    auction = await async_crud.place_auction_bid(db, auction_id, team, amount)
+    return {'msg': 'bid accepted', 'auction': auction}
+
+
+async def feed_snapshot(sessions: ShardSessions) -> bytes:
+    """
+    Market listing sent to the new feed clients, by player id, cached until the market changes.
+    The sessions are closed afterwards: the feed connections do not hold database connections
     """
-    List of all the players available on the market, with stats, team and price
+    page = await market_cache.get_async(FEED_SNAPSHOT_KEY)
+    if page is None:
+        version = await market_cache.version_async()
+        rows = await sharding.get_market_rows(sessions, None, 'id', 'asc', None, settings.FEED_SNAPSHOT_LIMIT)
+        page = await market_cache.put_async(FEED_SNAPSHOT_KEY, version, serializers.encode_players(rows))
+    for db in sessions.all():
+        await db.close()
+    return page.body
+
+
+@router.get("/feed")
+async def market_feed_events(sessions: ShardSessions = Depends(get_shard_sessions)):
+    """
+    Live market feed, as Server-Sent Events: a `snapshot` of the market list (first players by id,
+    as in /market/), then a `listed`, `withdrawn` or `sold` event for each change. Events carry
+    increasing ids; the ones following the snapshot may already be part of it. A client falling
+    too far behind gets a `dropped` event and the stream ends
+    :param sessions: database sessions, for the snapshot
+    :return: stream of events
+    """
+    subscriber = market_feed.subscribe()
+    try:
+        snapshot = feed.snapshot_message(market_feed.seq, await feed_snapshot(sessions))
+    except Exception:
+        market_feed.unsubscribe(subscriber)
+        raise
+    return StreamingResponse(
+        feed.sse_stream(market_feed, subscriber, snapshot), media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache'}
+    )
+
+
+@router.websocket("/feed/ws")
+async def market_feed_websocket(websocket: WebSocket, sessions: ShardSessions = Depends(get_shard_sessions)):
+    """
+    Live market feed over a WebSocket: the same snapshot and events as /market/feed, as json
+    messages with `seq`, `type` and `data`. A client falling too far behind is disconnected
+    with code 1013
+    :param websocket: connection
+    :param sessions: database sessions, for the snapshot
+    """
+    await websocket.accept()
+    subscriber = market_feed.subscribe()
+    try:
+        snapshot = feed.snapshot_message(market_feed.seq, await feed_snapshot(sessions))
+    except Exception:
+        market_feed.unsubscribe(subscriber)
+        raise
+    await feed.websocket_stream(market_feed, subscriber, websocket, snapshot)
+
+
+@router.get("/export", dependencies=[Depends(single_database)])
+async def market_export(
+        export_format: schemas.ExportFormat = Query(schemas.ExportFormat.ndjson, alias='format'),
+        filters: schemas.MarketFilter = Depends(),
+        db: AsyncSession = Depends(get_async_db)
+        ):
+    """
+    Streams the whole market list, by player id, as NDJSON or CSV. Rows are written as they are
+    read from the database, so memory use does not grow with the size of the market
+    :param export_format: 'ndjson' (default) or 'csv', as the `format` query key
+    :param filters: same optional filters as the market list
     :param db: database session
+    :return: streamed players, with stats, team and price
+    """
+    result = await async_crud.stream_market_export(db, filters)
+    encoder = export.RowEncoder(result.keys(), export_format.value)
+    return StreamingResponse(export.aencode_rows(result, encoder), media_type=export.MEDIA_TYPES[export_format.value])
+
+
+@router.get("/cache")
+async def market_cache_stats():
+    """
+    Hit and miss counters of the market listing cache
+    :return: hits and misses of this worker, entries of the cache backend, version of the market topic
+    """
+    return await market_cache.stats_async()
+
+
+@router.get("/")
+async def market_list(
+        request: Request,
+        filters: schemas.MarketFilter = Depends(),
+        sort: schemas.MarketSort = schemas.MarketSort.id,
+        order: schemas.SortOrder = schemas.SortOrder.asc,
+        cursor: str = None,
+        limit: int = Query(100, ge=1, le=500),
+        sessions: ShardSessions = Depends(get_shard_sessions)
+        ):
+    """
+    List of the players available on the market, with stats, team and price, a page at a time.
+    When more players are available, the cursor of the next page is returned in the
+    X-Next-Cursor header (and a Link header), to be sent back as `cursor` with the same sort and filters.
+    Pages are served from a cache until the market changes; they carry an ETag, and a request
+    with a matching If-None-Match header gets an empty 304 response
+    :param request: incoming request
+    :param filters: optional role, country, age range (min_age, max_age) and asking price range
+    (min_price, max_price)
+    :param sort: 'id', 'price' (asking price) or 'value'
+    :param order: 'asc' or 'desc'
+    :param cursor: position returned with the previous page
+    :param limit: page size
+    :param sessions: database sessions, on every shard when sharded
     :return: list of the players
     """
-    db_market_players = crud.get_players_on_market(db)
-    market_players = [schemas.DBPlayer.from_orm(player) for player in db_market_players]
-    return market_players
+    key = str(sorted(request.query_params.multi_items()))
+    page = await market_cache.get_async(key)
+    cache_status = 'HIT'
+    if page is None:
+        cache_status = 'MISS'
+        version = await market_cache.version_async()
+        after = pagination.decode_cursor(cursor, sort.value, order.value)
+        rows = await sharding.get_market_rows(sessions, filters, sort.value, order.value, after, limit + 1)
+        headers = {}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = pagination.encode_cursor(
+                sort.value, order.value, getattr(last, crud.MARKET_SORT_COLUMNS[sort.value].key), last.id
+            )
+            headers = pagination.next_page_headers(request, next_cursor)
+        page = await market_cache.put_async(key, version, serializers.encode_players(rows), headers)
+    headers = dict(page.headers, ETag=page.etag)
+    headers['X-Cache'] = cache_status
+    if request.headers.get('if-none-match') == page.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=page.body, media_type='application/json', headers=headers)
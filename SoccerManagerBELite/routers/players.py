@@ -1,11 +1,19 @@
 from fastapi import APIRouter
 from sqlalchemy.orm import Session
 from database import get_db
-from fastapi import Depends
+from fastapi import Depends, Query, Request, Response
+from typing import List
+from fastapi.responses import StreamingResponse
 import exceptions
 import authorizations
 import crud
+import export
+import pagination
 import schemas
+import serializers
+from cache import team_cache, team_topic
+from feed import market_feed
+from sharding import get_team_db, single_database
 
 
 router = APIRouter(
@@ -18,47 +26,97 @@ router = APIRouter(
 def get_update_players(
         player_id: int,
         player_name: str = None, player_surname: str = None, player_country: str = None,
-        username: str = Depends(authorizations.get_username_from_token),
-        db: Session = Depends(get_db)
+        identity: authorizations.CurrentIdentity = Depends(),
+        db: Session = Depends(get_team_db)
         ):
     """
     API to update the updatable values of a player: name, surname and country, accessible as
     query with the stated keyword. ALl optional
     Nothing happens if no query is present, all other keys are ignored
-    Player can be updated only by its user
+    Player can be updated only by its user. A listed player is sent again to the market feed
     :param player_id: player id as from players database
     :param player_name: query key for the new name
     :param player_surname: query key for the new surname
     :param player_country: query key for the new country
-    :param username: user that owns the player, identify by JWT token
-    :param db: database session
+    :param identity: user and team identified by the JWT claims
+    :param db: session on the database of the user team
     :return: updated player stats
     """
-    user = crud.get_user_by_username(db, username)
-    if not user:
-        raise exceptions.user_exception()
     player = crud.get_player_by_player_id(db, player_id)
     if not player:
         raise exceptions.player_does_not_exist()
-    user_team = crud.get_team_by_user_id(db, user.id)
-    if player.team_id != user_team.id:
+    if player.team_id != identity.team_id:
         raise exceptions.player_unavailable()
     updated_player = crud.update_player(db, player, player_name, player_surname, player_country)
+    if updated_player.on_market:
+        market_feed.publish('listed', schemas.MarketPlayer.from_orm(updated_player).dict())
     return schemas.DBPlayer.from_orm(updated_player)
 
 
 @router.get("/user")
-def get_players_list(username: str = Depends(authorizations.get_username_from_token), db: Session = Depends(get_db)):
+def get_players_list(identity: authorizations.CurrentIdentity = Depends(), db: Session = Depends(get_team_db)):
     """
-    Lists all the player that belong to the logged user, identified by JWT
-    :param username: user identified
-    :param db: database session
+    Lists all the player that belong to the logged user, identified by JWT.
+    Served from the cache until the team changes
+    :param identity: user and team identified by the JWT claims
+    :param db: session on the database of the user team
     :return: list of players that belong to the user team
     """
-    user = crud.get_user_by_username(db, username)
-    if not user:
-        raise exceptions.user_exception()
-    team = crud.get_team_by_user_id(db, user.id)
-    db_players = crud.get_players_by_team_id(db, team.id)
-    players = [schemas.DBPlayer.from_orm(player) for player in db_players]
-    return players
+    topic = team_topic(identity.team_id)
+    page = team_cache.get('players', topic)
+    cache_status = 'HIT'
+    if page is None:
+        cache_status = 'MISS'
+        version = team_cache.version_of(topic)
+        rows = crud.get_team_player_rows(db, identity.team_id)
+        page = team_cache.put('players', version, serializers.encode_players(rows), topic=topic)
+    return Response(content=page.body, media_type='application/json', headers={'X-Cache': cache_status})
+
+
+@router.get("/user/export")
+def get_players_export(
+        export_format: schemas.ExportFormat = Query(schemas.ExportFormat.ndjson, alias='format'),
+        identity: authorizations.CurrentIdentity = Depends(),
+        db: Session = Depends(get_team_db)
+        ):
+    """
+    Streams the players of the logged user team, by player id, as NDJSON or CSV
+    :param export_format: 'ndjson' (default) or 'csv', as the `format` query key
+    :param identity: user and team identified by the JWT claims
+    :param db: session on the database of the user team
+    :return: streamed players of the user team
+    """
+    result = crud.export_team_players(db, identity.team_id)
+    encoder = export.RowEncoder(result.keys(), export_format.value)
+    return StreamingResponse(export.encode_rows(result, encoder), media_type=export.MEDIA_TYPES[export_format.value])
+
+
+@router.get("/{player_id}/history", response_model=List[schemas.Transfer],
+            dependencies=[Depends(single_database)])
+def get_player_history(
+        player_id: int,
+        request: Request,
+        response: Response,
+        cursor: str = None,
+        limit: int = Query(50, ge=1, le=500),
+        db: Session = Depends(get_db)
+        ):
+    """
+    Transfers of a player, newest first, a page at a time: price, values before and after,
+    teams and time. When older transfers are available, the cursor of the next page is returned
+    in the X-Next-Cursor header (and a Link header)
+    :param player_id: player id as from players database
+    :param request: incoming request
+    :param response: response, carrying the pagination headers
+    :param cursor: position returned with the previous page
+    :param limit: page size
+    :param db: database session
+    :return: list of transfers
+    """
+    after = pagination.decode_cursor(cursor, 'id', 'desc')
+    transfers = crud.get_player_transfers(db, player_id, after[1] if after else None, limit + 1)
+    if len(transfers) > limit:
+        transfers = transfers[:limit]
+        next_cursor = pagination.encode_cursor('id', 'desc', transfers[-1].id, transfers[-1].id)
+        response.headers.update(pagination.next_page_headers(request, next_cursor))
+    return transfers
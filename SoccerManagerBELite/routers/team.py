@@ -1,11 +1,14 @@
 from fastapi import APIRouter
 from sqlalchemy.orm import Session
-from database import get_db
-from fastapi import Depends
-import exceptions
+from fastapi import Depends, Query, Request, Response
+from typing import List
 import authorizations
 import crud
+import pagination
 import schemas
+import serializers
+from cache import team_cache, team_topic
+from sharding import get_team_db
 
 
 router = APIRouter(
@@ -15,43 +18,80 @@ router = APIRouter(
 
 
 @router.get("/user")
-def get_team_details(username: str = Depends(authorizations.get_username_from_token), db: Session = Depends(get_db)):
+def get_team_details(identity: authorizations.CurrentIdentity = Depends(), db: Session = Depends(get_team_db)):
     """
-    lists the team stats, team of the user logged in
-    :param username: team's owner, identified by the JWT token
-    :param db: database session
+    lists the team stats, team of the user logged in.
+    Served from the cache until the team changes
+    :param identity: user and team identified by the JWT claims
+    :param db: session on the database of the user team
     :return: team details from database
     """
-    user = crud.get_user_by_username(db, username)
-    if not user:
-        raise exceptions.user_exception()
-    team = crud.get_team_by_user_id(db, user.id)
-    team_value = crud.get_team_value(db, team)
-    team_dict = schemas.Team.from_orm(team).dict()
-    team_dict.update({'value': team_value})
-    return team_dict
+    topic = team_topic(identity.team_id)
+    page = team_cache.get('details', topic)
+    cache_status = 'HIT'
+    if page is None:
+        cache_status = 'MISS'
+        version = team_cache.version_of(topic)
+        team = identity.load(db)
+        page = team_cache.put('details', version, serializers.dumps(schemas.Team.from_orm(team).dict()), topic=topic)
+    return Response(content=page.body, media_type='application/json', headers={'X-Cache': cache_status})
 
 
 @router.get("/update")
 def update_team_details(
         team_name: str = None, team_country: str = None,
-        username: str = Depends(authorizations.get_username_from_token),
-        db: Session = Depends(get_db)
+        identity: authorizations.CurrentIdentity = Depends(),
+        db: Session = Depends(get_team_db)
         ):
     """
     Updates the team variable available for update: its name and country.
     Only the owner can update its team
     :param team_name: the desired name
     :param team_country: the desired country
-    :param username: logged user identified by JWT
-    :param db: database session
+    :param identity: user and team identified by the JWT claims
+    :param db: session on the database of the user team
     """
-    user = crud.get_user_by_username(db, username)
-    if not user:
-        raise exceptions.user_exception()
-    team = crud.get_team_by_user_id(db, user.id)
+    team = identity.load(db)
     db_updated_team = crud.update_team(db, team, team_name, team_country)
-    team_value = crud.get_team_value(db, db_updated_team)
-    team_dict = schemas.Team.from_orm(team).dict()
-    team_dict.update({'value': team_value})
-    return team_dict
+    return schemas.Team.from_orm(db_updated_team)
+
+
+@router.get("/transfers", response_model=List[schemas.Transfer])
+def get_team_transfers(
+        request: Request,
+        response: Response,
+        cursor: str = None,
+        limit: int = Query(50, ge=1, le=500),
+        identity: authorizations.CurrentIdentity = Depends(),
+        db: Session = Depends(get_team_db)
+        ):
+    """
+    Players sold and bought by the team of the user logged in, newest first, a page at a time.
+    When older transfers are available, the cursor of the next page is returned in the
+    X-Next-Cursor header (and a Link header)
+    :param request: incoming request
+    :param response: response, carrying the pagination headers
+    :param cursor: position returned with the previous page
+    :param limit: page size
+    :param identity: user and team identified by the JWT claims
+    :param db: session on the database of the user team
+    :return: list of transfers
+    """
+    after = pagination.decode_cursor(cursor, 'id', 'desc')
+    transfers = crud.get_team_transfers(db, identity.team_id, after[1] if after else None, limit + 1)
+    if len(transfers) > limit:
+        transfers = transfers[:limit]
+        next_cursor = pagination.encode_cursor('id', 'desc', transfers[-1].id, transfers[-1].id)
+        response.headers.update(pagination.next_page_headers(request, next_cursor))
+    return transfers
+
+
+@router.get("/transfers/totals", response_model=schemas.TransferTotals)
+def get_team_transfer_totals(identity: authorizations.CurrentIdentity = Depends(), db: Session = Depends(get_team_db)):
+    """
+    Money spent and earned, players bought and sold by the team of the user logged in, over all its transfers
+    :param identity: user and team identified by the JWT claims
+    :param db: session on the database of the user team
+    :return: transfer totals
+    """
+    return crud.get_transfer_totals(db, identity.team_id)
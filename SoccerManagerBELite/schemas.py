@@ -1,5 +1,7 @@
+from datetime import datetime
 from pydantic import BaseModel, EmailStr
-from typing import Optional
+from typing import List, Optional
+from enum import Enum
 from params import Role
 
 
@@ -53,3 +55,118 @@ class MarketPlayer(Player):
 
     class Config:
         orm_mode = True
+
+
+class MarketFilter(BaseModel):
+    role: Optional[Role]
+    country: Optional[str]
+    min_age: Optional[int]
+    max_age: Optional[int]
+    min_price: Optional[int]
+    max_price: Optional[int]
+
+
+class MarketSort(str, Enum):
+    id = 'id'
+    price = 'price'
+    value = 'value'
+
+
+class ExportFormat(str, Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
+class SortOrder(str, Enum):
+    asc = 'asc'
+    desc = 'desc'
+
+
+class SaleOrder(BaseModel):
+    player_id: int
+    asking_price: int
+
+
+class BatchItemResult(BaseModel):
+    player_id: int
+    ok: bool
+    msg: str
+    player: Optional[MarketPlayer]
+
+
+class Trade(BaseModel):
+    bid_id: int
+    player_id: int
+    price: int
+    seller_team_id: int
+    buyer_team_id: int
+
+
+class BatchResult(BaseModel):
+    msg: str
+    results: List[BatchItemResult]
+    trades: List[Trade] = []
+
+
+class BidOrder(BaseModel):
+    player_id: Optional[int]
+    role: Optional[Role]
+    min_age: Optional[int]
+    max_age: Optional[int]
+    country: Optional[str]
+    max_price: int
+
+
+class Bid(BidOrder):
+    id: int
+    team_id: int
+
+    class Config:
+        orm_mode = True
+
+
+class AuctionOrder(BaseModel):
+    player_id: int
+    reserve_price: int
+    # seconds until the auction ends
+    duration: int
+
+
+class Auction(BaseModel):
+    id: int
+    player_id: int
+    seller_team_id: int
+    reserve_price: int
+    ends_at: datetime
+    best_bid: Optional[int]
+    best_bidder_team_id: Optional[int]
+    status: str
+
+    class Config:
+        orm_mode = True
+
+
+class Transfer(BaseModel):
+    id: int
+    player_id: int
+    seller_team_id: int
+    buyer_team_id: int
+    price: int
+    old_value: int
+    new_value: int
+    source: str
+    created_at: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class TransferTotals(BaseModel):
+    team_id: int
+    spent: int = 0
+    earned: int = 0
+    bought: int = 0
+    sold: int = 0
+
+    class Config:
+        orm_mode = True
@@ -0,0 +1,93 @@
+"""
+seed-league: fills a database with generated users, teams and players,
+for capacity and load tests.
+
+    python seed_league.py --teams 1000000 --seed 42 --database-url sqlite:///./league.db
+
+Users are named `<prefix><n>@example.com` and all share the same password,
+hashed once. Rows are written with executemany inserts, one transaction per batch.
+
+The league is written to one database, with the ids of a single database:
+it is not meant for an app running with SHARD_URLS.
+"""
+import argparse
+import time
+from sqlalchemy import func, insert, select
+from authorizations import get_password_hash
+from core.config import settings
+from database import Base, SQLALCHEMY_DATABASE_URL, create_database_engine
+from generator import SquadGenerator
+import models
+
+
+def seed_league(engine, teams: int, seed: int = None, batch_size: int = 10000,
+                prefix: str = 'manager', password: str = 'password', log=None):
+    """
+    Inserts `teams` users, each with its team and squad
+    :param engine: target database engine, schema is created if missing
+    :param teams: number of users/teams to add
+    :param seed: generator seed, for a reproducible league
+    :param batch_size: teams written per transaction
+    :param prefix: username prefix
+    :param password: password shared by all the generated users
+    :param log: optional callable receiving progress messages
+    :return: number of players inserted
+    """
+    Base.metadata.create_all(bind=engine)
+    generator = SquadGenerator(seed)
+    hashed_password = get_password_hash(password)
+    with engine.connect() as conn:
+        first_user_id = (conn.execute(select(func.max(models.User.id))).scalar() or 0) + 1
+        first_team_id = (conn.execute(select(func.max(models.Team.id))).scalar() or 0) + 1
+    inserted_players = 0
+    for offset in range(0, teams, batch_size):
+        users, db_teams, players = [], [], []
+        for n in range(offset, min(offset + batch_size, teams)):
+            user_id, team_id = first_user_id + n, first_team_id + n
+            username = f'{prefix}{user_id}@example.com'
+            users.append({'id': user_id, 'username': username, 'hashed_password': hashed_password})
+            team = generator.team(user_id, username)
+            team['id'] = team_id
+            db_teams.append(team)
+            players.extend(generator.squad(team_id))
+        with engine.begin() as conn:
+            conn.execute(insert(models.User), users)
+            conn.execute(insert(models.Team), db_teams)
+            conn.execute(insert(models.Player), players)
+        inserted_players += len(players)
+        if log:
+            log(f'{offset + len(users)}/{teams} teams, {inserted_players} players')
+    if engine.dialect.name == 'postgresql' and teams:
+        # ids were given explicitly: move the sequences past them
+        with engine.begin() as conn:
+            for table in (models.User.__table__, models.Team.__table__):
+                conn.exec_driver_sql(
+                    f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), (SELECT MAX(id) FROM {table.name}))"
+                )
+    return inserted_players
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='seed-league', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--teams', type=int, required=True, help='number of users/teams to create')
+    parser.add_argument('--seed', type=int, default=None, help='generator seed')
+    parser.add_argument('--database-url', default=SQLALCHEMY_DATABASE_URL)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--prefix', default='manager', help='username prefix')
+    parser.add_argument('--password', default='password', help='password of every generated user')
+    args = parser.parse_args()
+    if settings.SHARD_URLS:
+        parser.error('the league is seeded in a single database, unset SHARD_URLS')
+
+    start = time.perf_counter()
+    players = seed_league(
+        create_database_engine(args.database_url), args.teams, args.seed, args.batch_size,
+        args.prefix, args.password, log=print
+    )
+    print(f'{args.teams} teams and {players} players in {time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
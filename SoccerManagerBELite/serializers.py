@@ -0,0 +1,33 @@
+# fast json responses
+#
+# List endpoints select plain column rows (see crud.PLAYER_COLUMNS) and encode
+# them straight to json bytes, with the same shape as the pydantic schemas but
+# without building ORM objects and validating models row by row.
+# orjson is used when installed, the standard library json otherwise.
+
+import json
+from typing import Iterable, Sequence
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# fields of schemas.DBPlayer, in order: the first columns of crud.PLAYER_COLUMNS
+PLAYER_FIELDS = ('id', 'name', 'surname', 'country', 'role', 'age', 'value', 'team_id')
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def encode_players(rows: Iterable[Sequence]) -> bytes:
+    """
+    :param rows: rows starting with the PLAYER_FIELDS columns, extra columns are left out
+    :return: json list of players, as schemas.DBPlayer
+    """
+    fields = PLAYER_FIELDS
+    return dumps([dict(zip(fields, row)) for row in rows])
+
@@ -0,0 +1,342 @@
+# horizontal sharding of the teams and players
+#
+# With SHARD_URLS set, the team and players of each user live on one of the
+# shard databases, picked by a jump consistent hash of the user id; the users
+# (and the idempotency keys) stay in DATABASE_URL, the directory. A team takes
+# the id of its user, and its players the ids user_id * PLAYER_ID_STRIDE + n,
+# so that ids are unique across shards without a shared sequence.
+#
+# The routes of a team open a session on its shard (get_team_db,
+# get_team_async_db), so that the writes of teams on different shards go to
+# different databases, with their own write lock. The market list is read from
+# every shard and merged. A sale between teams of the same shard is the usual
+# acquire_player transaction; between two shards, it is made of three local
+# transactions (see transfer_player): the seller shard reserves the player,
+# the buyer shard records the decision with the payment and the player, then
+# the seller shard is paid. The decision is written once on the buyer shard,
+# so a transfer interrupted between the steps is finished the same way by
+# resume_transfers, which every worker runs periodically (transfer_resumer),
+# and no money is created or lost.
+#
+# The order book, the auctions and the cross-team reads (player history, market
+# export) need every team in one database: those routes answer 501 when sharded.
+
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional, Sequence, Tuple
+
+from fastapi import Depends
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, sessionmaker
+
+import async_crud
+import authorizations
+import crud
+import exceptions
+import migrations
+import models
+import schemas
+from core.config import settings
+from database import async_database_url, create_async_database_engine, create_database_engine, get_async_db, get_db
+from generator import get_generator
+
+logger = logging.getLogger(__name__)
+
+# players ids of a team: team_id * PLAYER_ID_STRIDE + 1 .. + squad size
+PLAYER_ID_STRIDE = 32
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """
+    Jump consistent hash: going from n to n + 1 buckets only moves 1 / (n + 1) of the keys
+    :return: bucket of `key`, in [0, buckets)
+    """
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def player_ids(team_id: int, squad_size: int) -> List[int]:
+    """
+    :return: ids of the generated players of a team
+    """
+    if squad_size >= PLAYER_ID_STRIDE:
+        raise ValueError(f'squads of {squad_size} players do not fit in PLAYER_ID_STRIDE')
+    return [team_id * PLAYER_ID_STRIDE + n for n in range(1, squad_size + 1)]
+
+
+class ShardSet:
+    """
+    Engines and session factories of the shard databases
+    :param urls: database url of each shard, in a fixed order: the position gives the shard
+    """
+
+    def __init__(self, urls: Sequence[str]):
+        self.urls = list(urls)
+        self.engines = [create_database_engine(url) for url in self.urls]
+        self.async_engines = [create_async_database_engine(async_database_url(url)) for url in self.urls]
+        self.sessions = [sessionmaker(autoflush=False, autocommit=False, bind=engine) for engine in self.engines]
+        self.async_sessions = [
+            sessionmaker(autoflush=False, autocommit=False, expire_on_commit=False, class_=AsyncSession, bind=engine)
+            for engine in self.async_engines
+        ]
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def shard_of(self, team_id: int) -> int:
+        """
+        :param team_id: team id, the id of its user
+        :return: position of the shard holding the team
+        """
+        return jump_hash(team_id, len(self.urls))
+
+    def upgrade(self, log=None):
+        for engine in self.engines:
+            migrations.upgrade(engine, log)
+
+    async def dispose(self):
+        for engine in self.async_engines:
+            await engine.dispose()
+        for engine in self.engines:
+            engine.dispose()
+
+
+# shards of the app, None for a single database
+shards: Optional[ShardSet] = ShardSet(settings.SHARD_URLS) if settings.SHARD_URLS else None
+
+
+class ShardSessions:
+    """
+    Async sessions of a request on the shards, opened on first use and closed with the request.
+    Without shards, every team is in the database of `default`
+    """
+
+    def __init__(self, shard_set: Optional[ShardSet], default: AsyncSession):
+        self.shard_set = shard_set
+        self.default = default
+        self._opened = {}
+
+    def shard(self, index: int) -> AsyncSession:
+        if index not in self._opened:
+            self._opened[index] = self.shard_set.async_sessions[index]()
+        return self._opened[index]
+
+    def for_team(self, team_id: int) -> AsyncSession:
+        if self.shard_set is None:
+            return self.default
+        return self.shard(self.shard_set.shard_of(team_id))
+
+    def all(self) -> List[AsyncSession]:
+        if self.shard_set is None:
+            return [self.default]
+        return [self.shard(index) for index in range(len(self.shard_set))]
+
+    async def close(self):
+        for db in self._opened.values():
+            await db.close()
+        self._opened.clear()
+
+
+async def get_shard_sessions(db: AsyncSession = Depends(get_async_db)):
+    sessions = ShardSessions(shards, db)
+    try:
+        yield sessions
+    finally:
+        await sessions.close()
+
+
+async def get_team_async_db(
+        identity: authorizations.CurrentIdentity = Depends(),
+        sessions: ShardSessions = Depends(get_shard_sessions)
+        ) -> AsyncSession:
+    """
+    :return: async session on the database of the user team
+    """
+    return sessions.for_team(identity.team_id)
+
+
+def get_team_db(identity: authorizations.CurrentIdentity = Depends(), db: Session = Depends(get_db)):
+    """
+    :return: session on the database of the user team
+    """
+    if shards is None:
+        yield db
+        return
+    with shards.sessions[shards.shard_of(identity.team_id)]() as shard_db:
+        yield shard_db
+
+
+def single_database():
+    """
+    Dependency of the routes needing every team in one database
+    :raise HTTPException: not_available_with_shards when sharded
+    """
+    if shards is not None:
+        raise exceptions.not_available_with_shards()
+
+
+async def register_user(db: AsyncSession, user: schemas.User, hashed_password: str) -> models.User:
+    """
+    Registers a user in the directory, then its generated team and players on its shard.
+    The user is deleted again if the team could not be created
+    :param db: session of the directory database
+    :raise IntegrityError: the username is already registered
+    :return: the new user
+    """
+    db_user = await async_crud.create_user(db, user, hashed_password)
+    user_id, username = db_user.id, db_user.username
+    try:
+        async with shards.async_sessions[shards.shard_of(user_id)]() as shard_db:
+            await async_crud.register_team(shard_db, user_id, username,
+                                           player_ids(user_id, len(get_generator().roles)))
+    except BaseException:
+        await async_crud.delete_user(db, user_id)
+        raise
+    return db_user
+
+
+async def get_market_rows(
+        sessions: ShardSessions,
+        filters: schemas.MarketFilter = None,
+        sort: str = 'id',
+        order: str = 'asc',
+        after: Tuple = None,
+        limit: int = None
+        ) -> List[Row]:
+    """
+    Market list read from every shard at once, each page in (sort key, id) order, merged in the same order
+    :return: the first `limit` players of the merged pages, as crud.get_market_rows
+    """
+    dbs = sessions.all()
+    if len(dbs) == 1:
+        return await async_crud.get_market_rows(dbs[0], filters, sort, order, after, limit)
+    pages = await asyncio.gather(*(
+        async_crud.get_market_rows(db, filters, sort, order, after, limit) for db in dbs
+    ))
+    column = crud.MARKET_SORT_COLUMNS[sort].key
+    merged = heapq.merge(*pages, key=lambda row: (getattr(row, column), row.id), reverse=order == 'desc')
+    return list(itertools.islice(merged, limit))
+
+
+async def find_player(sessions: ShardSessions, player_id: int) -> Tuple[Optional[models.Player], AsyncSession]:
+    """
+    Looks a player up on the shard of the team it was generated for (its id tells the team),
+    then on every shard when it moved away. During a cross-shard transfer the player is on both
+    shards for a moment, without a team on the seller shard: the copy with a team is returned
+    :return: (player, session of its shard), (None, None) when it does not exist
+    """
+    home = sessions.for_team(player_id // PLAYER_ID_STRIDE)
+    player = await async_crud.get_player_by_player_id(home, player_id)
+    if sessions.shard_set is None or (player is not None and player.team_id is not None):
+        return player, home
+    dbs = sessions.all()
+    players = await asyncio.gather(*(async_crud.get_player_by_player_id(db, player_id) for db in dbs))
+    found = [(player, db) for player, db in zip(players, dbs) if player is not None]
+    if not found:
+        return None, None
+    return max(found, key=lambda item: item[0].team_id is not None)
+
+
+async def transfer_player(seller_db: AsyncSession, buyer_db: AsyncSession, player: models.Player,
+                          user_team: models.Team) -> models.Player:
+    """
+    Sale of a listed player to a team of another shard: the player is reserved on the seller shard,
+    received and paid on the buyer shard, then the seller is paid. When the buyer cannot pay,
+    or its shard fails, the player is listed again. The total of the budgets is the same before
+    and after, whatever the outcome
+    :param seller_db: session of the seller shard
+    :param buyer_db: session of the buyer shard
+    :param player: the player, as read on the seller shard
+    :param user_team: the buyer team
+    :raise HTTPException: player_not_on_sale if the listing changed, insufficient_funds
+    :return: the transferred player, as stored on the buyer shard
+    """
+    transfer = await async_crud.reserve_transfer(seller_db, player, user_team.id)
+    try:
+        decision = await async_crud.receive_transfer(buyer_db, transfer, player)
+    except Exception:
+        # the buyer shard rolled back: cancelled, unless a decision got recorded
+        decision = await async_crud.decide_transfer(buyer_db, transfer, 'cancelled')
+        if decision == 'cancelled':
+            await async_crud.cancel_transfer(seller_db, transfer.id)
+            raise
+    if decision == 'cancelled':
+        await async_crud.cancel_transfer(seller_db, transfer.id)
+        raise exceptions.insufficient_funds()
+    await async_crud.complete_transfer(seller_db, transfer.id)
+    return await async_crud.get_player_by_player_id(buyer_db, player.id)
+
+
+def resume_transfers(shard_set: ShardSet, older_than: int = None) -> int:
+    """
+    Finishes the cross-shard transfers left reserved for more than `older_than` seconds, after a crash:
+    completed when the buyer shard received them, cancelled otherwise (the cancellation is recorded
+    on the buyer shard first, so a late second step cannot receive the player anymore)
+    :param older_than: seconds, settings.SHARD_TRANSFER_TIMEOUT by default
+    :return: number of transfers finished
+    """
+    if older_than is None:
+        older_than = settings.SHARD_TRANSFER_TIMEOUT
+    before = datetime.utcnow() - timedelta(seconds=older_than)
+    finished = 0
+    for index, sessions in enumerate(shard_set.sessions):
+        with sessions() as seller_db:
+            for transfer in crud.get_reserved_transfers(seller_db, before):
+                with shard_set.sessions[shard_set.shard_of(transfer.buyer_team_id)]() as buyer_db:
+                    decision = crud.decide_transfer(buyer_db, transfer, 'cancelled')
+                if decision == 'received':
+                    finished += crud.complete_transfer(seller_db, transfer.id)
+                else:
+                    finished += crud.cancel_transfer(seller_db, transfer.id)
+    return finished
+
+
+class TransferResumer:
+    """
+    Background task of the workers, finishing every `interval` seconds the cross-shard transfers
+    left reserved for more than settings.SHARD_TRANSFER_TIMEOUT (see resume_transfers)
+    :param interval: seconds between two passes
+    """
+
+    def __init__(self, interval: float = None):
+        self.interval = interval or settings.SHARD_RESUME_INTERVAL
+        self._task: Optional[asyncio.Task] = None
+
+    async def run(self):
+        """
+        Resumes the stale transfers, until cancelled
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                # the shards are read through the sync engines, away from the event loop
+                finished = await loop.run_in_executor(None, resume_transfers, shards)
+                if finished:
+                    logger.warning('%d interrupted cross-shard transfers finished', finished)
+            except Exception:
+                logger.exception('resuming cross-shard transfers failed')
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+transfer_resumer = TransferResumer()
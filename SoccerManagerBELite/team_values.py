@@ -0,0 +1,37 @@
+"""
+Consistency of the team values stored in the `team` table with the values of
+their players.
+
+    python team_values.py check --database-url sqlite:///./soccermanager.db
+    python team_values.py rebuild --database-url sqlite:///./soccermanager.db
+
+`check` lists the inconsistent teams, and exits with status 1 if there are any;
+`rebuild` recomputes every team value.
+"""
+import argparse
+import sys
+from sqlalchemy.orm import Session
+from database import SQLALCHEMY_DATABASE_URL, create_database_engine
+import crud
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['check', 'rebuild'])
+    parser.add_argument('--database-url', default=SQLALCHEMY_DATABASE_URL)
+    args = parser.parse_args()
+
+    with Session(create_database_engine(args.database_url)) as db:
+        if args.command == 'rebuild':
+            print(f'{crud.rebuild_team_values(db)} teams updated')
+            return
+        inconsistent = crud.check_team_values(db)
+        for team_id, stored, actual in inconsistent:
+            print(f'team {team_id}: stored value {stored}, players value {actual}')
+        print(f'{len(inconsistent)} inconsistent teams')
+        if inconsistent:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
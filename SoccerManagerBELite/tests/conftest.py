@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+
+from cache import invalidation_bus, market_cache
+from database import Base, get_db, get_async_db
+from main import app
+from orderbook import order_book
+from query_budget import QueryCounter
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+SQLALCHEMY_ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./test.db"
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    """
+    the tests recreate their database: entries cached by a previous test are dropped
+    """
+    invalidation_bus.backend.clear()
+
+
+@pytest.fixture()
+def query_counter():
+    """
+    counts the statements run while open:
+
+        with query_counter() as queries:
+            client.get(...)
+        queries.assert_at_most(2)
+    """
+    return QueryCounter
+
+
+@pytest.fixture(scope='session')
+def db_engine():
+    # threads racing on the test database wait for the write lock rather than failing
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30})
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(scope='session')
+def async_db_engine():
+    engine = create_async_engine(SQLALCHEMY_ASYNC_DATABASE_URL)
+    yield engine
+    asyncio.run(engine.dispose())
+
+
+@pytest.fixture(scope='session')
+def db_sessions(db_engine):
+    """
+    session factory of the test database: `with db_sessions() as db: ...`
+    """
+    return sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
+
+
+@pytest.fixture(scope='session')
+def async_db_sessions(async_db_engine):
+    return sessionmaker(
+        autocommit=False, autoflush=False, expire_on_commit=False, class_=AsyncSession, bind=async_db_engine
+    )
+
+
+@pytest.fixture()
+def test_db(db_engine):
+    """
+    empty tables, market cache and order book for the test
+    """
+    Base.metadata.create_all(bind=db_engine)
+    market_cache.invalidate()
+    order_book.clear()
+    yield
+    Base.metadata.drop_all(bind=db_engine)
+
+
+@pytest.fixture()
+def test_app(db_sessions, async_db_sessions):
+    """
+    the app, its requests served by the test database
+    """
+    def override_get_db():
+        try:
+            db = db_sessions()
+            yield db
+        finally:
+            db.close()
+
+    async def override_get_async_db():
+        try:
+            db = async_db_sessions()
+            yield db
+        finally:
+            await db.close()
+
+    overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    yield app
+    app.dependency_overrides = overrides
+
+
+@pytest.fixture()
+def client(test_app):
+    return TestClient(test_app)
+
+
+@pytest.fixture()
+def auth_headers(client):
+    """
+    registers and logs a user in:
+
+        headers = auth_headers("user@example.com")
+        client.get("/team/user", headers=headers)
+    """
+    def login(username):
+        user = {"username": username, "password": "password"}
+        client.post("/auth/register", json=user)
+        token = client.post("/auth/login", data=user).json()['token']
+        return {"Authorization": f"Bearer {token}"}
+
+    return login
@@ -0,0 +1,215 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import async_crud
+import auctions
+import crud
+import models
+from auctions import AuctionScheduler
+from params import budget
+
+
+@pytest.fixture()
+def start(client):
+    def start(headers, player_id, reserve_price=1000000, duration=3600):
+        return client.post(
+            "/market/auctions", json={"player_id": player_id, "reserve_price": reserve_price, "duration": duration},
+            headers=headers
+        )
+
+    return start
+
+
+@pytest.fixture()
+def settle(async_db_sessions):
+    def settle(now, batch_size=500):
+        scheduler = AuctionScheduler(async_db_sessions, batch_size=batch_size, horizon=60)
+        asyncio.run(scheduler.reload(now))
+        return asyncio.run(scheduler.settle_due(now))
+
+    return settle
+
+
+def after(seconds):
+    return datetime.utcnow() + timedelta(seconds=seconds)
+
+
+def test_auction_sold_to_best_bid(test_db, client, auth_headers, db_sessions, start, settle):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    other = auth_headers("other@example.com")
+    value = client.get("/players/user", headers=seller).json()[0]['value']
+    response = start(seller, 1)
+    assert response.status_code == 200
+    auction = response.json()['auction']
+    assert (auction['player_id'], auction['seller_team_id'], auction['status']) == (1, 1, 'open')
+    assert client.get("/market/auctions").json() == [auction]
+
+    response = client.post(f"/market/auctions/{auction['id']}/bids?amount=1000000", headers=buyer)
+    assert response.json()['auction']['best_bid'] == 1000000
+    response = client.post(f"/market/auctions/{auction['id']}/bids?amount=1000000", headers=other)
+    assert response.json()['detail'] == 'bid below the reserve price or not above the best bid'
+    response = client.post(f"/market/auctions/{auction['id']}/bids?amount=1200000", headers=other)
+    assert response.json()['auction']['best_bidder_team_id'] == 3
+
+    # not ended yet
+    assert settle(after(60)) == 0
+    assert settle(after(3601)) == 1
+    assert client.get("/market/auctions").json() == []
+    with db_sessions() as db:
+        assert db.query(models.Auction.status).scalar() == 'sold'
+        player = crud.get_player_by_player_id(db, 1)
+        assert player.team_id == 3 and player.value > value
+        assert crud.check_team_values(db) == []
+    assert client.get("/team/user", headers=other).json()['budget'] == budget - 1200000
+    assert client.get("/team/user", headers=seller).json()['budget'] == budget + 1200000
+    assert client.get("/team/user", headers=buyer).json()['budget'] == budget
+    response = client.post(f"/market/auctions/{auction['id']}/bids?amount=2000000", headers=buyer)
+    assert response.json()['detail'] == 'auction closed'
+
+
+def test_auction_unsold(test_db, client, auth_headers, db_sessions, start, settle):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    start(seller, 1)
+    start(seller, 2)
+    # the bidder cannot pay anymore when the auction ends
+    client.post("/market/auctions/2/bids?amount=1000000", headers=buyer)
+    with db_sessions() as db:
+        db.query(models.Team).filter(models.Team.id == 2).update({models.Team.budget: 0})
+        db.commit()
+    assert settle(after(3601)) == 2
+    with db_sessions() as db:
+        assert [status for status, in db.query(models.Auction.status).order_by(models.Auction.id)] == \
+            ['unsold', 'unsold']
+        assert {player.team_id for player in crud.get_players_by_ids(db, [1, 2]).values()} == {1}
+    # the player can be listed again
+    response = client.get("/market/sell?player_id=1&asking_price=100", headers=seller)
+    assert response.json()['msg'] == 'player put on the market'
+
+
+def test_batch_settled_against_running_budgets(test_db, client, auth_headers, db_sessions, start, settle):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    for player_id in (1, 2, 3):
+        start(seller, player_id)
+        client.post(f"/market/auctions/{player_id}/bids?amount=2000000", headers=buyer)
+    # enough for two of the three auctions, settled in id order
+    with db_sessions() as db:
+        db.query(models.Team).filter(models.Team.id == 2).update({models.Team.budget: 5000000})
+        db.commit()
+    assert settle(after(3601)) == 3
+    with db_sessions() as db:
+        assert [status for status, in db.query(models.Auction.status).order_by(models.Auction.id)] == \
+            ['sold', 'sold', 'unsold']
+        assert crud.get_team_by_team_id(db, 2).budget == 1000000
+        assert crud.check_team_values(db) == []
+
+
+def test_invalid_auctions(test_db, client, auth_headers, start):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    assert start(buyer, 1).json()['detail'] == 'player with the given id does not belong to user'
+    assert start(seller, 1, reserve_price=0).status_code == 400
+    assert start(seller, 1, duration=1).json()['detail'] == 'auction duration out of the allowed range'
+    client.get("/market/sell?player_id=2&asking_price=100", headers=seller)
+    assert start(seller, 2).json()['detail'] == 'player on the market list, withdraw it before the auction'
+    assert start(seller, 1).status_code == 200
+    assert start(seller, 1).json()['detail'] == 'player already in an open auction'
+    response = client.get("/market/sell?player_id=1&asking_price=100", headers=seller)
+    assert response.json()['detail'] == 'player already in an open auction'
+    response = client.post("/market/sell/batch", json=[{"player_id": 1, "asking_price": 100}], headers=seller)
+    assert response.json()['results'][0]['msg'] == 'player already in an open auction'
+    assert client.post("/market/auctions/1/bids?amount=2000000", headers=seller).json()['detail'] == \
+        'player with the given already belongs to user'
+    assert client.post("/market/auctions/1/bids?amount=999999", headers=buyer).status_code == 400
+    assert client.post(f"/market/auctions/1/bids?amount={budget + 1}", headers=buyer).json()['detail'] == \
+        'user does not have enough money to buy player'
+    assert client.post("/market/auctions/9/bids?amount=2000000", headers=buyer).json()['detail'] == \
+        'auction with the given id does not exist'
+
+
+def test_scheduler_batches(test_db, client, auth_headers, async_db_sessions, start):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    for player_id in range(1, 21):
+        start(seller, player_id, reserve_price=1000, duration=60 * player_id)
+        client.post(f"/market/auctions/{player_id}/bids?amount=1000", headers=buyer)
+    scheduler = AuctionScheduler(async_db_sessions, batch_size=3, horizon=3600)
+    asyncio.run(scheduler.reload())
+    assert len(scheduler) == 20
+    # first ended first, a batch at a time
+    assert scheduler.pop_due(after(270), limit=3) == [1, 2, 3]
+    assert scheduler.pop_due(after(270), limit=3) == [4]
+    assert asyncio.run(scheduler.settle_due(after(1230))) == 16
+    assert len(scheduler) == 0
+    # the popped auctions are scheduled again by the next reload
+    asyncio.run(scheduler.reload())
+    assert asyncio.run(scheduler.settle_due(after(1230))) == 4
+    assert len(client.get("/players/user", headers=buyer).json()) == 40
+
+
+def test_scheduler_loop(test_db, client, auth_headers, db_sessions, async_db_sessions, start):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    start(seller, 1)
+    client.post("/market/auctions/1/bids?amount=1000000", headers=buyer)
+    with db_sessions() as db:
+        db.query(models.Auction).update({models.Auction.ends_at: datetime.utcnow()})
+        db.commit()
+
+    async def run():
+        scheduler = AuctionScheduler(async_db_sessions, horizon=60)
+        scheduler.start()
+        for _ in range(100):
+            await asyncio.sleep(0.02)
+            async with async_db_sessions() as db:
+                if not await async_crud.get_open_auctions(db):
+                    break
+        await scheduler.stop()
+
+    asyncio.run(run())
+    with db_sessions() as db:
+        assert crud.get_player_by_player_id(db, 1).team_id == 2
+
+
+def test_scheduler_backs_off_unmigrated_database(tmp_path, monkeypatch, caplog):
+    """
+    without the auctions table, the error is logged once and retried less and less often
+    """
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'empty.db'}")
+    sessions = sessionmaker(class_=AsyncSession, bind=engine)
+    clock = [datetime.utcnow()]
+    waits = []
+
+    class Clock(datetime):
+        @classmethod
+        def utcnow(cls):
+            return clock[0]
+
+    async def wait_for(awaitable, timeout):
+        # the scheduler sleeps until timed out
+        awaitable.close()
+        waits.append(timeout)
+        clock[0] += timedelta(seconds=timeout)
+        if len(waits) == 5:
+            raise asyncio.CancelledError
+        raise asyncio.TimeoutError
+
+    async def run():
+        monkeypatch.setattr(auctions, 'datetime', Clock)
+        monkeypatch.setattr(asyncio, 'wait_for', wait_for)
+        try:
+            await AuctionScheduler(sessions, horizon=4).run()
+        finally:
+            monkeypatch.undo()
+            await engine.dispose()
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(run())
+    assert waits == [1, 2, 4, 4, 4]
+    assert [record.levelname for record in caplog.records if record.name == 'auctions'] == ['ERROR']
@@ -1,17 +1,30 @@
 import pytest
+import threading
 from fastapi.testclient import TestClient
+from jose import jwt
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 
-from database import Base, get_db
+from database import Base, get_db, get_async_db
 from main import app
+import authorizations
+import crud
+import models
+import schemas
+from generator import get_generator
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+SQLALCHEMY_ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./test.db"
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_engine(SQLALCHEMY_ASYNC_DATABASE_URL)
+TestingAsyncSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, class_=AsyncSession, bind=async_engine
+)
 
 Base.metadata.create_all(bind=engine)
 
@@ -24,6 +37,14 @@ def override_get_db():
         db.close()
 
 
+async def override_get_async_db():
+    try:
+        db = TestingAsyncSessionLocal()
+        yield db
+    finally:
+        await db.close()
+
+
 @pytest.fixture()
 def test_db():
     Base.metadata.create_all(bind=engine)
@@ -32,6 +53,7 @@ def test_db():
 
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
 
 client = TestClient(app)
 
@@ -101,3 +123,80 @@ def test_get_token(test_db):
     json = response.json()
     assert json['msg'] == 'User user@example.com validated'
     assert json['token']
+
+
+def test_login_without_team(test_db):
+    """
+    a user without a team is refused like a bad password
+    """
+    db = TestingSessionLocal()
+    db.add(models.User(username="user@example.com", hashed_password=authorizations.get_password_hash("password")))
+    db.commit()
+    db.close()
+    response = client.post(
+        "/auth/login",
+        data={"username": "user@example.com", "password": "password"}
+    )
+    assert response.status_code == 401
+    assert response.json() == {'detail': 'Credentials could not be validated'}
+
+
+def test_login_hashing_queue_full(test_db, monkeypatch):
+    """
+    logins are refused with a 503 while the password hashing pool is saturated
+    """
+    user = {"username": "user@example.com", "password": "password"}
+    client.post(
+        "/auth/register",
+        json=user
+    )
+    monkeypatch.setattr(authorizations, '_hash_slots', threading.BoundedSemaphore(1))
+    authorizations._hash_slots.acquire()
+    response = client.post(
+        "/auth/login",
+        data=user
+    )
+    assert response.status_code == 503
+    assert response.json() == {'detail': 'server busy, retry later'}
+
+
+def test_create_user_is_atomic(test_db, monkeypatch):
+    """
+    a failure while generating the players leaves neither user nor team behind
+    """
+    def broken_squad(team_id):
+        raise RuntimeError('generator failure')
+    monkeypatch.setattr(get_generator(), 'squad', broken_squad)
+    user = schemas.User(username="user@example.com", password="password")
+    db = TestingSessionLocal()
+    with pytest.raises(RuntimeError):
+        crud.register_user(db, user, 'hash')
+    assert db.query(models.User).count() == 0
+    assert db.query(models.Team).count() == 0
+    db.close()
+
+
+def test_token_carries_ids(test_db):
+    """
+    tokens carry the user and team ids; tokens without them are refused
+    """
+    user = {"username": "user@example.com", "password": "password"}
+    client.post(
+        "/auth/register",
+        json=user
+    )
+    token = client.post(
+        "/auth/login",
+        data=user
+    ).json()['token']
+    claims = jwt.get_unverified_claims(token)
+    assert claims['sub'] == user['username']
+    assert claims['uid'] == 1
+    assert claims['tid'] == 1
+
+    legacy_token = jwt.encode({'sub': user['username']}, authorizations.SECRET_KEY, algorithm=authorizations.ALGORITHM)
+    response = client.get(
+        "/team/user",
+        headers={"Authorization": f"Bearer {legacy_token}"}
+    )
+    assert response.status_code == 401
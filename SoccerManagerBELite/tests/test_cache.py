@@ -0,0 +1,134 @@
+import asyncio
+import time
+
+import pytest
+
+from cache import (CacheBackend, FakeRedis, InvalidationBus, MemoryBackend, PageCache, RedisBackend,
+                   SQLiteBackend, create_backend, team_topic)
+from params import budget
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def backends(request, tmp_path):
+    """
+    two backends seen by two workers: the same store, except for the in-process one
+    """
+    if request.param == 'memory':
+        backend = MemoryBackend(max_entries=4)
+        return backend, backend
+    if request.param == 'sqlite':
+        path = str(tmp_path / 'cache.db')
+        return SQLiteBackend(path), SQLiteBackend(path)
+    server = FakeRedis()
+    return RedisBackend(server), RedisBackend(server)
+
+
+def test_pages_follow_topic_versions(backends):
+    first = PageCache('market', InvalidationBus(backends[0]))
+    second = PageCache('market', InvalidationBus(backends[1]))
+    version = first.version
+    page = first.put('page', version, b'[1]', {'X-Next-Cursor': 'abc'})
+    assert second.get('page') == page
+    assert page.etag.startswith('"')
+
+    # a page read before a change and stored after it is never served
+    stale_version = second.version
+    first.invalidate()
+    second.put('page', stale_version, b'[]')
+    assert second.get('page') is None and first.get('page') is None
+    second.put('page', second.version, b'[2]')
+    assert first.get('page').body == b'[2]'
+    assert (first.hits, first.misses) == (1, 1)
+
+    # other topics are left alone
+    team = PageCache('team', first.bus)
+    team.put('details', team.version_of(team_topic(1)), b'{}', topic=team_topic(1))
+    first.bus.publish(team_topic(2))
+    assert team.get('details', team_topic(1)).body == b'{}'
+
+    backends[0].clear()
+    assert backends[1].size() == 0
+    assert first.version == 1
+
+
+def test_bus_listeners(backends):
+    bus = InvalidationBus(backends[0])
+    published = []
+    bus.subscribe(published.append)
+    bus.publish('market', team_topic(1), 'market')
+    assert published == [['market', team_topic(1)]]
+    assert backends[1].versions(['market', team_topic(1), team_topic(2)]) == [1, 1, 0]
+
+
+def test_memory_backend_is_bounded():
+    backend = MemoryBackend(max_entries=2)
+    for key in 'abc':
+        backend.set(key, key.encode())
+    assert backend.get('a') is None and backend.size() == 2
+
+
+def test_create_backend(tmp_path):
+    assert isinstance(create_backend('memory://'), MemoryBackend)
+    assert isinstance(create_backend(f"sqlite:///{tmp_path / 'cache.db'}"), SQLiteBackend)
+    assert isinstance(create_backend('fakeredis://'), RedisBackend)
+    with pytest.raises(ValueError):
+        create_backend('memcached://localhost')
+
+
+def test_expired_redis_entries_skipped():
+    server = FakeRedis()
+    backend = RedisBackend(server, ttl=60)
+    backend.set('expired', b'1')
+    backend.set('kept', b'2')
+    server._expires[backend.entry_prefix + 'expired'] = time.monotonic() - 1
+    assert backend.size() == 1
+    backend.clear()
+    assert backend.size() == 0
+
+
+def test_publish_deferred_off_the_loop(backends):
+    bus = InvalidationBus(backends[0])
+    with bus.defer() as topics:
+        bus.publish('market', team_topic(1))
+        assert bus.backend.versions(['market']) == [0]
+    assert topics == ['market', team_topic(1)]
+    asyncio.run(bus.publish_async(*topics))
+    assert backends[1].versions(['market', team_topic(1)]) == [1, 1]
+
+
+def test_backend_must_implement_every_method():
+    class GetOnly(CacheBackend):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        GetOnly()
+
+
+def test_team_reads_invalidated_by_mutations(test_db, client, auth_headers):
+    """
+    team details and rosters are cached until a mutation of the team commits
+    """
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    for headers in (seller, buyer):
+        assert client.get("/team/user", headers=headers).headers['X-Cache'] == 'MISS'
+        assert client.get("/players/user", headers=headers).headers['X-Cache'] == 'MISS'
+    response = client.get("/team/user", headers=seller)
+    assert response.headers['X-Cache'] == 'HIT'
+    assert response.json()['budget'] == budget
+
+    client.get("/team/update?team_name=Sellers", headers=seller)
+    response = client.get("/team/user", headers=seller)
+    assert response.headers['X-Cache'] == 'MISS' and response.json()['name'] == 'Sellers'
+    # the other team is still cached
+    assert client.get("/team/user", headers=buyer).headers['X-Cache'] == 'HIT'
+
+    client.get("/market/sell?player_id=1&asking_price=1000", headers=seller)
+    client.get("/market/buy?player_id=1", headers=buyer)
+    for headers, budget_after in ((seller, budget + 1000), (buyer, budget - 1000)):
+        response = client.get("/team/user", headers=headers)
+        assert response.headers['X-Cache'] == 'MISS' and response.json()['budget'] == budget_after
+    response = client.get("/players/user", headers=buyer)
+    assert response.headers['X-Cache'] == 'MISS'
+    assert 1 in [player['id'] for player in response.json()]
@@ -0,0 +1,95 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import crud
+from feed import MarketFeed, market_feed, sse_stream
+
+
+def test_fanout_to_10k_subscribers():
+    subscribers, events = 10000, 20
+
+    async def run():
+        feed = MarketFeed(queue_size=64)
+        queues = [feed.subscribe() for _ in range(subscribers)]
+        published = [feed.publish('listed', {'player_id': n, 'price': 1000}) for n in range(events)]
+        received = 0
+        for subscriber in queues:
+            for event in published:
+                # the same serialized event for everybody
+                assert await subscriber.get() is event
+                received += 1
+        return feed, received
+
+    feed, received = asyncio.run(run())
+    assert len(feed) == subscribers and received == subscribers * events
+
+
+def test_slow_subscriber_dropped():
+    async def run():
+        feed = MarketFeed(queue_size=4)
+        slow, fast = feed.subscribe(), feed.subscribe()
+        for n in range(6):
+            feed.publish('withdrawn', {'player_id': n})
+            assert (await fast.get()).seq == n + 1
+        # the backlog is discarded, then the subscriber gets the end of its stream
+        assert await slow.get() is None and slow.queue.empty()
+        assert len(feed) == 1 and feed.dropped == 1
+
+        stream = sse_stream(feed, fast, '{}', heartbeat=0.01)
+        assert await stream.__anext__() == 'event: snapshot\ndata: {}\n\n'
+        assert await stream.__anext__() == ': keepalive\n\n'
+        event = feed.publish('sold', {'player_id': 1})
+        assert await stream.__anext__() == event.sse == \
+            'id: 7\nevent: sold\ndata: {"seq":7,"type":"sold","data":{"player_id":1}}\n\n'
+        await stream.aclose()
+        assert len(feed) == 0
+
+    asyncio.run(run())
+
+
+def test_websocket_feed(test_db, client, auth_headers):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    client.get("/market/sell?player_id=1&asking_price=1000", headers=seller)
+    with client.websocket_connect("/market/feed/ws") as websocket:
+        snapshot = websocket.receive_json()
+        assert snapshot['type'] == 'snapshot'
+        assert [player['id'] for player in snapshot['data']] == [1]
+        client.get("/market/sell?player_id=2&asking_price=2000", headers=seller)
+        listed = websocket.receive_json()
+        assert (listed['type'], listed['data']['id'], listed['data']['requested_value']) == ('listed', 2, 2000)
+        assert listed['seq'] > snapshot['seq']
+        client.get("/market/withdraw?player_id=2", headers=seller)
+        assert websocket.receive_json()['data'] == {'player_id': 2}
+        client.get("/market/buy?player_id=1", headers=buyer)
+        sold = websocket.receive_json()
+        assert sold['type'] == 'sold'
+        assert sold['data'] == {'player_id': 1, 'price': 1000, 'seller_team_id': 1, 'buyer_team_id': 2}
+    # unsubscribed on disconnect
+    for _ in range(100):
+        if not len(market_feed):
+            break
+        time.sleep(0.01)
+    assert len(market_feed) == 0
+
+
+def test_renames_and_auction_sales_published(test_db, monkeypatch, client, auth_headers, db_sessions):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    published = []
+    monkeypatch.setattr(market_feed, 'publish', lambda type, data: published.append((type, data)))
+    client.get("/market/sell?player_id=1&asking_price=1000", headers=seller)
+    client.get("/players/update?player_id=1&player_name=Renamed", headers=seller)
+    assert published[-1][0] == 'listed' and published[-1][1]['name'] == 'Renamed'
+    # renaming a player off the market changes no listing
+    client.get("/players/update?player_id=2&player_name=Renamed", headers=seller)
+    assert len(published) == 2
+
+    auction = client.post(
+        "/market/auctions", json={"player_id": 3, "reserve_price": 1000, "duration": 60}, headers=seller
+    ).json()['auction']
+    client.post(f"/market/auctions/{auction['id']}/bids?amount=2000", headers=buyer)
+    with db_sessions() as db:
+        crud.settle_auctions(db, [auction['id']], datetime.utcnow() + timedelta(seconds=61))
+    assert published[-1] == ('sold', {'player_id': 3, 'price': 2000, 'seller_team_id': 1, 'buyer_team_id': 2})
@@ -0,0 +1,51 @@
+import pickle
+from collections import Counter
+from random import Random
+
+from generator import AliasTable, SquadGenerator, load_pools
+from params import initial_player_value, team_size
+
+
+def test_squad_composition():
+    squad = SquadGenerator().squad(team_id=7)
+    assert len(squad) == sum(team_size.values())
+    assert Counter(player['role'] for player in squad) == team_size
+    for player in squad:
+        assert player['team_id'] == 7
+        assert 18 <= player['age'] <= 40
+        assert player['value'] == initial_player_value
+        assert player['name'] and player['surname'] and player['country']
+
+
+def test_seeded_generation_is_reproducible():
+    first, second = SquadGenerator(seed=42), SquadGenerator(seed=42)
+    assert first.team(1, 'user@example.com') == second.team(1, 'user@example.com')
+    assert first.squad(1) == second.squad(1)
+    assert SquadGenerator(seed=1).squad(1) != SquadGenerator(seed=2).squad(1)
+
+
+def test_alias_table_follows_weights():
+    table = AliasTable(['a', 'b', 'c'], [1, 2, 7])
+    rng = Random(0)
+    counts = Counter(table.sample(rng) for _ in range(100000))
+    assert abs(counts['a'] / 100000 - 0.1) < 0.01
+    assert abs(counts['b'] / 100000 - 0.2) < 0.01
+    assert abs(counts['c'] / 100000 - 0.7) < 0.01
+
+
+def test_pools_cache(tmp_path):
+    cache_path = str(tmp_path / 'pools.pickle')
+    built = load_pools.__wrapped__(cache_path)
+    cached = load_pools.__wrapped__(cache_path)
+    for built_pool, cached_pool in zip(built[:2], cached[:2]):
+        assert built_pool.items == cached_pool.items
+        assert built_pool.probability == cached_pool.probability
+        assert built_pool.alias == cached_pool.alias
+    assert built[2] == cached[2]
+
+    # a cache written from other versions of the sources is rebuilt
+    with open(cache_path, 'wb') as cache_file:
+        pickle.dump((('0', '0', 0), (None, None, ())), cache_file)
+    assert load_pools.__wrapped__(cache_path)[2] == built[2]
+    with open(cache_path, 'rb') as cache_file:
+        assert pickle.load(cache_file)[1][2] == built[2]
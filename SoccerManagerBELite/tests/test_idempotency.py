@@ -0,0 +1,136 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+from main import app
+import async_crud
+import crud
+import idempotency
+import models
+from params import budget
+
+
+def test_retried_buy_runs_once(test_db, query_counter, client, auth_headers):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    client.get("/market/sell?player_id=1&asking_price=1000", headers=seller)
+
+    headers = dict(buyer, **{"Idempotency-Key": "buy-1"})
+    first = client.get("/market/buy?player_id=1", headers=headers)
+    assert first.status_code == 200 and 'Idempotent-Replayed' not in first.headers
+    with query_counter() as queries:
+        retry = client.get("/market/buy?player_id=1", headers=headers)
+    # replayed from the stored response, without running the route
+    queries.assert_at_most(1)
+    assert retry.status_code == 200
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert retry.content == first.content
+    assert retry.headers['content-type'] == 'application/json'
+
+    assert client.get("/team/user", headers=buyer).json()['budget'] == budget - 1000
+    assert len(client.get("/team/transfers", headers=buyer).json()) == 1
+    # without the key, the request runs again
+    response = client.get("/market/buy?player_id=1", headers=buyer)
+    assert response.status_code == 400
+
+
+def test_key_bound_to_request_and_user(test_db, client, auth_headers):
+    seller = auth_headers("seller@example.com")
+    other = auth_headers("other@example.com")
+    headers = dict(seller, **{"Idempotency-Key": "sell"})
+    assert client.get("/market/sell?player_id=1&asking_price=1000", headers=headers).status_code == 200
+    response = client.get("/market/sell?player_id=2&asking_price=1000", headers=headers)
+    assert response.status_code == 422
+    assert response.json() == {'detail': 'Idempotency-Key already used for another request'}
+
+    # keys are per user: the same key runs for another user
+    response = client.get("/market/sell?player_id=21&asking_price=1000",
+                          headers=dict(other, **{"Idempotency-Key": "sell"}))
+    assert response.status_code == 200 and 'Idempotent-Replayed' not in response.headers
+
+    response = client.get("/market/sell?player_id=1&asking_price=1000",
+                          headers=dict(seller, **{"Idempotency-Key": "k" * 256}))
+    assert response.status_code == 400
+
+
+def test_refusal_replayed_failure_released(test_db, monkeypatch, client, auth_headers):
+    seller = auth_headers("seller@example.com")
+    headers = dict(seller, **{"Idempotency-Key": "withdraw"})
+    # not listed yet: the refusal is the answer to the retries as well
+    first = client.get("/market/withdraw?player_id=1", headers=headers)
+    assert first.status_code == 400
+    client.get("/market/sell?player_id=1&asking_price=1000", headers=seller)
+    response = client.get("/market/withdraw?player_id=1", headers=headers)
+    assert response.status_code == 400 and response.headers['Idempotent-Replayed'] == 'true'
+    assert response.json() == first.json()
+
+    # an unexpected failure is not stored: the retry runs again
+    remove_player_for_sale = async_crud.remove_player_for_sale
+
+    async def failing_remove_player_for_sale(db, player):
+        raise RuntimeError('database unavailable')
+
+    monkeypatch.setattr(async_crud, 'remove_player_for_sale', failing_remove_player_for_sale)
+    headers = dict(seller, **{"Idempotency-Key": "withdraw-again"})
+    with pytest.raises(RuntimeError):
+        client.get("/market/withdraw?player_id=1", headers=headers)
+    monkeypatch.setattr(async_crud, 'remove_player_for_sale', remove_player_for_sale)
+    response = client.get("/market/withdraw?player_id=1", headers=headers)
+    assert response.status_code == 200 and 'Idempotent-Replayed' not in response.headers
+
+
+def test_in_flight_duplicate_waits(test_db, monkeypatch, auth_headers, test_app):
+    seller = auth_headers("seller@example.com")
+    headers = dict(seller, **{"Idempotency-Key": "slow-sell"})
+    calls = []
+    put_player_for_sale = async_crud.put_player_for_sale
+
+    async def slow_put_player_for_sale(db, player, price):
+        calls.append(player.id)
+        await asyncio.sleep(0.3)
+        return await put_player_for_sale(db, player, price)
+
+    monkeypatch.setattr(async_crud, 'put_player_for_sale', slow_put_player_for_sale)
+
+    async def run():
+        async with httpx.AsyncClient(app=test_app, base_url='http://test') as async_client:
+            return await asyncio.gather(*(
+                async_client.get("/market/sell?player_id=1&asking_price=1000", headers=headers) for _ in range(3)
+            ))
+
+    responses = asyncio.run(run())
+    assert calls == [1]
+    assert [response.status_code for response in responses] == [200] * 3
+    assert len({response.content for response in responses}) == 1
+    assert sum('Idempotent-Replayed' in response.headers for response in responses) == 2
+
+
+def test_expired_and_lost_keys_are_taken_over(test_db, db_sessions):
+    now = datetime.utcnow()
+    with db_sessions() as db:
+        db.add(models.User(id=1, username='user@example.com', hashed_password='x'))
+        db.commit()
+        assert crud.claim_idempotency_key(db, 1, 'key', 'a', now, ttl=60, lock_timeout=10) is None
+        record = crud.claim_idempotency_key(db, 1, 'key', 'a', now + timedelta(seconds=5), ttl=60, lock_timeout=10)
+        assert record.status == 'pending'
+        # the worker running the first request was lost
+        assert crud.claim_idempotency_key(db, 1, 'key', 'a', now + timedelta(seconds=11), ttl=60,
+                                          lock_timeout=10) is None
+        crud.save_idempotent_response(db, 1, 'key', 200, '{}', b'{}')
+        assert crud.claim_idempotency_key(db, 1, 'key', 'b', now + timedelta(seconds=30), ttl=60,
+                                          lock_timeout=10).status == 'done'
+        # expired: the key is free again
+        assert crud.claim_idempotency_key(db, 1, 'key', 'b', now + timedelta(seconds=90), ttl=60,
+                                          lock_timeout=10) is None
+        assert crud.purge_idempotency_keys(db, now + timedelta(days=1)) == 1
+        assert crud.get_idempotency_key(db, 1, 'key') is None
+
+
+def test_routes_accepting_keys():
+    routes = {
+        f'{method} {route.path}' for route in app.routes for method in getattr(route, 'methods', ())
+        if isinstance(route, idempotency.IdempotentRoute)
+    }
+    assert idempotency.IDEMPOTENT_ROUTES <= routes
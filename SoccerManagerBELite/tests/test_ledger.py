@@ -0,0 +1,92 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func
+
+import models
+from auctions import AuctionScheduler
+
+
+@pytest.fixture()
+def buy(client):
+    def buy(seller, buyer, player_id, price):
+        client.get(f"/market/sell?player_id={player_id}&asking_price={price}", headers=seller)
+        return client.get(f"/market/buy?player_id={player_id}", headers=buyer)
+
+    return buy
+
+
+def test_sale_recorded(test_db, client, auth_headers, buy):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    value = client.get("/players/user", headers=seller).json()[0]['value']
+    assert client.get("/players/1/history").json() == []
+    response = buy(seller, buyer, 1, 1000000)
+    assert response.status_code == 200
+    history = client.get("/players/1/history").json()
+    assert len(history) == 1
+    transfer = history[0]
+    assert {key: transfer[key] for key in ('player_id', 'seller_team_id', 'buyer_team_id', 'price', 'source')} == \
+        {'player_id': 1, 'seller_team_id': 1, 'buyer_team_id': 2, 'price': 1000000, 'source': 'market'}
+    assert transfer['old_value'] == value and transfer['new_value'] == response.json()['player']['value']
+    assert client.get("/team/transfers", headers=seller).json() == history
+    assert client.get("/team/transfers", headers=buyer).json() == history
+    assert client.get("/team/transfers/totals", headers=seller).json() == \
+        {'team_id': 1, 'spent': 0, 'earned': 1000000, 'bought': 0, 'sold': 1}
+    assert client.get("/team/transfers/totals", headers=buyer).json() == \
+        {'team_id': 2, 'spent': 1000000, 'earned': 0, 'bought': 1, 'sold': 0}
+
+
+def test_bid_and_auction_sales_recorded(test_db, client, auth_headers, async_db_sessions):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    client.post("/market/bids", json={"player_id": 1, "max_price": 2000000}, headers=buyer)
+    client.get("/market/sell?player_id=1&asking_price=1500000", headers=seller)
+    client.post("/market/auctions", json={"player_id": 2, "reserve_price": 100, "duration": 60}, headers=seller)
+    client.post("/market/auctions/1/bids?amount=300000", headers=buyer)
+    scheduler = AuctionScheduler(async_db_sessions, horizon=120)
+    now = datetime.utcnow() + timedelta(seconds=61)
+    asyncio.run(scheduler.reload(now))
+    assert asyncio.run(scheduler.settle_due(now)) == 1
+    transfers = client.get("/team/transfers", headers=buyer).json()
+    assert [(transfer['player_id'], transfer['source'], transfer['price']) for transfer in transfers] == \
+        [(2, 'auction', 300000), (1, 'bid', 1500000)]
+    assert client.get("/team/transfers/totals", headers=buyer).json() == \
+        {'team_id': 2, 'spent': 1800000, 'earned': 0, 'bought': 2, 'sold': 0}
+
+
+def test_history_pages(test_db, client, auth_headers, db_sessions, buy):
+    first = auth_headers("first@example.com")
+    second = auth_headers("second@example.com")
+    third = auth_headers("third@example.com")
+    # player 1 goes around, and team 2 also buys from team 3
+    buy(first, second, 1, 1000)
+    buy(second, third, 1, 2000)
+    buy(third, second, 1, 3000)
+    buy(third, second, 41, 4000)
+    history = client.get("/players/1/history?limit=2")
+    assert [transfer['price'] for transfer in history.json()] == [3000, 2000]
+    cursor = history.headers['X-Next-Cursor']
+    assert 'cursor=' in history.headers['Link']
+    history = client.get(f"/players/1/history?limit=2&cursor={cursor}")
+    assert [transfer['price'] for transfer in history.json()] == [1000]
+    assert 'X-Next-Cursor' not in history.headers
+
+    prices, cursor = [], ''
+    while cursor is not None:
+        page = client.get(f"/team/transfers?limit=1&cursor={cursor}", headers=second)
+        prices += [transfer['price'] for transfer in page.json()]
+        cursor = page.headers.get('X-Next-Cursor')
+    assert prices == [4000, 3000, 2000, 1000]
+    assert client.get("/team/transfers?cursor=x", headers=second).status_code == 400
+
+    # the rollup matches the ledger
+    with db_sessions() as db:
+        for team_id in (1, 2, 3):
+            spent = db.query(func.coalesce(func.sum(models.Transfer.price), 0)) \
+                .filter(models.Transfer.buyer_team_id == team_id).scalar()
+            earned = db.query(func.coalesce(func.sum(models.Transfer.price), 0)) \
+                .filter(models.Transfer.seller_team_id == team_id).scalar()
+            totals = db.query(models.TeamTransferTotals).filter(models.TeamTransferTotals.team_id == team_id).one()
+            assert (totals.spent, totals.earned) == (spent, earned)
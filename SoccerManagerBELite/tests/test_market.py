@@ -1,18 +1,28 @@
+import json
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 
-from database import Base, get_db
+from database import Base, get_db, get_async_db
 from main import app
+import pagination
+from cache import market_cache
+from orderbook import order_book
 from params import budget, initial_player_value, markup
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+SQLALCHEMY_ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./test.db"
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_engine(SQLALCHEMY_ASYNC_DATABASE_URL)
+TestingAsyncSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, class_=AsyncSession, bind=async_engine
+)
 
 Base.metadata.create_all(bind=engine)
 
@@ -25,14 +35,25 @@ def override_get_db():
         db.close()
 
 
+async def override_get_async_db():
+    try:
+        db = TestingAsyncSessionLocal()
+        yield db
+    finally:
+        await db.close()
+
+
 @pytest.fixture()
 def test_db():
     Base.metadata.create_all(bind=engine)
+    market_cache.invalidate()
+    order_book.clear()
     yield
     Base.metadata.drop_all(bind=engine)
 
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
 
 client = TestClient(app)
 
@@ -158,6 +179,7 @@ def test_exchange_player_on_market(test_db):
 
     new_budget1 = response.json()['budget']
     assert new_budget1 == budget + price
+    assert response.json()['value'] == initial_player_value * 19
 
     response = client.get(
         "/team/user",
@@ -166,6 +188,7 @@ def test_exchange_player_on_market(test_db):
 
     new_budget2 = response.json()['budget']
     assert new_budget2 == budget - price
+    assert response.json()['value'] == initial_player_value * 20 + data['player']['value']
 
 
 def test_exchange_player_on_market_price_too_high(test_db):
@@ -198,3 +221,179 @@ def test_exchange_player_on_market_price_too_high(test_db):
     )
 
     assert response.status_code == 400
+
+
+def test_market_pagination_and_filters(test_db):
+    """
+    the market is walked a page at a time with keyset cursors, with filters and sorting
+    """
+    user = {"username": "user@example.com", "password": "password"}
+    client.post(
+        "/auth/register",
+        json=user
+    )
+    response = client.post(
+        "/auth/login",
+        data=user
+    )
+    token = response.json()['token']
+    # players 1-3 are goalkeepers, 4-9 defenders
+    prices = {1: 300, 2: 100, 3: 200, 4: 100, 5: 500}
+    for player_id, price in prices.items():
+        client.get(
+            f"/market/sell?player_id={player_id}&asking_price={price}",
+            headers={"Authorization": f"Bearer {token}"},
+        )
+
+    seen, cursors = [], []
+    url = "/market/?sort=price&limit=2"
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        assert len(response.json()) <= 2
+        seen.extend(player['id'] for player in response.json())
+        cursor = response.headers.get('X-Next-Cursor')
+        url = f"/market/?sort=price&limit=2&cursor={cursor}" if cursor else None
+        cursors.append(cursor)
+    assert seen == [2, 4, 3, 1, 5]
+
+    response = client.get("/market/?sort=price&order=desc&role=goalkeeper&max_price=250")
+    assert [player['id'] for player in response.json()] == [3, 2]
+    assert 'X-Next-Cursor' not in response.headers
+
+    # cursors only continue the listing they were issued for
+    for cursor in (cursors[0], 'bad'):
+        response = client.get(f"/market/?sort=value&cursor={cursor}")
+        assert response.status_code == 400
+        assert response.json() == {'detail': 'invalid pagination cursor'}
+    # and carry a sort key of the type of the sort column
+    for sort, key in (('price', '100'), ('price', None), ('price', [100]), ('price', True), ('id', 2.5)):
+        response = client.get(f"/market/?sort={sort}&cursor={pagination.encode_cursor(sort, 'asc', key, 2)}")
+        assert response.status_code == 400, (sort, key)
+    response = client.get(f"/market/?sort=price&cursor={pagination.encode_cursor('price', 'asc', 150.5, 2)}")
+    assert [player['id'] for player in response.json()] == [3, 1, 5]
+
+
+def test_market_cache(test_db):
+    """
+    market pages are cached with an ETag until a player is listed
+    """
+    response = client.get("/market/")
+    etag = response.headers['ETag']
+    assert response.headers['X-Cache'] == 'MISS'
+    response = client.get("/market/")
+    assert response.headers['X-Cache'] == 'HIT'
+    assert response.headers['ETag'] == etag
+    response = client.get("/market/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b''
+
+    user = {"username": "user@example.com", "password": "password"}
+    client.post(
+        "/auth/register",
+        json=user
+    )
+    response = client.post(
+        "/auth/login",
+        data=user
+    )
+    token = response.json()['token']
+    client.get(
+        "/market/sell?player_id=10&asking_price=1100000",
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    response = client.get("/market/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers['X-Cache'] == 'MISS'
+    assert [player['id'] for player in response.json()] == [10]
+
+    stats = client.get("/market/cache").json()
+    assert stats['hits'] >= 2
+    assert stats['misses'] >= 2
+
+
+def test_batch_sell_and_withdraw(test_db):
+    """
+    many players are listed and withdrawn at once, with a result for each of them
+    """
+    user1 = {"username": "user@example.com", "password": "password"}
+    user2 = {"username": "user2@example.com", "password": "password"}
+    for user in (user1, user2):
+        client.post(
+            "/auth/register",
+            json=user
+        )
+    response = client.post(
+        "/auth/login",
+        data=user1
+    )
+    token = response.json()['token']
+    orders = [
+        {"player_id": 1, "asking_price": 1100000},
+        {"player_id": 2, "asking_price": 1200000},
+        {"player_id": 30, "asking_price": 1100000},
+        {"player_id": 3, "asking_price": 0},
+        {"player_id": 99, "asking_price": 1100000},
+    ]
+    response = client.post(
+        "/market/sell/batch",
+        json=orders,
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    data = response.json()
+    assert response.status_code == 200
+    assert data['msg'] == '2 of 5 players put on the market'
+    assert [result['ok'] for result in data['results']] == [True, True, False, False, False]
+    assert data['results'][1]['player']['requested_value'] == 1200000
+    assert data['results'][2]['msg'] == "player with the given id does not belong to user"
+    assert data['results'][3]['msg'] == "price requested for player not allowed"
+    assert data['results'][4]['msg'] == "player does not exist"
+    assert [player['id'] for player in client.get("/market/").json()] == [1, 2]
+
+    response = client.post(
+        "/market/withdraw/batch",
+        json=[1, 3],
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    data = response.json()
+    assert data['msg'] == '1 of 2 players withdrawn from market listing'
+    assert data['results'][0]['player']['on_market'] is False
+    assert data['results'][1]['msg'] == "player not on market list"
+    assert [player['id'] for player in client.get("/market/").json()] == [2]
+
+
+def test_market_export(test_db):
+    """
+    the market list is streamed as NDJSON or CSV
+    """
+    user = {"username": "user@example.com", "password": "password"}
+    client.post(
+        "/auth/register",
+        json=user
+    )
+    response = client.post(
+        "/auth/login",
+        data=user
+    )
+    token = response.json()['token']
+    for player_id in (4, 2):
+        client.get(
+            f"/market/sell?player_id={player_id}&asking_price=1100000",
+            headers={"Authorization": f"Bearer {token}"},
+        )
+
+    response = client.get("/market/export")
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    listing = client.get("/market/").json()
+    assert [{key: row[key] for key in listing[0]} for row in rows] == listing
+    assert [row['id'] for row in rows] == [2, 4]
+    assert rows[0]['team_id'] == '1'
+    assert rows[0]['requested_value'] == 1100000
+
+    response = client.get("/market/export?format=csv&role=goalkeeper")
+    assert response.headers['content-type'].startswith('text/csv')
+    lines = response.text.splitlines()
+    assert lines[0] == 'id,name,surname,country,role,age,value,team_id,requested_value'
+    assert len(lines) == 2 and lines[1].startswith('2,')
@@ -0,0 +1,78 @@
+import re
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def instrumented(db_engine, async_db_engine):
+    # the engines serving the requests of the tests
+    metrics.instrument_engine(db_engine)
+    metrics.instrument_engine(async_db_engine)
+
+
+def sample(text, name, **labels):
+    """
+    value of the sample `name` having (at least) `labels`, 0 when missing
+    """
+    for line in text.splitlines():
+        match = re.match(r'^(\w+)(?:\{(.*)\})? (\S+)$', line)
+        if match and match.group(1) == name:
+            found = dict(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', match.group(2) or ''))
+            if all(found.get(key) == str(value) for key, value in labels.items()):
+                return float(match.group(3))
+    return 0
+
+
+def test_histogram_render():
+    histogram = metrics.Histogram('test_latency_seconds', 'test', ('route',), buckets=(0.1, 1))
+    metrics.REGISTRY.remove(histogram)
+    histogram.observe(0.05, '/a')
+    histogram.observe(0.1, '/a')
+    histogram.observe(5, '/a')
+    text = histogram.render()
+    assert '# TYPE test_latency_seconds histogram' in text
+    assert sample(text, 'test_latency_seconds_bucket', route='/a', le='0.1') == 2
+    assert sample(text, 'test_latency_seconds_bucket', route='/a', le=1) == 2
+    assert sample(text, 'test_latency_seconds_bucket', route='/a', le='+Inf') == 3
+    assert sample(text, 'test_latency_seconds_count', route='/a') == 3
+    assert sample(text, 'test_latency_seconds_sum', route='/a') == pytest.approx(5.15)
+
+
+def test_metrics(test_db, client):
+    before = client.get('/metrics').text
+    user = {"username": "user@example.com", "password": "password"}
+    client.post("/auth/register", json=user)
+    token = client.post("/auth/login", data=user).json()['token']
+    client.get("/players/user", headers={"Authorization": f"Bearer {token}"})
+    client.get("/market/")
+    client.get("/market/")
+    client.get("/no-such-route")
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain; version=0.0.4')
+    text = response.text
+
+    def delta(name, **labels):
+        return sample(text, name, **labels) - sample(before, name, **labels)
+
+    market = {'router': 'market', 'method': 'GET', 'route': '/market/'}
+    assert delta('http_requests_total', status=200, **market) == 2
+    assert delta('http_request_duration_seconds_count', **market) == 2
+    assert delta('http_requests_total', route='unmatched', status=404) == 1
+    # the second listing is served from the cache, without queries
+    assert delta('http_request_db_queries_bucket', le=0, **market) == 1
+    players = {'router': 'players', 'method': 'GET', 'route': '/players/user'}
+    assert delta('http_request_db_queries_count', **players) == 1
+    assert delta('http_request_db_queries_sum', **players) >= 1
+    assert delta('http_request_db_seconds_sum', **players) > 0
+    assert delta('db_queries_total') > 0
+    assert delta('db_pool_checkout_seconds_count') > 0
+    assert delta('password_hash_seconds_count', operation='get_password_hash') == 1
+    assert delta('password_hash_seconds_count', operation='verify_password') == 1
+    assert delta('market_cache_hits_total') == 1
+    assert delta('market_cache_misses_total') == 1
+    # only the /metrics request itself is still being served
+    assert sample(text, 'http_requests_in_flight') == 1
@@ -0,0 +1,171 @@
+import models
+from cache import ORDERS, invalidation_bus
+from orderbook import BookAsk, BookBid, OrderBook, order_book
+from params import budget
+
+
+def ask(player_id, price, team_id=1, role='attacker', age=25, country='Italy'):
+    return BookAsk(player_id, team_id, price, role, age, country)
+
+
+def test_bids_priority():
+    book = OrderBook()
+    book.load([
+        BookBid(1, team_id=2, max_price=100, role='attacker'),
+        BookBid(2, team_id=3, max_price=120, role='attacker'),
+        BookBid(3, team_id=4, max_price=120, role='attacker'),
+        BookBid(4, team_id=5, max_price=200, player_id=7),
+        BookBid(5, team_id=6, max_price=500, role='attacker', max_age=20),
+        BookBid(6, team_id=1, max_price=900, role='attacker'),
+    ], [])
+    book.update_asks([(7, ask(7, 90))])
+    # the player bid is the highest accepting the ask: too young for bid 5, bid 6 is from the seller team
+    bid, listed = book.take_crossing(player_id=7)
+    assert (bid.id, listed.player_id) == (4, 7)
+    book.update_asks([(8, ask(8, 90))])
+    # same price: the oldest bid first
+    assert book.take_crossing(player_id=8)[0].id == 2
+    book.update_asks([(9, ask(9, 110))])
+    assert book.take_crossing(player_id=9)[0].id == 3
+    book.update_asks([(10, ask(10, 110))])
+    assert book.take_crossing(player_id=10) is None
+
+
+def test_asks_priority():
+    book = OrderBook()
+    book.load([], [ask(1, 300), ask(2, 200), ask(3, 200), ask(4, 100, role='defender'), ask(5, 50, age=35)])
+    book.add_bid(BookBid(1, team_id=2, max_price=250, role='attacker', max_age=30))
+    # cheapest first, then first listed; player 5 is too old
+    bid, listed = book.take_crossing(bid_id=1)
+    assert listed.player_id == 2
+    book.restore(bid=bid)
+    bid, listed = book.take_crossing(bid_id=1)
+    assert listed.player_id == 3
+    book.restore(bid=bid)
+    # a new price resets the time priority
+    book.update_asks([(1, ask(1, 200)), (6, ask(6, 200))])
+    bid, listed = book.take_crossing(bid_id=1)
+    assert listed.player_id == 1
+    book.restore(bid=bid)
+    book.update_asks([(6, None)])
+    assert book.take_crossing(bid_id=1) is None
+
+
+def test_restore_keeps_priority():
+    book = OrderBook()
+    book.load([BookBid(1, team_id=2, max_price=100, role='attacker')], [ask(1, 80), ask(2, 80)])
+    bid, first = book.take_crossing(bid_id=1)
+    assert first.player_id == 1
+    book.restore(bid=bid, ask=first)
+    assert book.take_crossing(bid_id=1)[1].player_id == 1
+
+
+def test_bid_filled_by_listing(test_db, client, auth_headers):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    response = client.post("/market/bids", json={"player_id": 1, "max_price": 2000000}, headers=buyer)
+    assert response.status_code == 200
+    assert response.json()['msg'] == 'bid placed'
+    bid = response.json()['bid']
+    assert client.get("/market/bids", headers=buyer).json() == [bid]
+
+    # too expensive for the bid
+    response = client.get("/market/sell?player_id=1&asking_price=3000000", headers=seller)
+    assert response.json()['trades'] == []
+    response = client.get("/market/sell?player_id=1&asking_price=1500000", headers=seller)
+    data = response.json()
+    assert data['msg'] == 'player sold to a standing bid'
+    assert data['trades'] == [
+        {'bid_id': bid['id'], 'player_id': 1, 'price': 1500000, 'seller_team_id': 1, 'buyer_team_id': 2}
+    ]
+    assert data['player']['team_id'] == '2' and not data['player']['on_market']
+    assert client.get("/team/user", headers=buyer).json()['budget'] == budget - 1500000
+    assert client.get("/team/user", headers=seller).json()['budget'] == budget + 1500000
+    assert client.get("/market/bids", headers=buyer).json() == []
+    assert client.get("/market/").json() == []
+
+
+def test_role_bid_filled_at_once(test_db, client, auth_headers):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    players = client.get("/players/user", headers=seller).json()
+    attackers = [player for player in players if player['role'] == 'attacker']
+    client.post("/market/sell/batch", headers=seller, json=[
+        {"player_id": attackers[0]['id'], "asking_price": 900000},
+        {"player_id": attackers[1]['id'], "asking_price": 800000},
+        {"player_id": attackers[2]['id'], "asking_price": 800000},
+    ])
+    response = client.post("/market/bids", json={"role": "attacker", "max_price": 850000}, headers=buyer)
+    data = response.json()
+    assert data['msg'] == 'bid filled'
+    assert [trade['player_id'] for trade in data['trades']] == [attackers[1]['id']]
+    assert {player['id'] for player in client.get("/market/").json()} == {attackers[0]['id'], attackers[2]['id']}
+
+
+def test_unaffordable_bid_is_skipped(test_db, client, auth_headers):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    client.post("/market/bids", json={"player_id": 1, "max_price": budget * 2}, headers=buyer)
+    response = client.get(f"/market/sell?player_id=1&asking_price={budget + 1}", headers=seller)
+    assert response.json()['trades'] == []
+    assert response.json()['player']['on_market']
+    # the bid stands, and fills once the buyer can pay
+    assert len(client.get("/market/bids", headers=buyer).json()) == 1
+    response = client.get("/market/sell?player_id=1&asking_price=1000", headers=seller)
+    assert [trade['buyer_team_id'] for trade in response.json()['trades']] == [2]
+    assert client.get("/market/bids", headers=buyer).json() == []
+
+
+def test_invalid_bids(test_db, client, auth_headers):
+    seller = auth_headers("seller@example.com")
+    response = client.post("/market/bids", json={"max_price": 100}, headers=seller)
+    assert response.status_code == 400
+    response = client.post("/market/bids", json={"player_id": 1, "role": "attacker", "max_price": 100}, headers=seller)
+    assert response.status_code == 400
+    response = client.post("/market/bids", json={"player_id": 1, "max_price": 100}, headers=seller)
+    assert response.json()['detail'] == 'player with the given already belongs to user'
+    response = client.post("/market/bids", json={"role": "attacker", "max_price": 0}, headers=seller)
+    assert response.status_code == 400
+
+
+def test_cancel_bid(test_db, client, auth_headers):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    bid = client.post("/market/bids", json={"player_id": 1, "max_price": 2000000}, headers=buyer).json()['bid']
+    assert client.delete(f"/market/bids/{bid['id']}", headers=seller).status_code == 400
+    response = client.delete(f"/market/bids/{bid['id']}", headers=buyer)
+    assert response.json() == {'msg': 'bid cancelled', 'bid': bid}
+    response = client.get("/market/sell?player_id=1&asking_price=1000000", headers=seller)
+    assert response.json()['trades'] == []
+
+
+def test_book_rebuilt_from_database(test_db, client, auth_headers):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    client.post("/market/bids", json={"role": "goalkeeper", "max_price": 2000000}, headers=buyer)
+    order_book.clear()
+    response = client.get("/market/sell?player_id=1&asking_price=1000000", headers=seller)
+    assert response.json()['msg'] == 'player sold to a standing bid'
+
+
+def test_book_follows_other_workers(test_db, client, auth_headers, db_sessions, monkeypatch):
+    seller = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    loads = []
+    load = order_book.load
+    monkeypatch.setattr(order_book, 'load', lambda *args: loads.append(args) or load(*args))
+    client.post("/market/bids", json={"player_id": 2, "max_price": 100}, headers=buyer)
+    client.get("/market/sell?player_id=3&asking_price=1000", headers=seller)
+    client.delete("/market/bids/1", headers=buyer)
+    client.get("/market/sell?player_id=4&asking_price=1000", headers=seller)
+    # the changes of this worker are applied to its book
+    assert len(loads) == 1
+
+    # another worker places a bid: stored in the database, its topic bumped in the shared cache backend
+    with db_sessions() as db:
+        db.add(models.Bid(team_id=2, player_id=1, max_price=2000000))
+        db.commit()
+    invalidation_bus.backend.bump([ORDERS])
+    response = client.get("/market/sell?player_id=1&asking_price=1500000", headers=seller)
+    assert response.json()['msg'] == 'player sold to a standing bid'
+    assert len(loads) == 2
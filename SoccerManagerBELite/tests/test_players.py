@@ -1,18 +1,28 @@
+import json
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 
-from database import Base, get_db
+from database import Base, get_db, get_async_db
 from main import app
+import crud
+import schemas
+import serializers
 from params import initial_player_value, team_size
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+SQLALCHEMY_ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./test.db"
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_engine(SQLALCHEMY_ASYNC_DATABASE_URL)
+TestingAsyncSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, class_=AsyncSession, bind=async_engine
+)
 
 Base.metadata.create_all(bind=engine)
 
@@ -25,6 +35,14 @@ def override_get_db():
         db.close()
 
 
+async def override_get_async_db():
+    try:
+        db = TestingAsyncSessionLocal()
+        yield db
+    finally:
+        await db.close()
+
+
 @pytest.fixture()
 def test_db():
     Base.metadata.create_all(bind=engine)
@@ -33,6 +51,7 @@ def test_db():
 
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
 
 client = TestClient(app)
 
@@ -224,3 +243,56 @@ def test_player_not_yours(test_db):
     data = response.json()
     assert response.status_code == 400
     assert data == {'detail': 'player with the given id does not belong to user'}
+
+
+def test_players_export(test_db):
+    """
+    the user players are streamed as NDJSON or CSV
+    """
+    user = {"username": "user@example.com", "password": "password"}
+    client.post(
+        "/auth/register",
+        json=user
+    )
+    response = client.post(
+        "/auth/login",
+        data=user
+    )
+    token = response.json()['token']
+    players = client.get(
+        "/players/user",
+        headers={"Authorization": f"Bearer {token}"}
+    ).json()
+
+    response = client.get(
+        "/players/user/export",
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    assert response.status_code == 200
+    assert [json.loads(line) for line in response.text.splitlines()] == players
+
+    response = client.get(
+        "/players/user/export?format=csv",
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    lines = response.text.splitlines()
+    assert lines[0] == 'id,name,surname,country,role,age,value,team_id'
+    assert len(lines) == len(players) + 1
+
+
+def test_players_rows_match_schema(test_db, monkeypatch):
+    """
+    the rows encoded without pydantic have the shape of schemas.DBPlayer, with either json encoder
+    """
+    user = {"username": "user@example.com", "password": "password"}
+    client.post(
+        "/auth/register",
+        json=user
+    )
+    db = TestingSessionLocal()
+    expected = [json.loads(schemas.DBPlayer.from_orm(player).json()) for player in crud.get_players_by_team_id(db, 1)]
+    rows = crud.get_team_player_rows(db, 1)
+    assert json.loads(serializers.encode_players(rows)) == expected
+    monkeypatch.setattr(serializers, 'orjson', None)
+    assert json.loads(serializers.encode_players(rows)) == expected
+    db.close()
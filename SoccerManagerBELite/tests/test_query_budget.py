@@ -0,0 +1,95 @@
+import logging
+
+from fastapi.testclient import TestClient
+
+import crud
+from authorizations import CurrentIdentity
+from orderbook import order_book
+from query_budget import ROUTE_BUDGETS, QueryBudgetMiddleware, statement_shape
+
+
+def test_statement_shape():
+    assert statement_shape("SELECT * FROM players WHERE id IN (?, ?, ?) AND name = 'x'") == \
+        statement_shape("SELECT *  FROM players\nWHERE id IN (?) AND name = 'y'") == \
+        "SELECT * FROM players WHERE id IN (?) AND name = ?"
+    assert statement_shape("SELECT 1 LIMIT 10") == "SELECT ? LIMIT ?"
+
+
+def test_route_budgets(test_db, query_counter, client, auth_headers, db_sessions):
+    headers = auth_headers("seller@example.com")
+    buyer = auth_headers("buyer@example.com")
+    # loaded at startup
+    order_book.clear()
+    with db_sessions() as db:
+        crud.load_order_book(db)
+    user = {"username": "user@example.com", "password": "password"}
+    requests = [
+        (('POST', '/auth/register'), lambda: client.post("/auth/register", json=user)),
+        (('POST', '/auth/login'), lambda: client.post("/auth/login", data=user)),
+        (('GET', '/market/sell'), lambda: client.get("/market/sell?player_id=1&asking_price=100", headers=headers)),
+        (('GET', '/market/'), lambda: client.get("/market/")),
+        (('GET', '/market/withdraw'), lambda: client.get("/market/withdraw?player_id=1", headers=headers)),
+        (('POST', '/market/sell/batch'), lambda: client.post(
+            "/market/sell/batch", json=[{"player_id": i, "asking_price": 100} for i in range(1, 11)], headers=headers
+        )),
+        (('POST', '/market/withdraw/batch'), lambda: client.post(
+            "/market/withdraw/batch", json=list(range(2, 11)), headers=headers
+        )),
+        (('GET', '/market/buy'), lambda: client.get("/market/buy?player_id=1", headers=buyer)),
+        (('POST', '/market/bids'), lambda: client.post("/market/bids", json={"player_id": 2, "max_price": 1}, headers=buyer)),
+        (('GET', '/market/bids'), lambda: client.get("/market/bids", headers=buyer)),
+        (('DELETE', '/market/bids/{bid_id}'), lambda: client.delete("/market/bids/1", headers=buyer)),
+        (('POST', '/market/auctions'), lambda: client.post(
+            "/market/auctions", json={"player_id": 3, "reserve_price": 100, "duration": 3600}, headers=headers
+        )),
+        (('GET', '/market/auctions'), lambda: client.get("/market/auctions")),
+        (('POST', '/market/auctions/{auction_id}/bids'), lambda: client.post(
+            "/market/auctions/1/bids?amount=100", headers=buyer
+        )),
+        (('GET', '/players/user'), lambda: client.get("/players/user", headers=headers)),
+        (('GET', '/players/update'), lambda: client.get("/players/update?player_id=2&player_name=x", headers=headers)),
+        (('GET', '/team/user'), lambda: client.get("/team/user", headers=headers)),
+        (('GET', '/team/update'), lambda: client.get("/team/update?team_name=x", headers=headers)),
+        (('GET', '/players/{player_id}/history'), lambda: client.get("/players/1/history")),
+        (('GET', '/team/transfers'), lambda: client.get("/team/transfers", headers=headers)),
+        (('GET', '/team/transfers/totals'), lambda: client.get("/team/transfers/totals", headers=headers)),
+    ]
+    assert {route for route, _ in requests} == set(ROUTE_BUDGETS)
+    for route, request in requests:
+        with query_counter() as queries:
+            response = request()
+        assert response.status_code == 200, (route, response.text)
+        queries.assert_at_most(ROUTE_BUDGETS[route])
+        queries.assert_no_repeats()
+
+
+def test_identity_loads_team_and_user_at_once(test_db, query_counter, auth_headers, db_sessions):
+    identity = CurrentIdentity(auth_headers("user@example.com")["Authorization"].split()[1])
+    with db_sessions() as db:
+        with query_counter() as queries:
+            team = identity.load(db)
+            assert identity.load(db) is team
+            assert (team.id, team.user.username) == (identity.team_id, "user@example.com")
+        queries.assert_at_most(1)
+
+
+def test_repeated_queries_are_reported(caplog):
+    middleware = QueryBudgetMiddleware(app=None, budgets={('GET', '/team/user'): 1}, repeat_threshold=3)
+    statements = [f"SELECT * FROM players WHERE players.team_id = {team_id}" for team_id in range(3)]
+    with caplog.at_level(logging.WARNING, logger='query_budget'):
+        middleware.check('GET /team/user', 1, statements)
+    assert 'ran 3 queries, over its budget of 1' in caplog.text
+    assert 'ran 3 times the same query, possible N+1: SELECT * FROM players WHERE players.team_id = ?' in caplog.text
+
+
+def test_middleware_logs_requests_over_budget(test_db, caplog, auth_headers, test_app):
+    headers = auth_headers("user@example.com")
+    middleware = QueryBudgetMiddleware(test_app, budgets={('GET', '/players/user'): 0})
+    middleware_client = TestClient(middleware)
+    with caplog.at_level(logging.WARNING, logger='query_budget'):
+        response = middleware_client.get("/players/user", headers=headers)
+        assert response.status_code == 200
+        assert 'GET /players/user ran 1 queries, over its budget of 0' in caplog.text
+        caplog.clear()
+        middleware_client.get("/team/user", headers=headers)
+        assert caplog.text == ''
@@ -0,0 +1,240 @@
+import asyncio
+from collections import Counter
+
+import httpx
+import pytest
+from sqlalchemy import func
+
+import crud
+import models
+import sharding
+from params import budget
+
+
+@pytest.fixture()
+def shards(test_db, tmp_path, monkeypatch):
+    """
+    two sqlite shards for the teams, test.db as the users database
+    """
+    shard_set = sharding.ShardSet([f"sqlite:///{tmp_path / f'shard{n}.db'}" for n in range(2)])
+    shard_set.upgrade()
+    monkeypatch.setattr(sharding, 'shards', shard_set)
+    yield shard_set
+    asyncio.run(shard_set.dispose())
+
+
+@pytest.fixture()
+def register(client, auth_headers, shards):
+    def register(count):
+        """
+        :return: headers, team id and shard of `count` new users
+        """
+        teams = []
+        for n in range(count):
+            headers = auth_headers(f"user{n}@example.com")
+            # a sharded team has the id of its user
+            team_id = int(client.get("/team/user", headers=headers).json()['user_id'])
+            teams.append((headers, team_id, shards.shard_of(team_id)))
+        return teams
+
+    return register
+
+
+def on_other_shards(teams):
+    seller = teams[0]
+    return seller, next(team for team in teams if team[2] != seller[2])
+
+
+def total_budget(shard_set):
+    total = 0
+    for sessions in shard_set.sessions:
+        with sessions() as db:
+            total += db.query(func.sum(models.Team.budget)).scalar() or 0
+    return total
+
+
+def test_jump_hash():
+    keys = range(1, 10001)
+    # balanced, and growing from 4 to 5 shards only moves keys to the new one
+    assert min(Counter(sharding.jump_hash(key, 4) for key in keys).values()) > 2300
+    moved = [key for key in keys if sharding.jump_hash(key, 4) != sharding.jump_hash(key, 5)]
+    assert all(sharding.jump_hash(key, 5) == 4 for key in moved)
+    assert 1700 < len(moved) < 2300
+
+
+def test_teams_on_their_shard(shards, client, db_sessions, register):
+    teams = register(4)
+    assert {team[2] for team in teams} == {0, 1}
+    for headers, team_id, shard in teams:
+        with shards.sessions[shard]() as db:
+            assert crud.get_team_by_team_id(db, team_id).budget == budget
+            players = crud.get_players_by_team_id(db, team_id)
+        assert [player.id for player in players] == sharding.player_ids(team_id, len(players))
+        with shards.sessions[1 - shard]() as db:
+            assert crud.get_team_by_team_id(db, team_id) is None
+        roster = client.get("/players/user", headers=headers).json()
+        assert sorted(player['id'] for player in roster) == [player.id for player in players]
+    # the users database keeps the users only
+    with db_sessions() as db:
+        assert db.query(models.User).count() == 4 and db.query(models.Team).count() == 0
+
+
+def test_cross_shard_buy(shards, client, register):
+    teams = register(4)
+    (seller, seller_team, seller_shard), (buyer, buyer_team, buyer_shard) = on_other_shards(teams)
+    player_id = sharding.player_ids(seller_team, 1)[0]
+    before = total_budget(shards)
+    assert client.get(f"/market/sell?player_id={player_id}&asking_price=1000", headers=seller).status_code == 200
+    assert [player['id'] for player in client.get("/market/").json()] == [player_id]
+
+    response = client.get(f"/market/buy?player_id={player_id}", headers=buyer)
+    assert response.status_code == 200
+    assert response.json()['player']['team_id'] == str(buyer_team)
+    assert client.get("/market/").json() == []
+    assert total_budget(shards) == before
+    assert client.get("/team/user", headers=seller).json()['budget'] == budget + 1000
+    assert client.get("/team/user", headers=buyer).json()['budget'] == budget - 1000
+    assert player_id in [player['id'] for player in client.get("/players/user", headers=buyer).json()]
+    assert player_id not in [player['id'] for player in client.get("/players/user", headers=seller).json()]
+    # each shard records its side of the sale, and the team values still add up
+    for headers, side in ((seller, 'sold'), (buyer, 'bought')):
+        assert client.get("/team/transfers/totals", headers=headers).json()[side] == 1
+        assert client.get("/team/transfers", headers=headers).json()[0]['player_id'] == player_id
+    for sessions in shards.sessions:
+        with sessions() as db:
+            assert crud.check_team_values(db) == []
+
+    # the player moves on from its new shard
+    assert client.get(f"/market/sell?player_id={player_id}&asking_price=10", headers=buyer).status_code == 200
+    assert client.get(f"/market/buy?player_id={player_id}", headers=seller).status_code == 200
+    assert total_budget(shards) == before
+
+
+def test_concurrent_cross_shard_buyers(shards, client, register, test_app):
+    teams = register(6)
+    seller = teams[0]
+    buyers = [team for team in teams if team[2] != seller[2]]
+    player_id = sharding.player_ids(seller[1], 1)[0]
+    client.get(f"/market/sell?player_id={player_id}&asking_price=1000", headers=seller[0])
+    before = total_budget(shards)
+
+    async def run():
+        async with httpx.AsyncClient(app=test_app, base_url='http://test') as async_client:
+            return await asyncio.gather(*(
+                async_client.get(f"/market/buy?player_id={player_id}", headers=headers) for headers, _, _ in buyers
+            ))
+
+    responses = asyncio.run(run())
+    assert sorted(response.status_code for response in responses) == [200] + [400] * (len(buyers) - 1)
+    assert total_budget(shards) == before
+
+
+def test_transfer_refused_or_interrupted(shards, client, register):
+    teams = register(4)
+    (seller, seller_team, seller_shard), (buyer, buyer_team, buyer_shard) = on_other_shards(teams)
+    first, second, third = sharding.player_ids(seller_team, 3)
+    for player_id in (first, second, third):
+        client.get(f"/market/sell?player_id={player_id}&asking_price=1000", headers=seller)
+    seller_db, buyer_db = shards.sessions[seller_shard](), shards.sessions[buyer_shard]()
+
+    # the buyer cannot pay anymore: the player is listed again
+    buyer_db.query(models.Team).filter(models.Team.id == buyer_team).update({models.Team.budget: 10})
+    buyer_db.commit()
+    player = crud.get_player_by_player_id(seller_db, first)
+    transfer = crud.reserve_transfer(seller_db, player, buyer_team)
+    assert crud.get_player_by_player_id(seller_db, first).team_id is None
+    assert crud.receive_transfer(buyer_db, transfer, player) == 'cancelled'
+    assert crud.cancel_transfer(seller_db, transfer.id)
+    relisted = crud.get_player_by_player_id(seller_db, first)
+    assert (relisted.team_id, relisted.on_market, relisted.requested_value) == (seller_team, True, 1000)
+    buyer_db.query(models.Team).filter(models.Team.id == buyer_team).update({models.Team.budget: budget})
+    buyer_db.commit()
+    before = total_budget(shards)
+
+    # a worker stopped after the buyer paid, another before it
+    received = crud.reserve_transfer(seller_db, crud.get_player_by_player_id(seller_db, second), buyer_team)
+    assert crud.receive_transfer(buyer_db, received, crud.get_player_by_player_id(seller_db, second)) == 'received'
+    lost = crud.reserve_transfer(seller_db, crud.get_player_by_player_id(seller_db, third), buyer_team)
+    # in flight: the money paid by the buyer is not counted yet
+    assert total_budget(shards) == before - 1000
+    assert sharding.resume_transfers(shards, older_than=0) == 2
+    assert total_budget(shards) == before
+    assert crud.get_player_by_player_id(seller_db, second) is None
+    assert crud.get_player_by_player_id(seller_db, third).on_market
+    # the cancelled transfer cannot be received late
+    assert crud.receive_transfer(buyer_db, lost, crud.get_player_by_player_id(seller_db, third)) == 'cancelled'
+    assert crud.get_player_by_player_id(buyer_db, third) is None
+    for db in (seller_db, buyer_db):
+        assert crud.check_team_values(db) == []
+        db.close()
+
+
+def test_resumer_finishes_stale_transfers(shards, monkeypatch, client, register):
+    teams = register(4)
+    (seller, seller_team, seller_shard), (buyer, buyer_team, buyer_shard) = on_other_shards(teams)
+    player_id = sharding.player_ids(seller_team, 1)[0]
+    client.get(f"/market/sell?player_id={player_id}&asking_price=1000", headers=seller)
+    with shards.sessions[seller_shard]() as seller_db:
+        crud.reserve_transfer(seller_db, crud.get_player_by_player_id(seller_db, player_id), buyer_team)
+
+    async def run():
+        resumer = sharding.TransferResumer(interval=0.05)
+        resumer.start()
+        await asyncio.sleep(0.5)
+        await resumer.stop()
+
+    monkeypatch.setattr(sharding.settings, 'SHARD_TRANSFER_TIMEOUT', 0)
+    asyncio.run(run())
+    with shards.sessions[seller_shard]() as seller_db:
+        relisted = crud.get_player_by_player_id(seller_db, player_id)
+        assert (relisted.team_id, relisted.on_market) == (seller_team, True)
+
+
+def test_find_player_on_home_shard(shards, client, register):
+    teams = register(4)
+    (seller, seller_team, seller_shard), (buyer, buyer_team, buyer_shard) = on_other_shards(teams)
+    player_id = sharding.player_ids(seller_team, 1)[0]
+
+    async def find():
+        """
+        :return: team of the player, shard of its session, and the shards read
+        """
+        sessions = sharding.ShardSessions(shards, None)
+        try:
+            player, db = await sharding.find_player(sessions, player_id)
+            shard = next(index for index, opened in sessions._opened.items() if opened is db)
+            return player.team_id, shard, set(sessions._opened)
+        finally:
+            await sessions.close()
+
+    # found where it was generated, without reading the other shard
+    assert asyncio.run(find()) == (seller_team, seller_shard, {seller_shard})
+    client.get(f"/market/sell?player_id={player_id}&asking_price=1000", headers=seller)
+    client.get(f"/market/buy?player_id={player_id}", headers=buyer)
+    assert asyncio.run(find()) == (buyer_team, buyer_shard, {0, 1})
+
+def test_market_merged_across_shards(shards, client, register):
+    teams = register(4)
+    prices = {}
+    for n, (headers, team_id, _) in enumerate(teams):
+        for player_id in sharding.player_ids(team_id, 3):
+            prices[player_id] = 100 + (player_id * 7919 + n) % 1000
+            client.get(f"/market/sell?player_id={player_id}&asking_price={prices[player_id]}", headers=headers)
+
+    for order, reverse in (('asc', False), ('desc', True)):
+        listed, cursor = [], None
+        while True:
+            query = f"/market/?sort=price&order={order}&limit=5" + (f"&cursor={cursor}" if cursor else "")
+            response = client.get(query)
+            listed += [player['id'] for player in response.json()]
+            cursor = response.headers.get('X-Next-Cursor')
+            if cursor is None:
+                break
+        assert listed == sorted(prices, key=lambda player_id: (prices[player_id], player_id), reverse=reverse)
+
+
+def test_single_database_routes(shards, client, auth_headers):
+    headers = auth_headers("user@example.com")
+    assert client.get("/market/bids", headers=headers).status_code == 501
+    assert client.get("/market/auctions").status_code == 501
+    assert client.get("/players/1/history").status_code == 501
@@ -2,17 +2,25 @@ import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 
-from database import Base, get_db
+from database import Base, get_db, get_async_db
 from main import app
+import crud
+import models
 from params import budget, initial_player_value, team_size
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+SQLALCHEMY_ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./test.db"
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_engine(SQLALCHEMY_ASYNC_DATABASE_URL)
+TestingAsyncSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, class_=AsyncSession, bind=async_engine
+)
 
 Base.metadata.create_all(bind=engine)
 
@@ -25,6 +33,14 @@ def override_get_db():
         db.close()
 
 
+async def override_get_async_db():
+    try:
+        db = TestingAsyncSessionLocal()
+        yield db
+    finally:
+        await db.close()
+
+
 @pytest.fixture()
 def test_db():
     Base.metadata.create_all(bind=engine)
@@ -33,6 +49,7 @@ def test_db():
 
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
 
 client = TestClient(app)
 
@@ -137,3 +154,24 @@ def test_update_team_name_and_country(test_db):
     assert response.status_code == 200
     assert data['name'] == 'new name'
     assert data['country'] == 'another name'
+
+
+def test_team_value_check_and_rebuild(test_db):
+    """
+    inconsistent stored team values are reported, and rebuilt from the players values
+    """
+    user = {"username": "user@example.com", "password": "password"}
+    client.post(
+        "/auth/register",
+        json=user
+    )
+    db = TestingSessionLocal()
+    assert crud.check_team_values(db) == []
+    team = db.query(models.Team).first()
+    team.value = 1
+    db.commit()
+    number_of_players = sum([n for n in team_size.values()])
+    assert crud.check_team_values(db) == [(team.id, 1, initial_player_value * number_of_players)]
+    assert crud.rebuild_team_values(db) == 1
+    assert crud.check_team_values(db) == []
+    db.close()
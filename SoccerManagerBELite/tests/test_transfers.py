@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import func
+
+import crud
+import models
+import schemas
+from params import budget
+
+
+def register(db, n):
+    user = schemas.User(username=f"user{n}@example.com", password="password")
+    return crud.register_user(db, user, 'hash')
+
+
+def test_concurrent_buyers_single_winner(test_db, db_sessions):
+    """
+    many buyers racing for the same listed player: exactly one gets it, and money is conserved
+    """
+    buyers = 12
+    price = 1500000
+    db = db_sessions()
+    for n in range(buyers + 1):
+        register(db, n)
+    seller_team = crud.get_team_by_user_id(db, 1)
+    player = crud.get_players_by_team_id(db, seller_team.id)[0]
+    crud.put_player_for_sale(db, player, price)
+    player_id, seller_team_id = player.id, seller_team.id
+    db.close()
+
+    barrier = threading.Barrier(buyers)
+    outcomes = {}
+
+    def buy(team_id):
+        session = db_sessions()
+        try:
+            listed_player = crud.get_player_by_player_id(session, player_id)
+            team = crud.get_team_by_team_id(session, team_id)
+            barrier.wait()
+            crud.acquire_player(session, listed_player, team)
+            outcomes[team_id] = 'won'
+        except HTTPException as error:
+            outcomes[team_id] = error.detail
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=buy, args=(team_id,)) for team_id in range(2, buyers + 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    winners = [team_id for team_id, outcome in outcomes.items() if outcome == 'won']
+    assert len(outcomes) == buyers
+    assert len(winners) == 1
+    assert set(outcomes.values()) == {'won', 'player not on market list'}
+
+    db = db_sessions()
+    player = crud.get_player_by_player_id(db, player_id)
+    assert player.team_id == winners[0]
+    assert not player.on_market
+    assert crud.get_team_by_team_id(db, seller_team_id).budget == budget + price
+    assert crud.get_team_by_team_id(db, winners[0]).budget == budget - price
+    assert db.query(func.sum(models.Team.budget)).scalar() == budget * (buyers + 1)
+    assert crud.check_team_values(db) == []
+    # one sale in the ledger
+    assert db.query(models.Transfer.buyer_team_id).all() == [(winners[0],)]
+    db.close()
+
+
+def test_buy_guarded_on_budget(test_db, db_sessions):
+    """
+    the budget guard refuses a purchase the buyer cannot afford, leaving everything unchanged
+    """
+    db = db_sessions()
+    register(db, 1)
+    register(db, 2)
+    player = crud.get_players_by_team_id(db, 1)[0]
+    crud.put_player_for_sale(db, player, 1000)
+    buyer_team = crud.get_team_by_team_id(db, 2)
+    # another transfer spent the budget after the buyer team was read
+    db.query(models.Team).filter(models.Team.id == 2).update({models.Team.budget: 10})
+    db.commit()
+    with pytest.raises(HTTPException) as error:
+        crud.acquire_player(db, player, buyer_team)
+    assert error.value.detail == 'user does not have enough money to buy player'
+    db.expire_all()
+    player = crud.get_player_by_player_id(db, player.id)
+    assert player.team_id == 1 and player.on_market
+    assert crud.get_team_by_team_id(db, 1).budget == budget
+    assert crud.get_team_by_team_id(db, 2).budget == 10
+    assert db.query(models.Transfer).count() == 0
+    db.close()